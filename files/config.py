@@ -1,3 +1,50 @@
-DATABASE_NAME = 'userdata.db'
-CSV_IMPORT_HEADER = ['name', 'username', 'password']
-TABLE_HEADERS = ['Description', 'Username', 'Password']
\ No newline at end of file
+import os
+
+DATABASE_NAME = 'userdata.db'
+# движок хранилища: 'sqlite' (DATABASE_NAME), 'sqlite-sharded' (каталог DATABASE_NAME + файл на пользователя),
+# 'memory' (без сохранения), 'log' (файл-журнал DATABASE_NAME)
+STORAGE_BACKEND = 'sqlite'
+CSV_IMPORT_HEADER = ['name', 'username', 'password']
+TABLE_HEADERS = ['Description', 'Username', 'Password']
+TABLE_ROW_HEIGHT = 30  # высота всех строк таблицы, px (одинаковая - представлению не нужны размеры строк)
+COLLATION_CACHE_SIZE = 4096  # ключей сортировки таблицы в кэше (повторяющиеся логины не пересчитываются)
+DATA_PAGE_SIZE = 200  # записей на страницу при постраничной загрузке таблицы
+# 'split' - описание/логин и пароль шифруются отдельно, пароль расшифровывается только при использовании
+# 'blob' - вся запись шифруется одним блоком (прежний формат, по-прежнему читается в обоих режимах)
+DATA_STORAGE_MODE = 'split'
+DECRYPT_WORKERS = os.cpu_count() or 1  # потоков для параллельной расшифровки (1 - без пула)
+DECRYPT_CHUNK_SIZE = 64  # строк в одной порции расшифровки
+RECORD_COMPRESS_THRESHOLD = 256  # поле записи от стольких байт сжимается zlib (если это выгодно)
+ROTATION_CHUNK_SIZE = 512  # строк в одной транзакции смены мастер-ключа (после каждой - контрольная точка)
+SEARCH_DELAY_MS = 150  # пауза ввода перед поиском, мс (запрос не выполняется на каждое нажатие)
+SEARCH_RANK_LIMIT = 1000  # найденных записей ранжируется не больше (при большем числе - без лучшего совпадения)
+EDIT_COMMIT_DELAY_MS = 500  # задержка перед записью правок из таблицы, мс (правки за это время - одна транзакция)
+
+# профиль PRAGMA, применяемый к каждому соединению с БД
+DATABASE_PRAGMAS = {
+    'journal_mode': 'WAL',  # читатели не блокируются писателем
+    'synchronous': 'NORMAL',  # в режиме WAL безопасно и без fsync на каждый commit
+    'cache_size': -16000,  # размер кэша страниц в КиБ (отрицательное значение)
+    'mmap_size': 64 * 1024 * 1024,  # отображение файла БД в память, байт
+    'busy_timeout': 5000,  # ожидание снятия блокировки, мс
+    'foreign_keys': 'ON',  # нужен для ON DELETE CASCADE
+}
+STATEMENT_CACHE_SIZE = 256  # размер кэша подготовленных SQL-запросов на соединение
+WRITER_BATCH_SIZE = 64  # максимум заданий фонового писателя в одной транзакции
+
+# набор шифрования новых данных: 'aes-gcm', 'chacha20-poly1305' или 'auto' (AES-GCM при аппаратном AES,
+# иначе ChaCha20-Poly1305). Старые записи AES-CBC читаются всегда и перешифровываются при следующей записи
+CIPHER_SUITE = 'auto'
+
+# функция выработки ключа из пароля/PIN для новых слотов ключа: 'pbkdf2' (PBKDF2-SHA256) или 'scrypt'.
+# Параметры подбираются при запуске под KDF_TARGET_MS (время разблокировки на этой машине) или задаются явно
+# в KDF_PARAMS ('pbkdf2:<итерации>' / 'scrypt:<log2 N>:<r>:<p>'). Слоты с другими параметрами
+# перешифровываются при следующем успешном входе
+KDF_ALGORITHM = 'pbkdf2'
+KDF_TARGET_MS = 250
+KDF_PARAMS = None
+
+# процессов шифрования, запускаемых при старте приложения (KDF и пакетная расшифровка вне процесса GUI);
+# 0 - все в процессе приложения. Тело пакета от CRYPTO_SHM_THRESHOLD байт передается через разделяемую память
+CRYPTO_WORKERS = 0
+CRYPTO_SHM_THRESHOLD = 256 * 1024
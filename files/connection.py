@@ -0,0 +1,121 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from config import DATABASE_PRAGMAS, STATEMENT_CACHE_SIZE
+
+
+class ConnectionManager:
+    """Класс менеджера соединений с БД
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Держит одно долгоживущее соединение на поток, применяет к нему профиль PRAGMA и кэш подготовленных запросов.
+    Все открытые соединения закрываются методом close() при завершении работы.
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Атрибуты:
+
+    db_path: str
+        Имя базы данных
+
+    pragmas: dict
+        Профиль PRAGMA {имя: значение}
+
+    cached_statements: int
+        Размер кэша подготовленных запросов
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Методы:
+
+    connect()
+        Возвращает соединение текущего потока (создает при первом обращении)
+
+    apply_pragmas(con)
+        Применяет профиль PRAGMA к соединению con
+
+    transaction()
+        Контекстный менеджер транзакции; вложенные вызовы становятся SAVEPOINT внутри внешней транзакции
+
+    release()
+        Закрывает соединение текущего потока
+
+    close()
+        Закрывает все соединения
+
+    """
+
+    def __init__(self, db_path, pragmas=None, cached_statements=STATEMENT_CACHE_SIZE):
+        self.db_path = db_path
+        self.pragmas = dict(DATABASE_PRAGMAS if pragmas is None else pragmas)
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._closed = False
+
+    def connect(self):  # соединение текущего потока
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            if self._closed:
+                raise sqlite3.ProgrammingError('Connection manager is closed')
+            # check_same_thread=False нужен только для close() из главного потока
+            con = sqlite3.connect(self.db_path, cached_statements=self.cached_statements, check_same_thread=False)
+            self.apply_pragmas(con)
+            with self._lock:
+                self._connections.append(con)
+            self._local.con = con
+        return con
+
+    def apply_pragmas(self, con):  # применить профиль PRAGMA
+        for name, value in self.pragmas.items():
+            con.execute(f'PRAGMA {name} = {value}').fetchall()
+
+    @contextmanager
+    def transaction(self):  # единица работы: один commit на внешний блок with
+        con = self.connect()
+        depth = getattr(self._local, 'depth', 0)
+        savepoint = f'sp{depth}'
+        if depth:
+            con.execute(f'SAVEPOINT {savepoint}')
+        else:
+            con.execute('BEGIN IMMEDIATE')  # блокировка записи берется сразу, без повторов на upgrade
+        self._local.depth = depth + 1
+        try:
+            yield con
+        except BaseException:
+            if not depth:
+                con.rollback()
+            elif con.in_transaction:
+                con.execute(f'ROLLBACK TO {savepoint}')
+                con.execute(f'RELEASE {savepoint}')
+            raise
+        else:
+            if depth:
+                con.execute(f'RELEASE {savepoint}')
+            else:
+                con.commit()
+        finally:
+            self._local.depth = depth
+
+    def release(self):  # закрыть соединение текущего потока (для рабочих потоков)
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            self._local.con = None
+            with self._lock:
+                if con in self._connections:
+                    self._connections.remove(con)
+            con.close()
+
+    def close(self):  # закрыть все соединения
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._closed = True
+        for con in connections:
+            try:
+                con.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
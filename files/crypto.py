@@ -1,13 +1,120 @@
 import json
 import os
+import platform
+import re
 import secrets
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, AESSIV, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+from config import CIPHER_SUITE, KDF_ALGORITHM, KDF_PARAMS, KDF_TARGET_MS
+from crypto_worker import CryptoWorkerError
+
+# Формат шифротекста: [байт набора][nonce 12 байт][шифротекст + тег 16 байт], байт набора - associated data.
+# Старые блоки AES-256-CBC не имеют заголовка: [IV 16 байт][шифротекст с PKCS7], длина кратна 16.
+SUITE_AES_GCM = 0x01
+SUITE_CHACHA20_POLY1305 = 0x02
+AEAD_SUITES = {
+    SUITE_AES_GCM: AESGCM,
+    SUITE_CHACHA20_POLY1305: ChaCha20Poly1305,
+}
+SUITE_NAMES = {
+    'aes-gcm': SUITE_AES_GCM,
+    'chacha20-poly1305': SUITE_CHACHA20_POLY1305,
+}
+NONCE_SIZE = 12
+TAG_SIZE = 16
+DATA_KEY_SIZE = 32  # ключ данных одной записи (конвертное шифрование)
+# Ключ данных шифруется AES-SIV (RFC 5297, детерминированная обертка ключей): [синтетический IV 16 байт][ключ];
+# ключ AES-SIV выводится из мастер-ключа через HKDF. Ключи прежнего формата - обычный блок AEAD (61 байт)
+WRAPPED_KEY_SIZE = 16 + DATA_KEY_SIZE
+KEY_WRAP_INFO = b'myKey data key wrap'
+MASTER_KEY_SIZE = 32
+
+# Параметры KDF слота ключа - строка 'pbkdf2:<итерации>' или 'scrypt:<log2 N>:<r>:<p>';
+# слоты без параметров (NULL в БД) созданы прежней версией с PBKDF2-SHA256 и 10 ** 5 итерациями
+LEGACY_KDF = 'pbkdf2:100000'
+PBKDF2_ITERATIONS_RANGE = (100000, 2000000)  # не ниже прежних слотов; сверху - разблокировка не дольше ~2 с
+KDF_PROBES = 3  # пробных выработок при калибровке (берется самая быстрая - меньше всего помех)
+SCRYPT_LOG2N_RANGE = (14, 17)  # N от 16384 (16 МиБ при r=8) до 131072 (128 МиБ)
+SCRYPT_R, SCRYPT_P = 8, 1
+
+
+def has_aes_acceleration():  # есть ли аппаратное ускорение AES (AES-NI / ARMv8 Crypto)
+    try:
+        with open('/proc/cpuinfo') as file:
+            cpuinfo = file.read()
+    except OSError:  # Windows/macOS: все актуальные x86-64 и Apple Silicon умеют AES аппаратно
+        return platform.machine().lower() in ('amd64', 'x86_64', 'arm64', 'aarch64')
+    return re.search(r'^(flags|features)\s*:.*\baes\b', cpuinfo, re.MULTILINE | re.IGNORECASE) is not None
+
+
+def _reserve(buf, size):  # bytearray не меньше size байт: buf или новый, если buf не расширить
+    if len(buf) < size:
+        try:
+            buf.extend(bytes(size - len(buf)))
+        except BufferError:  # вызывающий сохранил представление buf - буфер занят, берется новый
+            return bytearray(size)
+    return buf
+
+
+def parse_kdf(kdf):  # 'pbkdf2:100000' -> ('pbkdf2', (100000,)); None - прежние параметры
+    name, *params = (kdf or LEGACY_KDF).split(':')
+    params = tuple(int(param) for param in params)
+    if (name, len(params)) not in (('pbkdf2', 1), ('scrypt', 3)):
+        raise ValueError(f'Unknown KDF parameters {kdf!r}')
+    return name, params
+
+
+def kdf_cost(kdf):  # относительная стоимость выработки ключа (для сравнения параметров одного алгоритма)
+    name, params = parse_kdf(kdf)
+    if name == 'pbkdf2':
+        return params[0]
+    log2n, r, p = params
+    return (1 << log2n) * r * p
+
+
+def calibrate_kdf(algorithm=KDF_ALGORITHM, target_ms=KDF_TARGET_MS):  # параметры KDF под время разблокировки
+    # несколько пробных выработок, стоимость масштабируется линейно до target_ms и ограничивается диапазоном
+    crypto = CryptographySystem(kdf=LEGACY_KDF)
+    if algorithm == 'pbkdf2':
+        probe = 10000
+        elapsed = _time_kdf(crypto, f'pbkdf2:{probe}')
+        iterations = int(probe * target_ms / 1000 / elapsed) // 1000 * 1000
+        return f'pbkdf2:{min(max(iterations, PBKDF2_ITERATIONS_RANGE[0]), PBKDF2_ITERATIONS_RANGE[1])}'
+    if algorithm == 'scrypt':
+        probe = 12
+        elapsed = _time_kdf(crypto, f'scrypt:{probe}:{SCRYPT_R}:{SCRYPT_P}')
+        log2n = probe + max(int(target_ms / 1000 / elapsed).bit_length() - 1, 0)  # степень двойки не выше цели
+        log2n = min(max(log2n, SCRYPT_LOG2N_RANGE[0]), SCRYPT_LOG2N_RANGE[1])
+        return f'scrypt:{log2n}:{SCRYPT_R}:{SCRYPT_P}'
+    raise ValueError(f'Unknown KDF algorithm {algorithm!r}')
+
+
+def _time_kdf(crypto, kdf, probes=KDF_PROBES):  # время выработки ключа с параметрами kdf (лучшее из probes), с
+    best = None
+    for _ in range(probes):
+        start = time.perf_counter()
+        crypto.derive_key('calibration', bytes(16), kdf)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return max(best, 1e-6)
+
+
+def select_cipher_suite(name=CIPHER_SUITE):  # байт набора по имени из config ('auto' - по процессору)
+    if name == 'auto':
+        return SUITE_AES_GCM if has_aes_acceleration() else SUITE_CHACHA20_POLY1305
+    return SUITE_NAMES[name]
 
 
 class CryptographySystem:
@@ -31,62 +138,369 @@ class CryptographySystem:
     get_master_key()
         Возвращает рандомные 32 бита данных (ИСПРАВЛЕНО В СООТВЕТСТВИИ С СТАНДАРТАМИ КРИПТОГРАФИИ)
 
-    derive_key(passw, salt):
-        Возвращает ключ шифрования(HASH-значение пароля password с солью salt)
+    derive_key(passw, salt, kdf):
+        Возвращает ключ шифрования(HASH-значение пароля password с солью salt) с параметрами kdf слота
+        (None - прежние PBKDF2-SHA256, 10 ** 5 итераций)
+
+    kdf_needs_upgrade(kdf):
+        Проверяет, отличаются ли параметры слота от текущих (другой алгоритм или стоимость вне 0.5x-2x)
 
     encrypt_data(data, key):
-        Шифрует введенные данные data с помощью ключа key
+        Шифрует введенные данные data с помощью ключа key (AEAD-набор suite, заголовок из одного байта)
+
+    decrypt_data(encr_data, key):
+         Дешифрует введенные данные encr_data с помощью ключа key (AEAD по заголовку или старый AES-CBC).
+         Неверный ключ или поврежденные данные - ValueError
+
+    decrypt_master_key(encr_key, key):
+         Дешифрует мастер-ключ из слота ключа. Ключ другой длины - ValueError, как и неверный ключ: старый
+         блок CBC под чужим ключом изредка проходит проверку дополнения и дает мусор
+
+    encrypt_many(items, key):
+        Шифрует набор данных одним ключом (ключ и AEAD-объект создаются один раз), порядок сохраняется
+
+    decrypt_many(items, key, return_exceptions):
+        Дешифрует набор блоков одним ключом; при return_exceptions=True ошибка блока возвращается на его месте
+
+    decrypt_into(encr_data, key, buf, ciphers):
+        Дешифрует блок (bytes, memoryview - например, BLOB из SQLite) в переиспользуемый bytearray buf без
+        промежуточных копий, возвращает (буфер, длина данных): если buf не расширить (на него есть живое
+        представление), данные пишутся в новый bytearray
+
+    iter_decrypt_into(items, key, buf, return_exceptions):
+        Дешифрует набор блоков в один буфер, выдает memoryview данных. Представление действительно только до
+        следующего шага: его и срезы из него нельзя сохранять (нужна копия - bytes(view) или str(view, 'utf8')).
+        Сохраненное представление не ломает чтение, но следующий блок большего размера уйдет в новый буфер
+
+    seal_many(groups, master_key):
+        Конвертное шифрование: для каждой группы данных - случайный ключ данных, группа шифруется им,
+        ключ данных - мастер-ключом. Возвращает [(зашифрованный ключ данных, [шифротексты группы]), ...]
+
+    wrap_keys(keys, master_key):
+        Шифрует ключи данных мастер-ключом (AES-SIV, 48 байт на ключ)
+
+    unwrap_keys(wrapped_keys, master_key, return_exceptions):
+        Расшифровывает ключи данных (AES-SIV или прежний формат); None - данные зашифрованы прямо мастер-ключом
 
-    encrypt_data(encr_data, key):
-         Дешифрует введенные данные encr_data с помощью ключа key
+    rewrap_keys(wrapped_keys, old_master_key, new_master_key, return_exceptions):
+        Перешифровывает ключи данных новым мастер-ключом, сами данные не трогаются (смена мастер-ключа)
 
-    derive_userdata(password, pin):
-        Выпускает готовые к записи в БД зашифрованные данные
+    open_many(items, master_key, return_exceptions):
+        Расшифровывает [(зашифрованный ключ данных или None, шифротекст), ...] одним набором (в пуле процессов,
+        если он есть): ключ данных и шифротекст записи обрабатываются одним шагом
+
+    iter_open_into(items, master_key, buf, return_exceptions):
+        Как iter_decrypt_into для [(зашифрованный ключ данных или None, шифротекст), ...]
+
+    needs_upgrade(encr_data):
+        Проверяет, зашифрован ли блок не текущим набором (старые блоки перешифровываются при записи)
+
+    derive_userdata(password, pin, master_key):
+        Выпускает готовые к записи в БД зашифрованные данные (ключи пароля и PIN вырабатываются параллельно);
+        master_key - зашифровать заданный мастер-ключ (смена мастер-ключа), по умолчанию новый
+
+    close():
+        Останавливает поток выработки ключей и пул процессов шифрования
+
+    С пулом процессов worker (CryptoWorkerPool) выработка ключей и пакетные операции выполняются в нем, при
+    остановке пула - снова в этом процессе
 
     """
 
-    def __init__(self):
+    def __init__(self, suite=None, kdf=None, worker=None):
         self.backend = default_backend()
+        self.suite = suite if suite is not None else select_cipher_suite()  # набор для новых шифротекстов
+        self._kdf = kdf or KDF_PARAMS  # параметры KDF новых слотов ключа (None - калибровка при первом обращении)
+        self._executor = None  # поток для параллельной выработки ключей, создается при первой регистрации
+        self.worker = worker  # пул процессов шифрования (CryptoWorkerPool) или None - все в этом процессе
+
+    def _proxy(self, method, *args):  # выполнить в пуле процессов; None - пула нет, выполнить здесь
+        worker = self.worker
+        if worker is None:
+            return None
+        try:
+            return getattr(worker, method)(*args)
+        except CryptoWorkerError:  # пул остановился - дальше все в этом процессе
+            self.worker = None
+            return None
+
+    def close(self):  # остановить поток выработки ключей и пул процессов
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self.worker is not None:
+            self.worker.close()
+            self.worker = None
+
+    @property
+    def kdf(self):  # параметры KDF для новых слотов ключа
+        if self._kdf is None:
+            self._kdf = calibrate_kdf()
+        return self._kdf
+
+    def _get_executor(self):  # пул выработки ключей
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kdf')
+        return self._executor
 
     def get_master_key(self):  # мастер-ключ
-        return secrets.token_bytes(32)
+        return secrets.token_bytes(MASTER_KEY_SIZE)
         # return os.urandom(32)
 
-    def derive_key(self, passw: str, salt: bytes):  # выпустить ключ шифрования из пароля/PIN и cоли
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=10 ** 5,
-            backend=self.backend
-        )
+    def derive_key(self, passw: str, salt: bytes, kdf=None):  # выпустить ключ шифрования из пароля/PIN и cоли
+        name, params = parse_kdf(kdf)
+        keys = self._proxy('derive_keys', kdf, [(passw, salt)])
+        if keys is not None:
+            return keys[0]
+        if name == 'scrypt':
+            log2n, r, p = params
+            kdf = Scrypt(salt=salt, length=32, n=1 << log2n, r=r, p=p, backend=self.backend)
+        else:
+            kdf = PBKDF2HMAC(
+                algorithm=hashes.SHA256(),
+                length=32,
+                salt=salt,
+                iterations=params[0],
+                backend=self.backend
+            )
         return kdf.derive(passw.encode())  # вернуть ключ шифрования
 
+    def kdf_needs_upgrade(self, kdf):  # параметры слота заметно отличаются от текущих
+        # разброс калибровки между запусками не должен перешифровывать слот при каждом входе
+        if parse_kdf(kdf)[0] != parse_kdf(self.kdf)[0]:
+            return True
+        return not 0.5 <= kdf_cost(kdf) / kdf_cost(self.kdf) <= 2
+
     def encrypt_data(self, data, key):  # зашифровать данные (и мастер ключ и сами данные)
-        iv = secrets.token_bytes(16)
-        cipher = Cipher(algorithm=algorithms.AES256(key), backend=self.backend, mode=modes.CBC(iv))
-        encryptor = cipher.encryptor()
-        pad = padding.PKCS7(128).padder()
-        padded_data = pad.update(data) + pad.finalize()
-        encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
-        return iv + encrypted_data  # вернуть зашифрованные данные
+        header = bytes((self.suite,))
+        nonce = secrets.token_bytes(NONCE_SIZE)
+        return header + nonce + AEAD_SUITES[self.suite](key).encrypt(nonce, data, header)  # вернуть зашифрованные данные
 
     def decrypt_data(self, encr_data, key):  # расшифровать данные (и мастер ключ и сами данные)
-        iv = encr_data[:16]
-        data = encr_data[16:]
-        cipher = Cipher(algorithm=algorithms.AES256(key), backend=self.backend, mode=modes.CBC(iv))
+        return self.decrypt_many((encr_data,), key)[0]  # вернуть данные
+
+    def decrypt_master_key(self, encr_key, key):  # расшифровать мастер-ключ из слота с проверкой длины
+        master_key = self.decrypt_data(encr_key, key)
+        if len(master_key) != MASTER_KEY_SIZE:  # у CBC нет аутентификации - неверный ключ дает мусор
+            raise ValueError('Invalid key or corrupted data')
+        return master_key
+
+    def decrypt_data_cbc(self, encr_data, key, aes=None):  # расшифровать старый блок AES-256-CBC
+        view = memoryview(encr_data)  # срезы без копирования
+        cipher = Cipher(algorithm=aes or algorithms.AES256(key), backend=self.backend, mode=modes.CBC(view[:16]))
         decryptor = cipher.decryptor()
-        encrypted_data = decryptor.update(data) + decryptor.finalize()
+        decrypted_data = decryptor.update(view[16:])
+        decryptor.finalize()  # CBC без дополнения ничего не возвращает
         unpad = padding.PKCS7(128).unpadder()
-        final_data = unpad.update(encrypted_data) + unpad.finalize()
-        return final_data  # вернуть данные
+        return unpad.update(decrypted_data) + unpad.finalize()  # вернуть данные
+
+    def decrypt_into(self, encr_data, key, buf, ciphers=None):  # расшифровать блок в буфер, вернуть (буфер, длина)
+        # encr_data - любой объект с буферным протоколом (bytes из BLOB SQLite, memoryview), buf - bytearray,
+        # при нехватке места он расширяется; ciphers - кэш объектов шифра для этого ключа между вызовами
+        ciphers = dict() if ciphers is None else ciphers
+        view = memoryview(encr_data)
+        suite = view[0] if len(view) else None
+        if suite in AEAD_SUITES and len(view) >= 1 + NONCE_SIZE + TAG_SIZE:
+            size = len(view) - 1 - NONCE_SIZE - TAG_SIZE
+            buf = _reserve(buf, size)
+            try:
+                aead = self._cipher(ciphers, suite, key)
+                with memoryview(buf) as out:
+                    if hasattr(aead, 'decrypt_into'):
+                        aead.decrypt_into(view[1:1 + NONCE_SIZE], view[1 + NONCE_SIZE:], view[:1], out[:size])
+                    else:  # cryptography без *_into - одна копия результата
+                        out[:size] = aead.decrypt(view[1:1 + NONCE_SIZE], view[1 + NONCE_SIZE:], view[:1])
+                return buf, size
+            except InvalidTag:
+                if len(view) % 16:  # не может быть старым блоком CBC - неверный ключ или данные повреждены
+                    raise ValueError('Invalid key or corrupted data')
+                # старый блок CBC, IV которого случайно начинается с байта набора
+        if len(view) < 32 or len(view) % 16:
+            raise ValueError('Invalid key or corrupted data')
+        buf = _reserve(buf, len(view) - 16 + 15)  # update_into требует запас в один блок
+        decryptor = Cipher(self._cipher(ciphers, None, key), modes.CBC(view[:16]), backend=self.backend).decryptor()
+        with memoryview(buf) as out:
+            size = decryptor.update_into(view[16:], out)
+            decryptor.finalize()
+            unpad = padding.PKCS7(128).unpadder()  # проверяется только последний блок
+            tail = unpad.update(out[size - 16:size]) + unpad.finalize()
+        return buf, size - 16 + len(tail)
+
+    def iter_decrypt_into(self, items, key, buf=None, return_exceptions=False):  # расшифровка набора в один буфер
+        # выдает memoryview расшифрованного блока внутри buf; представление освобождается на следующем шаге,
+        # данные нужно разобрать сразу (например, str(view, 'utf8'))
+        if self.worker is not None:  # пул возвращает готовые данные, буфер не нужен
+            for data in self.decrypt_many(items, key, return_exceptions):
+                yield data if isinstance(data, Exception) else memoryview(data)
+            return
+        ciphers = dict()
+        yield from self._iter_views(((encr_data, key, ciphers) for encr_data in items), buf, return_exceptions)
+
+    def _iter_views(self, items, buf, return_exceptions):  # [(шифротекст, ключ, кэш шифров) или ошибка] -> данные
+        buf = bytearray() if buf is None else buf
+        for item in items:
+            if isinstance(item, Exception):
+                yield item
+                continue
+            encr_data, key, ciphers = item
+            try:
+                buf, size = self.decrypt_into(encr_data, key, buf, ciphers)  # буфер мог смениться - дальше новый
+            except ValueError as e:
+                if not return_exceptions:
+                    raise
+                yield e
+            else:
+                view = memoryview(buf)[:size]
+                yield view
+                view.release()  # буфер можно расширять на следующем шаге
+
+    def _cipher(self, ciphers, suite, key):  # объект шифра набора suite (None - AES для CBC) из кэша ciphers
+        cipher = ciphers.get(suite)
+        if cipher is None:
+            cipher = ciphers[suite] = AEAD_SUITES[suite](key) if suite is not None else algorithms.AES256(key)
+        return cipher
+
+    def encrypt_many(self, items, key):  # зашифровать набор данных одним ключом
+        items = list(items)
+        if len(items) > 1:  # одиночный блок быстрее зашифровать здесь, чем передать в пул
+            result = self._proxy('encrypt_many', self.suite, key, items)
+            if result is not None:
+                return result
+        header = bytes((self.suite,))
+        encrypt = AEAD_SUITES[self.suite](key).encrypt
+        nonces = secrets.token_bytes(NONCE_SIZE * len(items))  # один вызов ГСЧ на весь набор
+        result = []
+        for i, data in enumerate(items):
+            nonce = nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE]
+            result.append(header + nonce + encrypt(nonce, data, header))
+        return result
+
+    def decrypt_many(self, items, key, return_exceptions=False):  # расшифровать набор блоков одним ключом
+        items = list(items)
+        result = self._proxy('decrypt_many', key, items) if len(items) > 1 else None
+        if result is not None:
+            errors = [data for data in result if isinstance(data, Exception)]
+            if errors and not return_exceptions:
+                raise errors[0]
+            return result
+        ciphers = dict()  # набор -> объект шифра с этим ключом (создается при первом блоке набора)
+        result = []
+        for encr_data in items:
+            try:
+                view = memoryview(encr_data)  # срезы без копирования
+                suite = view[0] if len(view) else None
+                if suite in AEAD_SUITES and len(view) >= 1 + NONCE_SIZE + TAG_SIZE:
+                    try:
+                        result.append(self._cipher(ciphers, suite, key).decrypt(
+                            view[1:1 + NONCE_SIZE], view[1 + NONCE_SIZE:], view[:1]))
+                        continue
+                    except InvalidTag:
+                        if len(view) % 16:  # не может быть старым блоком CBC
+                            raise ValueError('Invalid key or corrupted data')
+                result.append(self.decrypt_data_cbc(view, key, self._cipher(ciphers, None, key)))
+            except ValueError as e:
+                if not return_exceptions:
+                    raise
+                result.append(e)
+        return result
+
+    def seal_many(self, groups, master_key):  # конвертное шифрование групп данных
+        groups = [list(group) for group in groups]
+        keys = secrets.token_bytes(DATA_KEY_SIZE * len(groups))
+        keys = [keys[i * DATA_KEY_SIZE:(i + 1) * DATA_KEY_SIZE] for i in range(len(groups))]
+        wrapped_keys = self.wrap_keys(keys, master_key)
+        header = bytes((self.suite,))
+        nonces = secrets.token_bytes(NONCE_SIZE * sum(len(group) for group in groups))
+        offset = 0
+        result = []
+        for key, wrapped_key, group in zip(keys, wrapped_keys, groups):
+            encrypt = AEAD_SUITES[self.suite](key).encrypt  # свой ключ у каждой группы
+            encrypted = []
+            for data in group:
+                nonce = nonces[offset:offset + NONCE_SIZE]
+                offset += NONCE_SIZE
+                encrypted.append(header + nonce + encrypt(nonce, data, header))
+            result.append((wrapped_key, encrypted))
+        return result
+
+    def _key_wrapper(self, master_key):  # AES-SIV с ключом, выведенным из мастер-ключа
+        return AESSIV(HKDF(algorithm=hashes.SHA256(), length=64, salt=None, info=KEY_WRAP_INFO,
+                           backend=self.backend).derive(master_key))
+
+    def wrap_keys(self, keys, master_key):  # зашифровать ключи данных мастер-ключом
+        # ключи случайны и не повторяются, поэтому детерминированная обертка без nonce безопасна
+        wrapper = self._key_wrapper(master_key)
+        return [wrapper.encrypt(key, None) for key in keys]
+
+    def unwrap_keys(self, wrapped_keys, master_key, return_exceptions=False):  # расшифровать ключи данных
+        wrapped_keys = list(wrapped_keys)
+        legacy = iter(self.decrypt_many([wrapped_key for wrapped_key in wrapped_keys
+                                         if wrapped_key is not None and len(wrapped_key) != WRAPPED_KEY_SIZE],
+                                        master_key, return_exceptions))  # прежний формат - одним набором
+        wrapper = None
+        result = []
+        for wrapped_key in wrapped_keys:
+            if wrapped_key is None:
+                result.append(master_key)
+            elif len(wrapped_key) != WRAPPED_KEY_SIZE:
+                result.append(next(legacy))
+            else:
+                wrapper = wrapper or self._key_wrapper(master_key)
+                try:
+                    result.append(wrapper.decrypt(wrapped_key, None))
+                except InvalidTag:
+                    if not return_exceptions:
+                        raise ValueError('Invalid key or corrupted data')
+                    result.append(ValueError('Invalid key or corrupted data'))
+        return result
+
+    def rewrap_keys(self, wrapped_keys, old_master_key, new_master_key, return_exceptions=False):
+        # ключ, который не открывается старым мастер-ключом, при return_exceptions=True - ValueError на его месте
+        keys = self.unwrap_keys(wrapped_keys, old_master_key, return_exceptions)
+        wrapped = iter(self.wrap_keys([key for key in keys if not isinstance(key, Exception)], new_master_key))
+        return [key if isinstance(key, Exception) else next(wrapped) for key in keys]
+
+    def open_many(self, items, master_key, return_exceptions=False):  # расшифровать набор конвертов
+        items = list(items)
+        result = self._proxy('open_many', master_key, items) if len(items) > 1 else None
+        if result is not None:
+            errors = [data for data in result if isinstance(data, Exception)]
+            if errors and not return_exceptions:
+                raise errors[0]
+            return result
+        keys = self.unwrap_keys((wrapped_key for wrapped_key, _ in items), master_key, return_exceptions)
+        result = []
+        for (wrapped_key, encr_data), key in zip(items, keys):
+            # ключ данных у каждой записи свой - набор из одного блока расшифровывается здесь, без пула
+            result.append(key if isinstance(key, Exception) else self.decrypt_many((encr_data,), key,
+                                                                                   return_exceptions)[0])
+        return result
+
+    def iter_open_into(self, items, master_key, buf=None, return_exceptions=False):  # расшифровка конвертов
+        items = list(items)
+        if self.worker is not None:  # ключи данных и записи - одним набором в пуле, буфер не нужен
+            for data in self.open_many(items, master_key, return_exceptions):
+                yield data if isinstance(data, Exception) else memoryview(data)
+            return
+        keys = self.unwrap_keys((wrapped_key for wrapped_key, _ in items), master_key, return_exceptions)
+        # ключ данных у каждой записи свой - буфер общий, представление действует до следующего шага
+        yield from self._iter_views((key if isinstance(key, Exception) else (encr_data, key, dict())
+                                     for (wrapped_key, encr_data), key in zip(items, keys)), buf, return_exceptions)
+
+    def needs_upgrade(self, encr_data):  # блок зашифрован не текущим набором
+        # старый блок CBC, случайно начинающийся с текущего байта набора, не распознается - он просто
+        # останется в старом формате до следующей перезаписи
+        return not encr_data or encr_data[0] != self.suite
 
-    def derive_userdata(self, password, pin):  # выпустить пользовательские данные из пароля и PIN
-        master_key = self.get_master_key()  # мастер-ключ
+    def derive_userdata(self, password, pin, master_key=None):  # выпустить данные слотов ключа из пароля и PIN
+        master_key = master_key or self.get_master_key()  # мастер-ключ (новый, если не задан)
         passw_salt = secrets.token_bytes(16)  # соль пароля
         pin_salt = secrets.token_bytes(16)  # соль PIN-кода
-        password_key = self.derive_key(passw=password, salt=passw_salt)  # ключ из пароля и его соли
-        pin_key = self.derive_key(passw=pin, salt=pin_salt)  # ключ из PIN-кода и его соли
+        kdf = self.kdf
+        # ключи независимы: ключ пароля вырабатывается в пуле одновременно с ключом PIN-кода в этом потоке
+        password_key = self._get_executor().submit(self.derive_key, password, passw_salt, kdf)
+        pin_key = self.derive_key(passw=pin, salt=pin_salt, kdf=kdf)  # ключ из PIN-кода и его соли
+        password_key = password_key.result()  # ключ из пароля и его соли
         master_key_password = self.encrypt_data(master_key, password_key)  # зашифрованный ключом мастер-ключ
         master_key_pin = self.encrypt_data(master_key, pin_key)  # зашифрованный ключом мастер-ключ
         return master_key_password, passw_salt, master_key_pin, pin_salt  # возвращает готовые к записи в бд данные
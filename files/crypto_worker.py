@@ -0,0 +1,237 @@
+"""Внепроцессный движок шифрования: пул процессов-обработчиков для KDF и пакетного шифрования/расшифровки.
+
+Процессы запускаются один раз (spawn) и получают пакеты запросов по каналу Pipe в компактном двоичном формате:
+
+    кадр  = [код 1 байт][флаги 1 байт][число полей 4 байта] + тело
+    тело  = ([длина поля 4 байта][поле]) * число полей
+    FLAG_SHM: вместо тела - [размер тела 8 байт][имя сегмента SharedMemory], тело лежит в разделяемой памяти
+
+Код кадра запроса - операция (OP_*), ответа - статус (STATUS_*). Каждое поле ответа начинается с байта
+статуса элемента, за ним результат или текст ошибки. Сегмент разделяемой памяти удаляет принимающая сторона
+ответа (для запроса - отправитель после получения ответа).
+"""
+import multiprocessing
+import queue
+import struct
+from multiprocessing import shared_memory
+
+from config import CRYPTO_SHM_THRESHOLD, CRYPTO_WORKERS
+
+OP_DERIVE_KEYS = 1  # поля: kdf, (пароль, соль) * n -> ключи
+OP_ENCRYPT = 2  # поля: набор (1 байт), ключ, данные * n -> шифротексты
+OP_DECRYPT = 3  # поля: ключ, шифротексты * n -> данные или ошибки
+OP_OPEN = 4  # поля: мастер-ключ, (ключ данных или пусто, шифротекст) * n -> данные или ошибки
+STATUS_OK = 0
+STATUS_ERROR = 1
+FLAG_SHM = 0x01
+
+_HEADER = struct.Struct('<BBI')
+_LENGTH = struct.Struct('<I')
+_SHM_SIZE = struct.Struct('<Q')
+
+
+class CryptoWorkerError(RuntimeError):
+    """Процесс-обработчик недоступен (остановлен или канал разорван)"""
+
+
+def encode_frame(code, fields, shm_threshold=CRYPTO_SHM_THRESHOLD):  # -> (кадр, SharedMemory или None)
+    size = sum(_LENGTH.size + len(field) for field in fields)
+    if size < shm_threshold:
+        parts = [_HEADER.pack(code, 0, len(fields))]
+        for field in fields:
+            parts.append(_LENGTH.pack(len(field)))
+            parts.append(field)
+        return b''.join(parts), None
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    offset = 0
+    for field in fields:
+        _LENGTH.pack_into(shm.buf, offset, len(field))
+        offset += _LENGTH.size
+        shm.buf[offset:offset + len(field)] = field
+        offset += len(field)
+    return _HEADER.pack(code, FLAG_SHM, len(fields)) + _SHM_SIZE.pack(size) + shm.name.encode(), shm
+
+
+def decode_frame(frame, unlink=False):  # -> (код, [memoryview поля]); unlink - удалить сегмент после чтения
+    code, flags, count = _HEADER.unpack_from(frame)
+    if flags & FLAG_SHM:
+        size, = _SHM_SIZE.unpack_from(frame, _HEADER.size)
+        shm = shared_memory.SharedMemory(name=bytes(frame[_HEADER.size + _SHM_SIZE.size:]).decode())
+        try:
+            body = memoryview(bytes(shm.buf[:size]))  # одна копия из сегмента, поля - срезы без копирования
+        finally:
+            shm.close()
+            if unlink:
+                shm.unlink()
+    else:
+        body = memoryview(frame)[_HEADER.size:]
+    fields = []
+    offset = 0
+    for _ in range(count):
+        length, = _LENGTH.unpack_from(body, offset)
+        offset += _LENGTH.size
+        fields.append(body[offset:offset + length])
+        offset += length
+    return code, fields
+
+
+def _release(shm):  # закрыть и удалить сегмент запроса
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+def _handle(crypto, op, fields):  # выполнить запрос в процессе-обработчике, вернуть [(статус, результат)]
+    if op == OP_DERIVE_KEYS:
+        kdf = str(fields[0], 'utf8') or None
+        return [(STATUS_OK, crypto.derive_key(str(fields[i], 'utf8'), bytes(fields[i + 1]), kdf))
+                for i in range(1, len(fields), 2)]
+    if op == OP_ENCRYPT:
+        crypto.suite = fields[0][0]
+        return [(STATUS_OK, data) for data in crypto.encrypt_many(fields[2:], bytes(fields[1]))]
+    if op == OP_DECRYPT:
+        return [(STATUS_ERROR, str(data).encode()) if isinstance(data, Exception) else (STATUS_OK, data)
+                for data in crypto.decrypt_many(fields[1:], bytes(fields[0]), return_exceptions=True)]
+    if op == OP_OPEN:
+        items = [(bytes(fields[i]) or None, fields[i + 1]) for i in range(1, len(fields), 2)]
+        return [(STATUS_ERROR, str(data).encode()) if isinstance(data, Exception) else (STATUS_OK, data)
+                for data in crypto.open_many(items, bytes(fields[0]), return_exceptions=True)]
+    raise ValueError(f'Unknown operation {op}')
+
+
+def _worker_main(conn, shm_threshold):  # цикл процесса-обработчика
+    from crypto import CryptographySystem  # в дочернем процессе, без цикла импорта с crypto
+    crypto = CryptographySystem()  # без обработчика - выполняет все сам
+    while True:
+        try:
+            frame = conn.recv_bytes()
+        except (EOFError, OSError):  # пул закрыл канал
+            break
+        try:
+            op, fields = decode_frame(frame)
+            code, results = STATUS_OK, [bytes((status,)) + result for status, result in _handle(crypto, op, fields)]
+        except Exception as e:  # ошибка всего запроса
+            code, results = STATUS_ERROR, [(str(e) or type(e).__name__).encode()]
+        reply, shm = encode_frame(code, results, shm_threshold)
+        conn.send_bytes(reply)
+        if shm is not None:
+            shm.close()  # сегмент удалит пул после чтения
+
+
+class CryptoWorkerPool:
+    """Класс пула процессов шифрования
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Атрибуты:
+
+    processes: int
+        Число процессов-обработчиков
+
+    shm_threshold: int
+        Размер тела кадра, начиная с которого оно передается через разделяемую память, байт
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Методы:
+
+    derive_keys(kdf, items)
+        Вырабатывает ключи для [(пароль, соль), ...] с параметрами kdf
+
+    encrypt_many(suite, key, items)
+        Шифрует набор данных набором suite, порядок сохраняется
+
+    decrypt_many(key, items)
+        Дешифрует набор блоков; на месте битого блока - ValueError
+
+    open_many(master_key, items)
+        Расшифровывает конверты [(зашифрованный ключ данных или None, шифротекст), ...]; на месте битого - ValueError
+
+    close()
+        Останавливает процессы
+
+    Большие наборы делятся между свободными процессами. Недоступный процесс - CryptoWorkerError,
+    ошибка запроса - ValueError
+
+    """
+
+    def __init__(self, processes=CRYPTO_WORKERS, shm_threshold=CRYPTO_SHM_THRESHOLD):
+        context = multiprocessing.get_context('spawn')  # fork небезопасен в процессе с потоками Qt
+        self.processes = processes
+        self.shm_threshold = shm_threshold
+        self._workers = []
+        self._idle = queue.Queue()  # свободные каналы
+        self._closed = False
+        for i in range(processes):
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker_main, args=(child_conn, shm_threshold),
+                                      name=f'crypto-{i}', daemon=True)
+            process.start()
+            child_conn.close()
+            self._workers.append((process, conn))
+            self._idle.put(conn)
+
+    def derive_keys(self, kdf, items):  # [(пароль, соль), ...] -> ключи
+        head = [(kdf or '').encode()]
+        return self._batch(OP_DERIVE_KEYS, head, [field for passw, salt in items for field in (passw.encode(), salt)],
+                           step=2)
+
+    def encrypt_many(self, suite, key, items):
+        return self._batch(OP_ENCRYPT, [bytes((suite,)), key], list(items))
+
+    def decrypt_many(self, key, items):
+        return self._batch(OP_DECRYPT, [key], list(items), errors=True)
+
+    def open_many(self, master_key, items):  # [(ключ данных или None, шифротекст), ...] -> данные
+        return self._batch(OP_OPEN, [master_key], [field for wrapped_key, encr_data in items
+                                                    for field in (wrapped_key or b'', encr_data)], step=2, errors=True)
+
+    def _batch(self, op, head, items, step=1, errors=False):  # разделить items между свободными процессами
+        if self._closed:
+            raise CryptoWorkerError('Crypto worker pool is closed')
+        conns = [self._idle.get()]  # хотя бы один процесс, остальные - если свободны
+        while len(conns) * step < len(items) and len(conns) < len(self._workers):
+            try:
+                conns.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        size = max(-(-len(items) // step // len(conns)), 1) * step
+        chunks = [items[i:i + size] for i in range(0, len(items), size)] or [[]]
+        segments = []
+        try:
+            for conn, chunk in zip(conns, chunks):
+                frame, shm = encode_frame(op, head + chunk, self.shm_threshold)
+                segments.append(shm)
+                conn.send_bytes(frame)
+            replies = [decode_frame(conn.recv_bytes(), unlink=True) for conn, _ in zip(conns, chunks)]
+            results = []
+            for code, fields in replies:  # ответы прочитаны все - каналы снова готовы к запросам
+                if code != STATUS_OK:
+                    raise ValueError(str(fields[0], 'utf8'))
+                for field in fields:
+                    if field[0] == STATUS_OK:
+                        results.append(bytes(field[1:]))
+                    elif errors:
+                        results.append(ValueError(str(field[1:], 'utf8')))
+                    else:
+                        raise ValueError(str(field[1:], 'utf8'))
+            return results
+        except (EOFError, OSError) as e:  # процесс завершился - каналы в неизвестном состоянии
+            self.close()
+            raise CryptoWorkerError(str(e) or type(e).__name__) from e
+        finally:
+            for shm in segments:
+                _release(shm)
+            for conn in conns:
+                self._idle.put(conn)
+
+    def close(self):  # закрыть каналы и дождаться процессов
+        if self._closed:
+            return
+        self._closed = True
+        for process, conn in self._workers:
+            conn.close()  # обработчик получает EOFError и выходит
+        for process, conn in self._workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
@@ -240,8 +240,31 @@ class Ui_Form(object):
         self.split_line3.setFrameShape(QtWidgets.QFrame.Shape.VLine)
         self.split_line3.setFrameShadow(QtWidgets.QFrame.Shadow.Sunken)
         self.split_line3.setObjectName("split_line3")
+        self.key_button = QtWidgets.QPushButton(parent=self.main_frame)
+        self.key_button.setGeometry(QtCore.QRect(103, 74, 25, 25))
+        font = QtGui.QFont()
+        font.setFamily("Bahnschrift Light")
+        font.setPointSize(12)
+        self.key_button.setFont(font)
+        self.key_button.setStyleSheet("  QPushButton {\n"
+"  background-color:  rgb(255, 255, 255);\n"
+"\n"
+"}\n"
+"QPushButton:hover {\n"
+"background-color: rgb(238, 238, 238);\n"
+"}\n"
+"QPushButton::menu-indicator {\n"
+"image: none;\n"
+"}")
+        self.key_button.setObjectName("key_button")
+        self.split_line5 = QtWidgets.QFrame(parent=self.main_frame)
+        self.split_line5.setGeometry(QtCore.QRect(128, 74, 1, 25))
+        self.split_line5.setStyleSheet("background-color: rgb(0, 0, 0);")
+        self.split_line5.setFrameShape(QtWidgets.QFrame.Shape.VLine)
+        self.split_line5.setFrameShadow(QtWidgets.QFrame.Shadow.Sunken)
+        self.split_line5.setObjectName("split_line5")
         self.spacer1 = QtWidgets.QFrame(parent=self.main_frame)
-        self.spacer1.setGeometry(QtCore.QRect(103, 74, 180, 25))
+        self.spacer1.setGeometry(QtCore.QRect(129, 74, 154, 25))
         self.spacer1.setStyleSheet("background-color: rgb(255, 255, 255);")
         self.spacer1.setFrameShape(QtWidgets.QFrame.Shape.HLine)
         self.spacer1.setFrameShadow(QtWidgets.QFrame.Shadow.Sunken)
@@ -263,7 +286,7 @@ class Ui_Form(object):
 "border-top-right-radius:15;")
         self.search_edit.setObjectName("search_edit")
         self.info_label = QtWidgets.QLabel(parent=self.main_frame)
-        self.info_label.setGeometry(QtCore.QRect(102, 70, 181, 31))
+        self.info_label.setGeometry(QtCore.QRect(128, 70, 155, 31))
         font = QtGui.QFont()
         font.setFamily("Bahnschrift Light")
         font.setPointSize(11)
@@ -283,6 +306,8 @@ class Ui_Form(object):
         self.split_line2.raise_()
         self.import_data_button.raise_()
         self.split_line3.raise_()
+        self.key_button.raise_()
+        self.split_line5.raise_()
         self.spacer1.raise_()
         self.split_line4.raise_()
         self.search_edit.raise_()
@@ -300,6 +325,8 @@ class Ui_Form(object):
         self.add_data_button.setText(_translate("Form", "+"))
         self.delete_data_button.setText(_translate("Form", "-"))
         self.import_data_button.setText(_translate("Form", "~"))
+        self.key_button.setToolTip(_translate("Form", "Change password or PIN"))
+        self.key_button.setText(_translate("Form", "⚙"))
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import locale
 import sys
 
 from PyQt6 import QtCore
@@ -5,7 +6,7 @@ from PyQt6.QtGui import QFontDatabase, QPixmap
 from PyQt6.QtWidgets import QApplication, QMainWindow, QStackedWidget
 
 from usermanager import UserManagementSystem
-from widgets import GreetWidget, UserCreation, MainWidget, PasswordCreation, PasswordAuth
+from widgets import GreetWidget, UserCreation, MainWidget, PasswordCreation, PasswordAuth, WriteWatcher
 
 
 class MainWindow(QMainWindow):
@@ -51,6 +52,18 @@ class MainWindow(QMainWindow):
 
     isLogged()
         Возвращает статус
+
+    delete_user()
+        Удаляет пользователя после подтверждения паролем (в фоновом потоке записи)
+
+    on_user_registered(result)
+        Обновляет список пользователей после регистрации (и если диалог регистрации уже закрыт)
+
+    on_user_deleted(result)
+        Обновляет список пользователей после удаления или показывает ошибку
+
+    closeEvent(event)
+        Дописывает очередь записи и закрывает соединения с БД при выходе из приложения
     '''
 
     def __init__(self):
@@ -122,8 +135,7 @@ class MainWindow(QMainWindow):
     def open_password_creation_window(self):
         if self.isLogged():
             creation_window = PasswordCreation(self)
-            creation_window.exec()
-            self.main_widget.show_data()
+            creation_window.exec()  # новая строка добавляется в таблицу без перечитывания
 
     def mousePressEvent(self, ev):
         self.dragPos = ev.globalPosition().toPoint()
@@ -172,6 +184,7 @@ class MainWindow(QMainWindow):
 
     def log_out(self):  # выйти
         if self.isLogged():
+            self.main_widget.flush_edits()
             self.widget_stack.setCurrentIndex(1)
             self.greet_widget.clear_input()
             self.greet_widget.label.setText('Enter your PIN-code')
@@ -184,19 +197,33 @@ class MainWindow(QMainWindow):
             passw_auth = PasswordAuth(self, current_user, f"Confirm deletion of User: {current_user}")
             passw_auth.exec()
             if current_user in [k[0] for k in self.usermanager.get_users_list()] and self.isLogged() and self.get_user_session():
-                result = self.usermanager.delete_user(current_user)
-                if result[0]:
-                    self.greet_widget.label.setText(result[1])
-                    self.greet_widget.clear_input()
-                    self.update_user_list()
-                    self.greet_widget.user_picture.clear()
-                    self.greet_widget.set_picture()
+                WriteWatcher(self, self.usermanager.submit(self.usermanager.delete_user, current_user),
+                             self.on_user_deleted)
             else:
                 self.greet_widget.label.setText('Password authentication failed.')
                 self.greet_widget.clear_input()
         self.isLoggedState = False
         self.user_session = None
 
+    def on_user_registered(self, result):  # результат фоновой регистрации
+        if result[0]:
+            self.update_user_list()
+
+    def on_user_deleted(self, result):  # результат фонового удаления пользователя
+        if not result[0]:
+            self.greet_widget.label.setText(f'User not deleted: {result[1]}')
+            return
+        self.greet_widget.label.setText(result[1])
+        self.greet_widget.clear_input()
+        self.update_user_list()
+        self.greet_widget.user_picture.clear()
+        self.greet_widget.set_picture()
+
+    def closeEvent(self, event):  # закрыть соединения с БД при выходе
+        self.main_widget.flush_edits()
+        self.usermanager.close()
+        super().closeEvent(event)
+
 
 def except_hook(cls, exception, traceback):
     sys.excepthook(cls, exception, traceback)
@@ -204,6 +231,10 @@ def except_hook(cls, exception, traceback):
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
+    try:
+        locale.setlocale(locale.LC_COLLATE, '')  # сортировка таблицы по правилам языка системы
+    except locale.Error:
+        pass  # локаль недоступна - порядок символов Unicode
     if hasattr(QtCore.Qt, 'AA_EnableHighDpiScaling'):
         app.setAttribute(QtCore.Qt.AA_EnableHighDpiScaling, True)
 
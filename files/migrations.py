@@ -0,0 +1,192 @@
+"""Миграции схемы БД
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Номер примененной версии хранится в таблице schema_version. Шаги из MIGRATIONS выполняются по порядку, каждый
+    в своей транзакции, и только если их версия больше текущей. Если схема актуальна, migrate() делает один SELECT.
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Функции:
+
+    get_schema_version(con)
+        Возвращает текущую версию схемы (0 для пустой БД)
+
+    migrate(con, migrations)
+        Применяет недостающие миграции (по умолчанию MIGRATIONS, для файлов пользователей - SHARD_MIGRATIONS)
+        и возвращает итоговую версию схемы
+
+"""
+
+import sqlite3
+
+
+def _create_base_tables(con):  # исходные таблицы users и data
+    con.execute('''CREATE TABLE IF NOT EXISTS users (
+        id                    INTEGER PRIMARY KEY ON CONFLICT ROLLBACK AUTOINCREMENT,
+        username              TEXT    UNIQUE
+                                      NOT NULL
+                                      ON CONFLICT ROLLBACK,
+        image                 BLOB            ,
+        master_key_passw      BLOB    NOT NULL,
+        master_key_passw_salt BLOB    NOT NULL,
+        master_key_pin        BLOB    NOT NULL,
+        master_key_pin_salt   BLOB    NOT NULL
+    )''')
+    con.execute('''CREATE TABLE IF NOT EXISTS data (
+        id             INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id        INTEGER NOT NULL
+                               REFERENCES users (id),
+        encrypted_data BLOB    NOT NULL
+    )''')
+
+
+def _add_data_user_index(con):  # индекс для выборки данных одного пользователя
+    con.execute('''CREATE INDEX IF NOT EXISTS data_user_id_idx ON data (user_id, id)''')
+
+
+def _rebuild_table(con, table, create_sql, columns, where=''):  # пересоздать таблицу (ALTER TABLE не меняет ограничения)
+    seq = con.execute('''SELECT seq FROM sqlite_sequence WHERE name = ?''', (table,)).fetchone()
+    con.execute(create_sql.replace(f'CREATE TABLE {table}', f'CREATE TABLE {table}_new', 1))
+    con.execute(f'''INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table} {where}''')
+    con.execute(f'''DROP TABLE {table}''')
+    con.execute(f'''ALTER TABLE {table}_new RENAME TO {table}''')
+    if seq:  # не выдавать заново id удаленных строк
+        con.execute('''UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?''', (seq[0], table))
+
+
+def _rebuild_data(con, create_sql, columns):  # пересоздать таблицу data вместе с индексом
+    # строки удаленных пользователей расшифровать уже нельзя - не переносим их
+    _rebuild_table(con, 'data', create_sql, columns, where='''WHERE user_id IN (SELECT id FROM users)''')
+    _add_data_user_index(con)
+
+
+def _cascade_data_foreign_key(con):  # data.user_id с ON DELETE CASCADE
+    _rebuild_data(con, '''CREATE TABLE data (
+        id             INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id        INTEGER NOT NULL
+                               REFERENCES users (id) ON DELETE CASCADE,
+        encrypted_data BLOB    NOT NULL
+    )''', 'id, user_id, encrypted_data')
+
+
+def _split_data_fields(con):  # отдельные зашифрованные поля для метаданных и пароля
+    # encrypted_data остается для старых записей, новые пишут encrypted_meta + encrypted_password
+    _rebuild_data(con, '''CREATE TABLE data (
+        id                 INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id            INTEGER NOT NULL
+                                   REFERENCES users (id) ON DELETE CASCADE,
+        encrypted_data     BLOB,
+        encrypted_meta     BLOB,
+        encrypted_password BLOB,
+        CHECK (encrypted_data IS NOT NULL OR (encrypted_meta IS NOT NULL AND encrypted_password IS NOT NULL))
+    )''', 'id, user_id, encrypted_data')
+
+
+def _drop_users_conflict_rollback(con):  # ON CONFLICT ROLLBACK откатывал всю внешнюю транзакцию
+    _rebuild_table(con, 'users', '''CREATE TABLE users (
+        id                    INTEGER PRIMARY KEY AUTOINCREMENT,
+        username              TEXT    UNIQUE
+                                      NOT NULL,
+        image                 BLOB            ,
+        master_key_passw      BLOB    NOT NULL,
+        master_key_passw_salt BLOB    NOT NULL,
+        master_key_pin        BLOB    NOT NULL,
+        master_key_pin_salt   BLOB    NOT NULL
+    )''', 'id, username, image, master_key_passw, master_key_passw_salt, master_key_pin, master_key_pin_salt')
+
+
+def _add_key_slot_kdf(con):  # параметры KDF слотов ключа (NULL - прежние PBKDF2-SHA256, 10 ** 5 итераций)
+    con.execute('''ALTER TABLE users ADD COLUMN master_key_passw_kdf TEXT''')
+    con.execute('''ALTER TABLE users ADD COLUMN master_key_pin_kdf TEXT''')
+
+
+def _add_data_wrapped_key(con):  # ключ данных записи, зашифрованный мастер-ключом (NULL - без конверта)
+    con.execute('''ALTER TABLE data ADD COLUMN wrapped_key BLOB''')
+
+
+def _create_key_rotation(con):  # незавершенная смена мастер-ключа (не больше одной на пользователя)
+    # master_key_new - новый мастер-ключ под старым, слоты - новый мастер-ключ под паролем и PIN-кодом,
+    # checkpoint - id последней записи, уже перешифрованной новым ключом
+    con.execute('''CREATE TABLE key_rotation (
+        user_id               INTEGER PRIMARY KEY
+                                      REFERENCES users (id) ON DELETE CASCADE,
+        master_key_new        BLOB    NOT NULL,
+        master_key_passw      BLOB    NOT NULL,
+        master_key_passw_salt BLOB    NOT NULL,
+        master_key_passw_kdf  TEXT,
+        master_key_pin        BLOB    NOT NULL,
+        master_key_pin_salt   BLOB    NOT NULL,
+        master_key_pin_kdf    TEXT,
+        checkpoint            INTEGER NOT NULL DEFAULT 0
+    )''')
+
+
+MIGRATIONS = [  # (версия, описание, шаг) - строго по возрастанию версии
+    (1, 'create users and data tables', _create_base_tables),
+    (2, 'index data (user_id, id)', _add_data_user_index),
+    (3, 'data.user_id ON DELETE CASCADE', _cascade_data_foreign_key),
+    (4, 'split data into encrypted_meta and encrypted_password', _split_data_fields),
+    (5, 'users without ON CONFLICT ROLLBACK', _drop_users_conflict_rollback),
+    (6, 'per-slot KDF parameters', _add_key_slot_kdf),
+    (7, 'per-entry wrapped data key', _add_data_wrapped_key),
+    (8, 'master key rotation state', _create_key_rotation),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _create_shard_data(con):  # таблица data в отдельном файле пользователя (таблицы users там нет)
+    con.execute('''CREATE TABLE IF NOT EXISTS data (
+        id                 INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id            INTEGER NOT NULL,
+        encrypted_data     BLOB,
+        encrypted_meta     BLOB,
+        encrypted_password BLOB,
+        CHECK (encrypted_data IS NOT NULL OR (encrypted_meta IS NOT NULL AND encrypted_password IS NOT NULL))
+    )''')
+    _add_data_user_index(con)
+
+
+SHARD_MIGRATIONS = [  # схема файла данных одного пользователя (ShardedSQLiteBackend)
+    (1, 'create data table', _create_shard_data),
+    (2, 'per-entry wrapped data key', _add_data_wrapped_key),
+]
+
+
+def get_schema_version(con):  # текущая версия схемы
+    try:
+        return con.execute('''SELECT MAX(version) FROM schema_version''').fetchone()[0] or 0
+    except sqlite3.OperationalError:  # таблицы schema_version еще нет
+        return 0
+
+
+def migrate(con, migrations=MIGRATIONS):  # применить недостающие миграции
+    version = get_schema_version(con)
+    if version >= migrations[-1][0]:
+        return version
+    con.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version     INTEGER PRIMARY KEY,
+        description TEXT    NOT NULL,
+        applied_at  TEXT    NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )''')
+    con.commit()
+    # пересоздание таблиц требует отключенных внешних ключей, а PRAGMA не действует внутри транзакции
+    foreign_keys = con.execute('''PRAGMA foreign_keys''').fetchone()[0]
+    con.execute('''PRAGMA foreign_keys = OFF''')
+    try:
+        for step_version, description, step in migrations:
+            if step_version <= version:
+                continue
+            con.execute('''BEGIN''')
+            try:
+                step(con)
+                con.execute('''INSERT INTO schema_version (version, description) VALUES (?, ?)''',
+                            (step_version, description))
+            except Exception:
+                con.rollback()
+                raise
+            con.commit()
+            version = step_version
+    finally:
+        con.execute(f'''PRAGMA foreign_keys = {foreign_keys}''')
+    return version
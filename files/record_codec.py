@@ -0,0 +1,117 @@
+"""Двоичный формат расшифрованной записи (вместо json.dumps в каждой записи).
+
+    запись = [версия 1 байт][число полей 1 байт] + поля
+    поле   = [id поля 1 байт][флаги 1 байт][длина varint][значение]
+
+Имена полей не повторяются в каждой записи: они в таблице FIELD_IDS. Поле не из таблицы пишется с id FIELD_NAMED,
+и его значение начинается с имени ([длина varint][имя]). Строки хранятся в UTF-8, FLAG_NULL - значение None,
+FLAG_ZLIB - значение сжато zlib (длинный текст от RECORD_COMPRESS_THRESHOLD байт, если сжатие выгодно).
+Записи прежних версий - JSON-объекты: они начинаются с '{', байт версии никогда ему не равен, поэтому
+decode_record читает оба формата.
+"""
+import json
+import zlib
+
+from config import RECORD_COMPRESS_THRESHOLD
+
+RECORD_VERSION = 1
+FIELD_IDS = {'name': 1, 'username': 2, 'password': 3}  # id полей только добавляются - записи хранят id, не имена
+FIELD_NAMES = {field_id: name for name, field_id in FIELD_IDS.items()}
+FIELD_NAMED = 0  # поле не из таблицы: имя хранится в значении
+FLAG_NULL = 0x01
+FLAG_ZLIB = 0x02
+
+_JSON_START = ord('{')
+
+
+def _pack_varint(value, out):  # беззнаковое число по 7 бит в байте (LEB128) в конец bytearray out
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _varint(value):  # varint отдельным bytearray
+    out = bytearray()
+    _pack_varint(value, out)
+    return out
+
+
+def _unpack_varint(data, offset):  # -> (число, смещение после него)
+    value = shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError('Truncated varint')
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_record(datum, compress_threshold=RECORD_COMPRESS_THRESHOLD):  # словарь записи -> bytes
+    if len(datum) > 0xFF:
+        raise ValueError('Too many fields in record')
+    out = bytearray((RECORD_VERSION, len(datum)))
+    for name, value in datum.items():
+        field_id = FIELD_IDS.get(name, FIELD_NAMED)
+        flags = 0
+        if value is None:
+            flags, value = FLAG_NULL, b''
+        elif isinstance(value, str):
+            value = value.encode()
+            if len(value) >= compress_threshold:
+                packed = zlib.compress(value)
+                if len(packed) < len(value):
+                    flags, value = FLAG_ZLIB, packed
+        else:
+            raise TypeError(f'Record field {name} must be str or None, not {type(value).__name__}')
+        if field_id == FIELD_NAMED:
+            name = name.encode()
+            value = bytes(_varint(len(name))) + name + value
+        out += bytes((field_id, flags))
+        _pack_varint(len(value), out)
+        out += value
+    return bytes(out)
+
+
+def decode_record(data):  # bytes / memoryview -> словарь записи (JSON прежних версий - тоже)
+    if not len(data):
+        raise ValueError('Empty record')
+    if data[0] == _JSON_START:
+        return json.loads(str(data, 'utf8'))
+    if data[0] != RECORD_VERSION:
+        raise ValueError(f'Unknown record version {data[0]}')
+    if len(data) < 2:
+        raise ValueError('Truncated record')
+    datum = dict()
+    offset = 2
+    for _ in range(data[1]):
+        if offset + 2 > len(data):
+            raise ValueError('Truncated record')
+        field_id, flags = data[offset], data[offset + 1]
+        length, offset = _unpack_varint(data, offset + 2)
+        end = offset + length
+        if field_id == FIELD_NAMED:
+            name_length, offset = _unpack_varint(data, offset)
+            name = str(data[offset:offset + name_length], 'utf8')
+            offset += name_length
+        elif field_id in FIELD_NAMES:
+            name = FIELD_NAMES[field_id]
+        else:
+            raise ValueError(f'Unknown record field {field_id}')
+        if end > len(data):
+            raise ValueError('Truncated record')
+        if flags & FLAG_NULL:
+            datum[name] = None
+        else:
+            value = data[offset:end]  # срез memoryview - без копии, строка создается один раз
+            if flags & FLAG_ZLIB:
+                try:
+                    value = zlib.decompress(value)
+                except zlib.error as e:  # ошибки формата - ValueError, как и остальные
+                    raise ValueError(f'Corrupted compressed field {name}: {e}') from None
+            datum[name] = str(value, 'utf8')
+        offset = end
+    return datum
@@ -0,0 +1,134 @@
+"""Триграммный индекс для поиска по расшифрованным описаниям и логинам.
+
+Поля записи приводятся к casefold и склеиваются в одну строку, где после каждого поля стоят два граничных
+символа; индексируются все триграммы этой строки: триграмма -> множество id записей. Запрос от трех символов -
+пересечение множеств его триграмм (начиная с самого короткого) с проверкой вхождения строки. Любая подстрока из одного-двух символов
+- начало какой-то триграммы строки (граница после поля это гарантирует), поэтому короткий запрос -
+объединение множеств триграмм с таким началом (по словарю префиксов, без перебора записей).
+"""
+import heapq
+
+from config import SEARCH_RANK_LIMIT
+
+BOUNDARY = '\x00'  # граничный символ (в тексте записей не встречается)
+SEPARATOR = BOUNDARY * 2  # после каждого поля: триграммы не переходят из поля в поле
+
+
+def _joined(fields):  # поля записи -> строка индекса
+    return ''.join((field or '').casefold() + SEPARATOR for field in fields)
+
+
+def _grams(text):  # триграммы строки индекса
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramIndex:
+    """Класс триграммного индекса записей
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Методы:
+
+    add(row_id, *fields)
+        Индексирует (или переиндексирует) поля записи row_id
+
+    add_many(rows)
+        Индексирует [(id, поле, поле, ...), ...]
+
+    remove(row_id)
+        Убирает запись из индекса
+
+    clear()
+        Очищает индекс
+
+    search(query, limit)
+        Возвращает (множество id найденных записей, до limit лучших id по убыванию релевантности);
+        при большем числе найденных записей ранжирование пропускается - список пуст
+
+    Релевантность: поле совпадает с запросом, начинается с него, запрос с начала слова, вхождение в середине;
+    при равенстве описание важнее логина, короткое поле - длинного
+
+    """
+
+    def __init__(self):
+        self._postings = dict()  # триграмма -> множество id
+        self._prefixes = dict()  # первые 1-2 символа -> множество триграмм с таким началом
+        self._texts = dict()  # id -> строка индекса (поля в casefold через SEPARATOR)
+
+    def __len__(self):
+        return len(self._texts)
+
+    def add(self, row_id, *fields):
+        if row_id in self._texts:
+            self.remove(row_id)
+        text = self._texts[row_id] = _joined(fields)
+        for gram in _grams(text):
+            posting = self._postings.get(gram)
+            if posting is None:
+                posting = self._postings[gram] = set()
+                self._prefixes.setdefault(gram[:1], set()).add(gram)
+                self._prefixes.setdefault(gram[:2], set()).add(gram)
+            posting.add(row_id)
+
+    def add_many(self, rows):
+        for row_id, *fields in rows:
+            self.add(row_id, *fields)
+
+    def remove(self, row_id):
+        text = self._texts.pop(row_id, None)
+        if text is None:
+            return
+        for gram in _grams(text):
+            posting = self._postings[gram]
+            posting.discard(row_id)
+            if not posting:
+                del self._postings[gram]
+                for prefix in (gram[:1], gram[:2]):
+                    grams = self._prefixes[prefix]
+                    grams.discard(gram)
+                    if not grams:
+                        del self._prefixes[prefix]
+
+    def clear(self):
+        self._postings.clear()
+        self._prefixes.clear()
+        self._texts.clear()
+
+    def search(self, query, limit=SEARCH_RANK_LIMIT):  # -> (множество id, список лучших id)
+        query = query.casefold()
+        if not query or BOUNDARY in query:
+            return set(), []
+        if len(query) < 3:
+            ids = set().union(*(self._postings[gram] for gram in self._prefixes.get(query, ())))
+        else:
+            postings = sorted((self._postings.get(query[i:i + 3], ()) for i in range(len(query) - 2)), key=len)
+            ids = set(postings[0])
+            for posting in postings[1:]:
+                if not ids:
+                    break
+                ids &= posting
+            if len(query) > 3:  # триграммы могут встретиться порознь - проверка вхождения только у кандидатов
+                texts = self._texts
+                ids = {row_id for row_id in ids if query in texts[row_id]}
+        if len(ids) > limit:
+            return ids, []
+        return ids, heapq.nsmallest(limit, ids, key=lambda row_id: self._rank(row_id, query))
+
+    def _rank(self, row_id, query):  # ключ сортировки: меньше - релевантнее
+        best = None
+        for field_no, text in enumerate(self._texts[row_id].split(SEPARATOR)):
+            position = text.find(query)
+            if position < 0:
+                continue
+            if text == query:
+                score = 0
+            elif position == 0:
+                score = 1
+            elif not text[position - 1].isalnum():
+                score = 2
+            else:
+                score = 3
+            key = (score, field_no, len(text))
+            if best is None or key < best:
+                best = key
+        return best or (4, 0, 0), row_id
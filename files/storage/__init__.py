@@ -0,0 +1,18 @@
+from storage.base import StorageBackend, UserExistsError
+from storage.log_backend import LogBackend
+from storage.memory_backend import MemoryBackend
+from storage.sharded_backend import ShardedSQLiteBackend
+from storage.sqlite_backend import SQLiteBackend
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'sqlite-sharded': ShardedSQLiteBackend,
+    'memory': lambda path=None: MemoryBackend(),
+    'log': LogBackend,
+}
+
+
+def create_backend(name, path=None):  # создать хранилище по имени из config.STORAGE_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown storage backend {name}')
+    return BACKENDS[name](path)
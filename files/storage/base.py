@@ -0,0 +1,153 @@
+class UserExistsError(Exception):
+    """Пользователь с таким именем уже зарегистрирован"""
+
+
+class StorageBackend:
+    """Базовый класс хранилища
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Хранилище работает только с уже зашифрованными данными: шифрование остается в UserManagementSystem,
+    поэтому движки взаимозаменяемы без изменений в интерфейсе (widgets.py).
+    Запись данных (encrypted record) - кортеж (encrypted_data, encrypted_meta, encrypted_password, wrapped_key),
+    где encrypted_data - запись одним блоком, а encrypted_meta/encrypted_password - раздельное хранение;
+    wrapped_key - ключ данных записи, зашифрованный мастер-ключом (None - данные зашифрованы мастер-ключом).
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Методы:
+
+    init_storage()
+        Создает или обновляет структуру хранилища
+
+    transaction()
+        Контекстный менеджер транзакции; вложенные вызовы откатываются независимо (SAVEPOINT)
+
+    release()
+        Освобождает ресурсы текущего потока
+
+    close()
+        Закрывает хранилище
+
+    add_user(username, image, master_key_passw, master_key_passw_salt, master_key_pin, master_key_pin_salt,
+             master_key_passw_kdf, master_key_pin_kdf)
+        Добавляет пользователя; UserExistsError, если имя занято
+
+    get_user_id(username)
+        Возвращает id пользователя или None
+
+    get_key_slot(username, slot)
+        Возвращает (зашифрованный мастер-ключ, соль, параметры KDF) для slot = 'passw' / 'pin' или None;
+        параметры KDF - None для слотов прежних версий
+
+    update_key_slot(username, slot, master_key_wrapped, salt, kdf)
+        Перезаписывает зашифрованный мастер-ключ, соль и параметры KDF слота slot
+
+    list_users()
+        Возвращает [(username, image), ...]
+
+    delete_user(username)
+        Удаляет пользователя и все его записи
+
+    insert_records(user_id, records)
+        Добавляет записи и возвращает список их id
+
+    iter_records(user_id, after_id, limit)
+        Возвращает до limit строк (id, encrypted_data, encrypted_meta, wrapped_key) с id > after_id по возрастанию id
+
+    get_record_secret(user_id, ud_id)
+        Возвращает (encrypted_data, encrypted_password, wrapped_key) записи или None
+        (user_id = None - без проверки владельца; хранилищу с файлом на пользователя владелец обязателен)
+
+    update_records(user_id, records)
+        Перезаписывает записи [(id, *record), ...] пользователя, возвращает число измененных
+
+    upsert_records(user_id, records)
+        Как update_records, но записи с id = None или отсутствующим id добавляются
+
+    delete_records(user_id, ud_ids)
+        Удаляет записи по id (user_id = None - как в get_record_secret), возвращает число удаленных
+
+    iter_raw_records(user_id, after_id, limit)
+        Как iter_records, но строки целиком: (id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key)
+
+    begin_rotation(user_id, master_key_new, master_key_passw, master_key_passw_salt, master_key_passw_kdf,
+                   master_key_pin, master_key_pin_salt, master_key_pin_kdf)
+        Сохраняет состояние смены мастер-ключа: новый мастер-ключ под старым и новые слоты ключа
+
+    get_rotation(user_id)
+        Возвращает (master_key_new, master_key_passw, master_key_passw_salt, master_key_passw_kdf,
+        master_key_pin, master_key_pin_salt, master_key_pin_kdf, checkpoint) или None
+
+    set_rotation_checkpoint(user_id, checkpoint)
+        Запоминает id последней записи, перешифрованной новым мастер-ключом
+
+    finish_rotation(user_id)
+        Записывает новые слоты ключа в пользователя и удаляет состояние смены (одной транзакцией)
+
+    """
+
+    def init_storage(self):
+        pass
+
+    def transaction(self):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+    def close(self):
+        pass
+
+    def add_user(self, username, image, master_key_passw, master_key_passw_salt, master_key_pin, master_key_pin_salt,
+                 master_key_passw_kdf=None, master_key_pin_kdf=None):
+        raise NotImplementedError
+
+    def get_user_id(self, username):
+        raise NotImplementedError
+
+    def get_key_slot(self, username, slot):
+        raise NotImplementedError
+
+    def update_key_slot(self, username, slot, master_key_wrapped, salt, kdf=None):
+        raise NotImplementedError
+
+    def list_users(self):
+        raise NotImplementedError
+
+    def delete_user(self, username):
+        raise NotImplementedError
+
+    def insert_records(self, user_id, records):
+        raise NotImplementedError
+
+    def iter_records(self, user_id, after_id, limit):
+        raise NotImplementedError
+
+    def get_record_secret(self, user_id, ud_id):
+        raise NotImplementedError
+
+    def update_records(self, user_id, records):
+        raise NotImplementedError
+
+    def upsert_records(self, user_id, records):
+        raise NotImplementedError
+
+    def delete_records(self, user_id, ud_ids):
+        raise NotImplementedError
+
+    def iter_raw_records(self, user_id, after_id, limit):
+        raise NotImplementedError
+
+    def begin_rotation(self, user_id, master_key_new, master_key_passw, master_key_passw_salt, master_key_passw_kdf,
+                       master_key_pin, master_key_pin_salt, master_key_pin_kdf):
+        raise NotImplementedError
+
+    def get_rotation(self, user_id):
+        raise NotImplementedError
+
+    def set_rotation_checkpoint(self, user_id, checkpoint):
+        raise NotImplementedError
+
+    def finish_rotation(self, user_id):
+        raise NotImplementedError
@@ -0,0 +1,116 @@
+import base64
+import json
+import os
+
+from storage.memory_backend import MemoryBackend
+
+
+def _encode(value):  # bytes -> {'$b': base64} для JSON
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'$b': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if '$b' in value:
+            return base64.b64decode(value['$b'])
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+class LogBackend(MemoryBackend):
+    """Хранилище в одном файле-журнале (append-only) с рабочей копией в памяти
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Каждая зафиксированная транзакция дописывается в файл одной строкой JSON - списком операций MemoryBackend.
+    При открытии журнал проигрывается заново; недописанная последняя строка (сбой во время записи) отбрасывается.
+    Чтение идет из памяти, запись - один write + fsync на транзакцию. Сбой записи откатывает транзакцию
+    и в памяти, и в файле (журнал обрезается до прежнего размера).
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Атрибуты:
+
+    log_path: str
+        Имя файла журнала
+
+    fsync: bool
+        Вызывать os.fsync после каждой транзакции
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Методы:
+
+    compact()
+        Перезаписывает журнал снимком текущего состояния
+
+    """
+
+    def __init__(self, log_path, fsync=True):
+        super().__init__()
+        self.log_path = log_path
+        self.fsync = fsync
+        self._file = None
+
+    def init_storage(self):  # проиграть журнал и открыть его на дозапись
+        valid_size = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as file:
+                for line in file:
+                    try:
+                        ops = _decode(json.loads(line))
+                    except ValueError:
+                        break  # хвост недописанной транзакции
+                    for op in ops:
+                        self._apply(op)
+                    valid_size += len(line)
+            self._undo = []
+        self._file = open(self.log_path, 'ab')
+        self._file.truncate(valid_size)
+
+    def _commit(self, ops):
+        if ops:
+            size = self._file.tell()
+            try:
+                self._file.write(json.dumps(_encode(ops), separators=(',', ':')).encode() + b'\n')
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            except BaseException:
+                self._truncate(size)  # недописанная строка не должна склеиться со следующей транзакцией
+                raise
+
+    def _truncate(self, size):  # отбросить хвост журнала после сбоя записи (транзакция откатывается)
+        try:
+            self._file.close()  # данные в буфере файла отбрасываются
+        except OSError:
+            pass
+        self._file = open(self.log_path, 'ab')
+        self._file.truncate(size)
+
+    def compact(self):  # переписать журнал снимком состояния
+        with self._write_lock:
+            ops = [('user+', username, user) for username, user in self.users.items()]
+            ops += [('rec+', ud_id, *record) for ud_id, record in self.records.items()]
+            tmp_path = self.log_path + '.tmp'
+            with open(tmp_path, 'wb') as file:
+                file.write(json.dumps(_encode(ops), separators=(',', ':')).encode() + b'\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.log_path)
+            self._file = open(self.log_path, 'ab')
+
+    def close(self):
+        with self._write_lock:
+            if self._file:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,257 @@
+import bisect
+import threading
+from contextlib import contextmanager
+
+from storage.base import StorageBackend, UserExistsError
+
+
+class MemoryBackend(StorageBackend):
+    """Хранилище в оперативной памяти (для тестов, замеров и сравнения движков)
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Все изменения выполняются операциями _apply(op) с журналом отмены, поэтому транзакции и вложенные
+    транзакции откатываются так же, как в SQLite; сбой фиксации (_commit) тоже откатывает транзакцию.
+    Транзакция держит блокировку писателя - писатель всегда один; чтение и каждая операция берут только
+    короткую блокировку данных, поэтому читатели не ждут конца транзакции, но видят ее незафиксированные изменения.
+
+    Операции:
+        ('user+', username, поля)  - добавить/заменить пользователя
+        ('user-', username)        - удалить пользователя
+        ('rec+', id, user_id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key) - добавить/заменить
+                                   запись (wrapped_key может отсутствовать в журналах прежних версий)
+        ('rec-', id)               - удалить запись
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Атрибуты:
+
+    users: dict
+        username -> {'id', 'image', 'master_key_passw', ...}; незавершенная смена мастер-ключа -
+        поле 'rotation' в формате get_rotation
+
+    records: dict
+        id записи -> [user_id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key]
+
+    """
+
+    def __init__(self):
+        self.users = dict()
+        self.records = dict()
+        self._user_records = dict()  # user_id -> отсортированный список id записей
+        self._next_user_id = 1
+        self._next_record_id = 1
+        self._lock = threading.RLock()  # данные: одна операция или одно чтение
+        self._write_lock = threading.RLock()  # транзакция целиком
+        self._undo = []  # журнал отмены текущей транзакции
+        self._ops = []  # операции текущей транзакции (для журнала LogBackend)
+        self._depth = 0
+
+    @contextmanager
+    def transaction(self):
+        with self._write_lock:
+            depth, undo_mark, ops_mark = self._depth, len(self._undo), len(self._ops)
+            self._depth += 1
+            try:
+                yield self
+                if not depth:
+                    self._commit(self._ops)  # сбой фиксации откатывает транзакцию вместе с данными в памяти
+            except BaseException:
+                with self._lock:
+                    while len(self._undo) > undo_mark:  # откат до начала этой (под)транзакции
+                        self._undo.pop()()
+                del self._ops[ops_mark:]
+                raise
+            finally:
+                self._depth = depth
+                if not depth:
+                    self._undo, self._ops = [], []
+
+    def _commit(self, ops):  # точка расширения: фиксация операций транзакции
+        pass
+
+    def _apply(self, op):  # выполнить операцию и запомнить, как ее отменить
+        with self._lock:
+            kind = op[0]
+            if kind == 'user+':
+                username, fields = op[1], op[2]
+                old = self.users.get(username)
+                self.users[username] = dict(fields)
+                self._user_records.setdefault(fields['id'], [])
+                self._next_user_id = max(self._next_user_id, fields['id'] + 1)
+                self._undo.append(lambda: self._restore_user(username, old))
+            elif kind == 'user-':
+                old = self.users.pop(op[1])
+                self._undo.append(lambda: self._restore_user(op[1], old))
+            elif kind == 'rec+':
+                ud_id, record = op[1], list(op[2:])
+                record += [None] * (5 - len(record))  # операция без wrapped_key
+                old = self.records.get(ud_id)
+                if old is None:
+                    bisect.insort(self._user_records.setdefault(record[0], []), ud_id)
+                self.records[ud_id] = record
+                self._next_record_id = max(self._next_record_id, ud_id + 1)
+                self._undo.append(lambda: self._restore_record(ud_id, old))
+            elif kind == 'rec-':
+                old = self.records.pop(op[1])
+                ids = self._user_records[old[0]]
+                del ids[bisect.bisect_left(ids, op[1])]
+                self._undo.append(lambda: self._restore_record(op[1], old))
+            else:
+                raise ValueError(f'Unknown storage operation {kind}')
+            if self._depth:
+                self._ops.append(op)
+
+    def _restore_user(self, username, old):
+        if old is None:
+            self.users.pop(username, None)
+        else:
+            self.users[username] = old
+
+    def _restore_record(self, ud_id, old):
+        current = self.records.pop(ud_id, None)
+        if current is not None:
+            ids = self._user_records[current[0]]
+            del ids[bisect.bisect_left(ids, ud_id)]
+        if old is not None:
+            self.records[ud_id] = old
+            bisect.insort(self._user_records.setdefault(old[0], []), ud_id)
+
+    def add_user(self, username, image, master_key_passw, master_key_passw_salt, master_key_pin, master_key_pin_salt,
+                 master_key_passw_kdf=None, master_key_pin_kdf=None):
+        with self.transaction():
+            if username in self.users:
+                raise UserExistsError(username)
+            self._apply(('user+', username, {
+                'id': self._next_user_id, 'image': image,
+                'master_key_passw': master_key_passw, 'master_key_passw_salt': master_key_passw_salt,
+                'master_key_passw_kdf': master_key_passw_kdf,
+                'master_key_pin': master_key_pin, 'master_key_pin_salt': master_key_pin_salt,
+                'master_key_pin_kdf': master_key_pin_kdf}))
+
+    def get_user_id(self, username):
+        with self._lock:
+            user = self.users.get(username)
+            return user['id'] if user else None
+
+    def get_key_slot(self, username, slot):
+        with self._lock:
+            user = self.users.get(username)
+            if user:
+                # журналы прежних версий не содержат параметров KDF
+                return user[f'master_key_{slot}'], user[f'master_key_{slot}_salt'], user.get(f'master_key_{slot}_kdf')
+
+    def update_key_slot(self, username, slot, master_key_wrapped, salt, kdf=None):
+        with self.transaction():
+            user = self.users.get(username)
+            if user:
+                self._apply(('user+', username, {**user, f'master_key_{slot}': master_key_wrapped,
+                                                 f'master_key_{slot}_salt': salt, f'master_key_{slot}_kdf': kdf}))
+
+    def list_users(self):
+        with self._lock:
+            return [(username, user['image']) for username, user in self.users.items()]
+
+    def delete_user(self, username):
+        with self.transaction():
+            user = self.users.get(username)
+            if user:
+                for ud_id in list(self._user_records.get(user['id'], ())):
+                    self._apply(('rec-', ud_id))
+                self._apply(('user-', username))
+
+    def insert_records(self, user_id, records):
+        with self.transaction():
+            ids = []
+            for record in records:
+                ids.append(self._next_record_id)
+                self._apply(('rec+', self._next_record_id, user_id, *record))
+            return ids
+
+    def iter_records(self, user_id, after_id, limit):
+        with self._lock:
+            ids = self._user_records.get(user_id, [])
+            start = bisect.bisect_right(ids, after_id)
+            return [(ud_id, *self.records[ud_id][1:3], self.records[ud_id][4]) for ud_id in ids[start:start + limit]]
+
+    def get_record_secret(self, user_id, ud_id):
+        with self._lock:
+            record = self.records.get(ud_id)
+            if record and (user_id is None or record[0] == user_id):
+                return record[1], record[3], record[4]
+
+    def update_records(self, user_id, records):
+        with self.transaction():
+            count = 0
+            for ud_id, *record in records:
+                old = self.records.get(ud_id)
+                if old and old[0] == user_id:
+                    self._apply(('rec+', ud_id, user_id, *record))
+                    count += 1
+            return count
+
+    def upsert_records(self, user_id, records):
+        with self.transaction():
+            count = 0
+            for ud_id, *record in records:
+                old = self.records.get(ud_id) if ud_id is not None else None
+                if old and old[0] != user_id:  # чужая запись не перезаписывается
+                    continue
+                self._apply(('rec+', self._next_record_id if ud_id is None else ud_id, user_id, *record))
+                count += 1
+            return count
+
+    def delete_records(self, user_id, ud_ids):
+        with self.transaction():
+            count = 0
+            for ud_id in ud_ids:
+                old = self.records.get(ud_id)
+                if old and (user_id is None or old[0] == user_id):
+                    self._apply(('rec-', ud_id))
+                    count += 1
+            return count
+
+    def iter_raw_records(self, user_id, after_id, limit):
+        with self._lock:
+            ids = self._user_records.get(user_id, [])
+            start = bisect.bisect_right(ids, after_id)
+            return [(ud_id, *self.records[ud_id][1:]) for ud_id in ids[start:start + limit]]
+
+    def _user_by_id(self, user_id):  # (username, поля) или (None, None)
+        for username, user in self.users.items():
+            if user['id'] == user_id:
+                return username, user
+        return None, None
+
+    def begin_rotation(self, user_id, master_key_new, master_key_passw, master_key_passw_salt, master_key_passw_kdf,
+                       master_key_pin, master_key_pin_salt, master_key_pin_kdf):
+        with self.transaction():
+            username, user = self._user_by_id(user_id)
+            if user is None:
+                raise LookupError(f'User {user_id} not found')
+            if user.get('rotation'):
+                raise ValueError('Key rotation is already in progress')
+            self._apply(('user+', username, {**user, 'rotation': [
+                master_key_new, master_key_passw, master_key_passw_salt, master_key_passw_kdf,
+                master_key_pin, master_key_pin_salt, master_key_pin_kdf, 0]}))
+
+    def get_rotation(self, user_id):
+        with self._lock:
+            user = self._user_by_id(user_id)[1]
+            if user and user.get('rotation'):
+                return tuple(user['rotation'])
+
+    def set_rotation_checkpoint(self, user_id, checkpoint):
+        with self.transaction():
+            username, user = self._user_by_id(user_id)
+            if user and user.get('rotation'):
+                self._apply(('user+', username, {**user, 'rotation': [*user['rotation'][:-1], checkpoint]}))
+
+    def finish_rotation(self, user_id):
+        with self.transaction():
+            username, user = self._user_by_id(user_id)
+            if user and user.get('rotation'):
+                slots = dict(zip(('master_key_passw', 'master_key_passw_salt', 'master_key_passw_kdf',
+                                  'master_key_pin', 'master_key_pin_salt', 'master_key_pin_kdf'),
+                                 user['rotation'][1:-1]))
+                self._apply(('user+', username, {**user, **slots, 'rotation': None}))
@@ -0,0 +1,256 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from connection import ConnectionManager
+from migrations import SHARD_MIGRATIONS, migrate
+from storage.sqlite_backend import SQLiteBackend
+
+
+class ShardedSQLiteBackend(SQLiteBackend):
+    """Хранилище SQLite с отдельным файлом данных на пользователя
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Файл-каталог (db_path) хранит только таблицу users, данные каждого пользователя лежат в своем файле
+    shards_dir/user_<id>.db. Файл пользователя открывается при первом обращении к его записям, то есть
+    после входа; блокировки и кэш страниц у каждого файла свои, поэтому запись одного пользователя
+    не мешает остальным. delete_user удаляет файл целиком.
+
+    Транзакция transaction() охватывает все файлы, затронутые внутри нее: каждый файл подключается к ней
+    при первом обращении (BEGIN, а для вложенных уровней - SAVEPOINT) и фиксируется при выходе из внешнего блока.
+    Записи, оставшиеся в таблице data каталога от прежнего формата, переносятся в файл пользователя при его открытии.
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Атрибуты:
+
+    shards_dir: str
+        Папка с файлами пользователей
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Методы:
+
+    shard_path(user_id)
+        Возвращает имя файла данных пользователя
+
+    """
+
+    def __init__(self, db_path, shards_dir=None):
+        super().__init__(db_path)
+        self.shards_dir = shards_dir or os.path.splitext(db_path)[0] + '_vaults'
+        self._shards = dict()  # user_id -> ConnectionManager файла пользователя
+        self._shards_lock = threading.Lock()
+        self._local = threading.local()  # frames: стек уровней транзакции, enlisted: подключенные файлы
+
+    def init_storage(self):
+        super().init_storage()
+        os.makedirs(self.shards_dir, exist_ok=True)
+        user_ids = {row[0] for row in self.connections.connect().execute('''SELECT id FROM users''')}
+        for name in os.listdir(self.shards_dir):  # файлы пользователей, удаление которых прервалось
+            if name.startswith('user_') and name.split('.')[0][5:].isdigit():
+                if int(name.split('.')[0][5:]) not in user_ids:
+                    os.remove(os.path.join(self.shards_dir, name))
+
+    def shard_path(self, user_id):
+        return os.path.join(self.shards_dir, f'user_{user_id}.db')
+
+    def _shard(self, user_id):  # менеджер соединений файла пользователя (открывается при первом обращении)
+        with self._shards_lock:
+            shard = self._shards.get(user_id)
+            if shard is None:
+                shard = ConnectionManager(self.shard_path(user_id))
+                migrate(shard.connect(), SHARD_MIGRATIONS)
+                self._adopt_catalog_rows(user_id, shard)
+                self._shards[user_id] = shard
+        return shard
+
+    def _adopt_catalog_rows(self, user_id, shard):  # перенести записи пользователя из data каталога
+        catalog = self.connections.connect()
+        rows = catalog.execute(
+            '''SELECT id, user_id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key
+            FROM data WHERE user_id = ?''',
+            (user_id,)).fetchall()
+        if rows:
+            with shard.transaction() as con:
+                con.executemany(
+                    '''INSERT OR IGNORE INTO data
+                    (id, user_id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key)
+                    VALUES (?,?,?,?,?,?)''', rows)
+            with self.connections.transaction() as con:
+                con.execute('''DELETE FROM data WHERE user_id = ?''', (user_id,))
+
+    # Транзакции по нескольким файлам
+    def _frames(self):
+        if not hasattr(self._local, 'frames'):
+            self._local.frames = []
+            self._local.enlisted = set()
+            self._local.after_commit = []
+        return self._local.frames
+
+    @contextmanager
+    def transaction(self):
+        frames = self._frames()
+        frame = []  # контекстные менеджеры транзакций файлов, открытые на этом уровне
+        for manager in self._local.enlisted:  # уже подключенные файлы получают SAVEPOINT этого уровня
+            cm = manager.transaction()
+            cm.__enter__()
+            frame.append(cm)
+        frames.append(frame)
+        try:
+            yield self
+        except BaseException as e:
+            frames.pop()
+            self._exit_frame(frame, e)
+            if not frames:
+                self._local.enlisted.clear()
+                self._local.after_commit.clear()
+            raise
+        else:
+            frames.pop()
+            self._exit_frame(frame, None)
+            if not frames:
+                self._local.enlisted.clear()
+                after_commit, self._local.after_commit = self._local.after_commit, []
+                for action in after_commit:
+                    action()
+
+    def _exit_frame(self, frame, exc):  # зафиксировать/откатить уровень во всех подключенных файлах
+        error = None
+        for cm in reversed(frame):
+            try:
+                cm.__exit__(type(exc) if exc else None, exc, exc.__traceback__ if exc else None)
+            except Exception as e:  # commit одного файла не удался - остальные откатываются
+                error = error or e
+                exc = e
+        if error is not None:
+            raise error
+
+    def _enlist(self, manager):  # подключить файл ко всем открытым уровням транзакции текущего потока
+        frames = self._frames()
+        if frames and manager not in self._local.enlisted:
+            self._local.enlisted.add(manager)
+            for frame in frames:
+                cm = manager.transaction()
+                cm.__enter__()
+                frame.append(cm)
+        return manager
+
+    def _after_commit(self, action):  # выполнить после фиксации внешней транзакции
+        if self._frames():
+            self._local.after_commit.append(action)
+        else:
+            action()
+
+    # Пользователи - в каталоге
+    def add_user(self, *args, **kwargs):
+        self._enlist(self.connections)
+        super().add_user(*args, **kwargs)
+
+    def update_key_slot(self, *args, **kwargs):
+        self._enlist(self.connections)
+        super().update_key_slot(*args, **kwargs)
+
+    def begin_rotation(self, *args, **kwargs):
+        self._enlist(self.connections)
+        super().begin_rotation(*args, **kwargs)
+
+    def set_rotation_checkpoint(self, user_id, checkpoint):
+        # checkpoint в каталоге, записи - в файле пользователя: при сбое между их commit перешифрованные
+        # записи остаются за checkpoint, и смена ключа пропускает их при продолжении (см. UserManagementSystem)
+        self._enlist(self.connections)
+        super().set_rotation_checkpoint(user_id, checkpoint)
+
+    def finish_rotation(self, user_id):
+        self._enlist(self.connections)
+        super().finish_rotation(user_id)
+
+    def delete_user(self, username):
+        user_id = self.get_user_id(username)
+        self._enlist(self.connections)
+        with self.connections.transaction() as con:
+            con.execute('''DELETE FROM users where username = ?''', (username,))
+        if user_id is not None:
+            self._after_commit(lambda: self._drop_shard(user_id))
+
+    def _drop_shard(self, user_id):  # закрыть и удалить файл пользователя
+        with self._shards_lock:
+            shard = self._shards.pop(user_id, None)
+        if shard:
+            shard.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.shard_path(user_id) + suffix)
+            except FileNotFoundError:
+                pass
+
+    # Записи - в файле пользователя
+    def _open_shards(self):  # все уже открытые файлы
+        with self._shards_lock:
+            return list(self._shards.values())
+
+    def insert_records(self, user_id, records):
+        shard = self._enlist(self._shard(user_id))
+        with shard.transaction() as con:
+            return [con.execute(
+                '''INSERT INTO data (user_id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key)
+                VALUES (?,?,?,?,?)''',
+                (user_id, *record)).lastrowid for record in records]
+
+    def iter_records(self, user_id, after_id, limit):
+        return self._shard(user_id).connect().execute(
+            '''SELECT id, encrypted_data, encrypted_meta, wrapped_key FROM data
+            WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?''',
+            (user_id, after_id, limit)).fetchall()
+
+    def iter_raw_records(self, user_id, after_id, limit):
+        return self._shard(user_id).connect().execute(
+            '''SELECT id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key FROM data
+            WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?''',
+            (user_id, after_id, limit)).fetchall()
+
+    def _owner_shard(self, user_id):  # файл владельца записей: id записей уникальны только внутри файла
+        if user_id is None:
+            raise ValueError('Record owner is required for sharded storage')
+        return self._shard(user_id)
+
+    def get_record_secret(self, user_id, ud_id):
+        return self._owner_shard(user_id).connect().execute(
+            '''SELECT encrypted_data, encrypted_password, wrapped_key FROM data WHERE user_id = ? AND id = ?''',
+            (user_id, ud_id)).fetchone()
+
+    def update_records(self, user_id, records):
+        shard = self._enlist(self._shard(user_id))
+        with shard.transaction() as con:
+            return con.executemany(
+                '''UPDATE data SET encrypted_data = ?, encrypted_meta = ?, encrypted_password = ?, wrapped_key = ?
+                WHERE id = ?''',
+                [(*record, ud_id) for ud_id, *record in records]).rowcount
+
+    def upsert_records(self, user_id, records):
+        shard = self._enlist(self._shard(user_id))
+        with shard.transaction() as con:
+            return con.executemany(
+                '''INSERT INTO data (id, user_id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key)
+                VALUES (?,?,?,?,?,?)
+                ON CONFLICT (id) DO UPDATE SET encrypted_data = excluded.encrypted_data,
+                                               encrypted_meta = excluded.encrypted_meta,
+                                               encrypted_password = excluded.encrypted_password,
+                                               wrapped_key = excluded.wrapped_key''',
+                [(ud_id, user_id, *record) for ud_id, *record in records]).rowcount
+
+    def delete_records(self, user_id, ud_ids):
+        with self._enlist(self._owner_shard(user_id)).transaction() as con:
+            return con.executemany('''DELETE FROM data WHERE user_id = ? AND id = ?''',
+                                   [(user_id, ud_id) for ud_id in ud_ids]).rowcount
+
+    def release(self):
+        super().release()
+        for shard in self._open_shards():
+            shard.release()
+
+    def close(self):
+        for shard in self._open_shards():
+            shard.close()
+        super().close()
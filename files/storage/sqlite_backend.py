@@ -0,0 +1,167 @@
+import sqlite3
+
+from connection import ConnectionManager
+from migrations import migrate
+from storage.base import StorageBackend, UserExistsError
+
+KEY_SLOTS = {  # слот ключа -> столбцы (зашифрованный мастер-ключ, соль, параметры KDF)
+    'passw': ('master_key_passw', 'master_key_passw_salt', 'master_key_passw_kdf'),
+    'pin': ('master_key_pin', 'master_key_pin_salt', 'master_key_pin_kdf'),
+}
+
+ROTATION_SLOTS = ('master_key_passw', 'master_key_passw_salt', 'master_key_passw_kdf',
+                  'master_key_pin', 'master_key_pin_salt', 'master_key_pin_kdf')  # столбцы новых слотов ключа
+
+
+class SQLiteBackend(StorageBackend):
+    """Хранилище в файле SQLite (по умолчанию)
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Атрибуты:
+
+    db_path: str
+        Имя базы данных
+
+    connections: class
+        Менеджер соединений с БД (одно соединение на поток)
+
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connections = ConnectionManager(db_path)
+
+    def init_storage(self):  # применить миграции схемы, ошибки не скрываются
+        migrate(self.connections.connect())
+
+    def transaction(self):
+        return self.connections.transaction()
+
+    def release(self):
+        self.connections.release()
+
+    def close(self):
+        self.connections.close()
+
+    def add_user(self, username, image, master_key_passw, master_key_passw_salt, master_key_pin, master_key_pin_salt,
+                 master_key_passw_kdf=None, master_key_pin_kdf=None):
+        try:
+            with self.connections.transaction() as con:
+                con.execute(
+                    '''INSERT INTO users 
+                    (username, image, master_key_passw, master_key_passw_salt, master_key_pin, master_key_pin_salt,
+                    master_key_passw_kdf, master_key_pin_kdf) 
+                    VALUES (?,?,?,?,?,?,?,?)''',
+                    (username, image, master_key_passw, master_key_passw_salt, master_key_pin, master_key_pin_salt,
+                     master_key_passw_kdf, master_key_pin_kdf))
+        except sqlite3.IntegrityError as e:
+            if str(e) == 'UNIQUE constraint failed: users.username':
+                raise UserExistsError(username) from e
+            raise
+
+    def get_user_id(self, username):
+        user = self.connections.connect().execute('''SELECT id FROM users WHERE username = ?''',
+                                                  (username,)).fetchone()
+        return user[0] if user else None
+
+    def get_key_slot(self, username, slot):
+        key_col, salt_col, kdf_col = KEY_SLOTS[slot]
+        return self.connections.connect().execute(
+            f'''SELECT {key_col}, {salt_col}, {kdf_col} FROM users WHERE username = ?''', (username,)).fetchone()
+
+    def update_key_slot(self, username, slot, master_key_wrapped, salt, kdf=None):
+        key_col, salt_col, kdf_col = KEY_SLOTS[slot]
+        with self.connections.transaction() as con:
+            con.execute(f'''UPDATE users SET {key_col} = ?, {salt_col} = ?, {kdf_col} = ? WHERE username = ?''',
+                        (master_key_wrapped, salt, kdf, username))
+
+    def list_users(self):
+        return self.connections.connect().execute('''SELECT username, image FROM users''').fetchall()
+
+    def delete_user(self, username):
+        with self.connections.transaction() as con:  # данные пользователя удаляются каскадно (ON DELETE CASCADE)
+            con.execute('''DELETE FROM users where username = ?''', (username,))
+
+    def insert_records(self, user_id, records):
+        # по одному INSERT, чтобы вернуть id; запрос берется из кэша подготовленных
+        with self.connections.transaction() as con:
+            return [con.execute(
+                '''INSERT INTO data (user_id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key)
+                VALUES (?,?,?,?,?)''',
+                (user_id, *record)).lastrowid for record in records]
+
+    def iter_records(self, user_id, after_id, limit):
+        return self.connections.connect().execute(
+            '''SELECT id, encrypted_data, encrypted_meta, wrapped_key FROM data
+            WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?''',
+            (user_id, after_id, limit)).fetchall()
+
+    def get_record_secret(self, user_id, ud_id):
+        if user_id is None:
+            return self.connections.connect().execute(
+                '''SELECT encrypted_data, encrypted_password, wrapped_key FROM data WHERE id = ?''',
+                (ud_id,)).fetchone()
+        return self.connections.connect().execute(
+            '''SELECT encrypted_data, encrypted_password, wrapped_key FROM data WHERE id = ? AND user_id = ?''',
+            (ud_id, user_id)).fetchone()
+
+    def update_records(self, user_id, records):
+        with self.connections.transaction() as con:
+            return con.executemany(
+                '''UPDATE data SET encrypted_data = ?, encrypted_meta = ?, encrypted_password = ?, wrapped_key = ?
+                WHERE id = ? AND user_id = ?''',
+                [(*record, ud_id, user_id) for ud_id, *record in records]).rowcount
+
+    def upsert_records(self, user_id, records):
+        with self.connections.transaction() as con:
+            # чужие записи с тем же id не перезаписываются (WHERE в DO UPDATE)
+            return con.executemany(
+                '''INSERT INTO data (id, user_id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key)
+                VALUES (?,?,?,?,?,?)
+                ON CONFLICT (id) DO UPDATE SET encrypted_data = excluded.encrypted_data,
+                                               encrypted_meta = excluded.encrypted_meta,
+                                               encrypted_password = excluded.encrypted_password,
+                                               wrapped_key = excluded.wrapped_key
+                WHERE data.user_id = excluded.user_id''',
+                [(ud_id, user_id, *record) for ud_id, *record in records]).rowcount
+
+    def delete_records(self, user_id, ud_ids):
+        with self.connections.transaction() as con:
+            if user_id is None:
+                return con.executemany('''DELETE FROM data WHERE id = ?''', [(ud_id,) for ud_id in ud_ids]).rowcount
+            return con.executemany('''DELETE FROM data WHERE id = ? AND user_id = ?''',
+                                   [(ud_id, user_id) for ud_id in ud_ids]).rowcount
+
+    def iter_raw_records(self, user_id, after_id, limit):
+        return self.connections.connect().execute(
+            '''SELECT id, encrypted_data, encrypted_meta, encrypted_password, wrapped_key FROM data
+            WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?''',
+            (user_id, after_id, limit)).fetchall()
+
+    def begin_rotation(self, user_id, master_key_new, master_key_passw, master_key_passw_salt, master_key_passw_kdf,
+                       master_key_pin, master_key_pin_salt, master_key_pin_kdf):
+        with self.connections.transaction() as con:
+            con.execute(
+                f'''INSERT INTO key_rotation (user_id, master_key_new, {', '.join(ROTATION_SLOTS)})
+                VALUES (?,?,?,?,?,?,?,?)''',
+                (user_id, master_key_new, master_key_passw, master_key_passw_salt, master_key_passw_kdf,
+                 master_key_pin, master_key_pin_salt, master_key_pin_kdf))
+
+    def get_rotation(self, user_id):
+        return self.connections.connect().execute(
+            f'''SELECT master_key_new, {', '.join(ROTATION_SLOTS)}, checkpoint FROM key_rotation WHERE user_id = ?''',
+            (user_id,)).fetchone()
+
+    def set_rotation_checkpoint(self, user_id, checkpoint):
+        with self.connections.transaction() as con:
+            con.execute('''UPDATE key_rotation SET checkpoint = ? WHERE user_id = ?''', (checkpoint, user_id))
+
+    def finish_rotation(self, user_id):
+        with self.connections.transaction() as con:
+            slots = con.execute(f'''SELECT {', '.join(ROTATION_SLOTS)} FROM key_rotation WHERE user_id = ?''',
+                                (user_id,)).fetchone()
+            if slots:
+                con.execute(f'''UPDATE users SET {', '.join(f'{col} = ?' for col in ROTATION_SLOTS)} WHERE id = ?''',
+                            (*slots, user_id))
+                con.execute('''DELETE FROM key_rotation WHERE user_id = ?''', (user_id,))
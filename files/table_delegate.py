@@ -0,0 +1,64 @@
+from PyQt6.QtCore import Qt, QPointF, QRectF
+from PyQt6.QtGui import QFontMetricsF, QPainter, QPalette, QPixmap
+from PyQt6.QtWidgets import QApplication, QStyle, QStyledItemDelegate, QStyleOptionViewItem
+
+from table_model import PASSWORD_MASK
+
+
+class PasswordDelegate(QStyledItemDelegate):
+    """Делегат столбца паролей
+
+    Маска пароля одинакова во всех строках, поэтому она рисуется один раз в QPixmap (на каждый цвет текста и
+    масштаб экрана), а paint() только рисует фон ячейки средствами стиля и копирует готовую картинку.
+    Роли модели (фон, шрифт, выделение) берутся в копию option через initStyleOption, как у QStyledItemDelegate,
+    но текст ячейки не раскладывается и не рисуется.
+    Редактирование - как у QStyledItemDelegate (EditRole модели отдает настоящий пароль).
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Атрибуты:
+
+    margin: int
+        Отступ маски от левого края ячейки, px
+
+    """
+
+    def __init__(self, parent=None, margin=4):
+        super().__init__(parent)
+        self.margin = margin
+        self._font = None  # шрифт ячеек модели (FontRole), берется при первой отрисовке
+        self._pixmaps = dict()  # (цвет текста, масштаб экрана) -> QPixmap маски
+
+    def paint(self, painter, option, index):
+        opt = QStyleOptionViewItem(option)  # option общий для всех ячеек - роли модели заполняются в копии
+        self.initStyleOption(opt, index)
+        widget = opt.widget
+        style = widget.style() if widget else QApplication.style()
+        style.drawPrimitive(QStyle.PrimitiveElement.PE_PanelItemViewItem, opt, painter, widget)  # фон, выделение
+        selected = opt.state & QStyle.StateFlag.State_Selected
+        color = opt.palette.color(QPalette.ColorRole.HighlightedText if selected else QPalette.ColorRole.Text)
+        if self._font is None:
+            self._font = opt.font  # с учетом FontRole модели
+        pixmap = self._mask_pixmap(color, painter.device().devicePixelRatioF())
+        rect = opt.rect
+        height = pixmap.height() / pixmap.devicePixelRatioF()
+        painter.drawPixmap(QPointF(rect.x() + self.margin, rect.y() + (rect.height() - height) / 2), pixmap)
+
+    def _mask_pixmap(self, color, ratio):  # маска пароля цветом color (рисуется один раз)
+        key = (color.rgba(), ratio)
+        pixmap = self._pixmaps.get(key)
+        if pixmap is None:
+            metrics = QFontMetricsF(self._font)
+            width, height = metrics.horizontalAdvance(PASSWORD_MASK), metrics.height()
+            pixmap = QPixmap(round(width * ratio) + 1, round(height * ratio) + 1)
+            pixmap.setDevicePixelRatio(ratio)
+            pixmap.fill(Qt.GlobalColor.transparent)
+            mask_painter = QPainter(pixmap)
+            mask_painter.setRenderHint(QPainter.RenderHint.TextAntialiasing)
+            mask_painter.setFont(self._font)
+            mask_painter.setPen(color)
+            mask_painter.drawText(QRectF(0, 0, width, height),
+                                  Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter, PASSWORD_MASK)
+            mask_painter.end()
+            self._pixmaps[key] = pixmap
+        return pixmap
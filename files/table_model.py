@@ -1,63 +1,461 @@
-from PyQt6.QtCore import Qt, QAbstractTableModel, QVariant, QModelIndex
+import locale
+import re
+import sys
+from array import array
+from functools import lru_cache
+
+from PyQt6.QtCore import Qt, QAbstractProxyModel, QAbstractTableModel, QVariant, QModelIndex, pyqtSignal
 from PyQt6.QtGui import QFont
 
+from config import COLLATION_CACHE_SIZE
+
+# роли и готовые значения: data() вызывается для каждой видимой ячейки при каждой перерисовке
+DISPLAY_ROLE = Qt.ItemDataRole.DisplayRole
+EDIT_ROLE = Qt.ItemDataRole.EditRole
+TOOLTIP_ROLE = Qt.ItemDataRole.ToolTipRole
+FONT_ROLE = Qt.ItemDataRole.FontRole
+ALIGNMENT_ROLE = Qt.ItemDataRole.TextAlignmentRole
+DESCENDING = Qt.SortOrder.DescendingOrder
+PASSWORD_MASK = '••••••••'
+CELL_ALIGNMENT = Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter
+NO_DATA = QVariant()
+NUMBER = re.compile(r'([0-9]+)')
+RELAYOUT_SCAN_LIMIT = 16  # до стольких сохраненных индексов их новые места ищутся перебором массива
+NUMBER_MARK = '\x00'  # меньше любого символа strxfrm: число идет раньше текста на том же месте
+
+
+@lru_cache(maxsize=COLLATION_CACHE_SIZE)
+def collation_key(value):  # ключ сортировки: без регистра, по правилам локали (LC_COLLATE), числа - по величине
+    if value is None:
+        return ''
+    key = []
+    for i, part in enumerate(NUMBER.split(value.casefold())):
+        if i % 2:  # число: метка, длина без ведущих нулей, цифры - 'file9' раньше 'file10'
+            digits = part.lstrip('0') or '0'
+            key.append(NUMBER_MARK + chr(len(digits) + 1) + digits)
+        elif part:
+            key.append(locale.strxfrm(part))
+    return ''.join(key)
+
+
+def _font(point_size):  # шрифт таблицы (создается после QApplication, поэтому не на уровне модуля)
+    font = QFont()
+    font.setPointSize(point_size)
+    font.setFamily("Bahnschrift Light")
+    return font
+
 
 class TableModel(QAbstractTableModel):
-    """Базовый класс абстрактной модели таблицы"""
+    """Базовый класс абстрактной модели таблицы
+
+    Строки можно подгружать лениво: set_pages(pages) принимает итератор страниц (списков пар (id, строка)),
+    а Qt запрашивает следующую страницу через canFetchMore/fetchMore по мере прокрутки.
+
+    Правки ячеек (setData) сообщаются сигналом rowEdited(id, значения строки) для записи в БД.
+    Добавленные и удаленные записи меняют модель точечно (insert_rows, remove_ids) без перезагрузки;
+    строка, уже добавленная через insert_rows, при подгрузке следующей страницы не повторяется.
+
+    Пароль в строке может быть None - тогда он расшифровывается только при обращении
+    (EditRole, ToolTipRole, password(row)) через password_loader(id) и в модели не хранится.
+
+    Данные хранятся по столбцам: список значений на столбец и массив id, без объекта-списка на строку.
+    Повторяющиеся описания и логины интернируются (пароли - нет). Шрифты создаются один раз.
+
+    Для столбцов, кроме паролей, при загрузке строк вычисляются ключи сортировки (collation_key): sort_rows
+    упорядочивает массив номеров строк сравнением готовых строк-ключей, без data() и QVariant.
+    """
+
+    fetchFailed = pyqtSignal(str)  # ошибка при загрузке очередной страницы
+    rowEdited = pyqtSignal(int, object)  # id записи и список значений строки после правки
 
     def __init__(self, headers=None, rows=None, parent=None):
         super().__init__(parent)
         self._headers = headers or []
-        self._rows = rows or []
+        self._columns = [[] for _ in self._headers]  # значения по столбцам
+        self._keys = [[] for _ in self._headers]  # ключи сортировки по столбцам (у паролей - пусто)
+        self._ids = array('q')  # id записей в БД, параллельно строкам столбцов
+        self._added = set()  # id строк, добавленных insert_rows до загрузки всех страниц
+        self._pages = None  # итератор еще не загруженных страниц
         self.password_col = 2
+        self.password_loader = None  # функция id -> пароль для нерасшифрованных паролей
+        self._cell_font = None
+        self._header_font = None
+        if rows:
+            self._append(enumerate(rows))
 
     # Базовая «двумерность»
-    def rowCount(self, parent=None):
-        return len(self._rows)
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._ids)
 
-    def columnCount(self, parent=None):
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
         return len(self._headers)
 
+    # Ленивая подгрузка
+    def set_pages(self, pages):  # заменить строки итератором страниц
+        self.beginResetModel()
+        self._columns = [[] for _ in self._headers]
+        self._keys = [[] for _ in self._headers]
+        self._ids = array('q')
+        self._added = set()
+        self._pages = iter(pages)
+        self.endResetModel()
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._pages is not None
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        try:
+            page = next(self._pages)
+        except StopIteration:
+            self._pages = None
+            self._added = set()
+            return
+        except Exception as e:
+            self._pages = None
+            self.fetchFailed.emit(str(e))
+            return
+        if self._added:
+            page = [(row_id, row) for row_id, row in page if row_id not in self._added]
+        self._insert(page)
+
+    # Точечные изменения
+    def insert_rows(self, rows):  # добавить строки [(id, строка), ...] в конец таблицы
+        rows = list(rows)
+        if self._pages is not None:  # эти записи встретятся и в еще не загруженных страницах
+            self._added.update(row_id for row_id, _ in rows)
+        self._insert(rows)
+
+    def _insert(self, rows):
+        if not rows:
+            return
+        start = len(self._ids)
+        self.beginInsertRows(QModelIndex(), start, start + len(rows) - 1)
+        self._append(rows)
+        self.endInsertRows()
+
+    def _append(self, rows):  # дописать строки в столбцы (и ключи сортировки)
+        intern, password_col, keys = sys.intern, self.password_col, self._keys
+        for row_id, row in rows:
+            self._ids.append(row_id)
+            for col, (column, value) in enumerate(zip(self._columns, row)):
+                if col == password_col:
+                    column.append(value)
+                    continue
+                if type(value) is str:
+                    value = intern(value)
+                column.append(value)
+                keys[col].append(collation_key(value))
+
+    def remove_ids(self, ids):  # удалить строки записей ids (подряд идущие - одним beginRemoveRows)
+        ids = set(ids)
+        ranges = []
+        for i, row_id in enumerate(self._ids):
+            if row_id in ids:
+                if ranges and ranges[-1][1] == i - 1:
+                    ranges[-1][1] = i
+                else:
+                    ranges.append([i, i])
+        for first, last in reversed(ranges):  # с конца - индексы предыдущих диапазонов не сдвигаются
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self._ids[first:last + 1]
+            for column in self._columns + self._keys:
+                del column[first:last + 1]
+            self.endRemoveRows()
+
+    def row_id(self, row):  # id записи в БД
+        return self._ids[row]
+
+    def row_ids(self):  # id записей по строкам (массив модели - только для чтения)
+        return self._ids
+
+    def row_of(self, row_id):  # номер строки записи row_id (-1, если ее нет в модели)
+        try:
+            return self._ids.index(row_id)
+        except ValueError:
+            return -1
+
+    def sort_rows(self, rows, column, order):  # номера строк rows по ключам столбца column (устойчиво)
+        if column == self.password_col or not 0 <= column < len(self._keys):
+            return array('q', rows)  # пароли в модели не хранятся - порядок не меняется
+        keys = self._keys[column]
+        return array('q', sorted(rows, key=keys.__getitem__, reverse=order == DESCENDING))
+
+    def row_values(self, row):  # значения строки row списком
+        return [column[row] for column in self._columns]
+
+    def password(self, row):  # пароль строки row (расшифровывается по запросу)
+        password = self._columns[self.password_col][row]
+        if password is None and self.password_loader:
+            return self.password_loader(self._ids[row])
+        return password
+
     # Данные на экран
-    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+    def data(self, index, role=DISPLAY_ROLE):
         if not index.isValid():
-            return QVariant()
-
-        if role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
-            if index.column() == self.password_col:
-                if role == Qt.ItemDataRole.DisplayRole:
-                    return "••••••••"
-                elif role == Qt.ItemDataRole.EditRole:
-                    return self._rows[index.row()][index.column()]  # Реальный пароль для редактирования
-            else:
-                return self._rows[index.row()][index.column()]
+            return NO_DATA
+        column = index.column()
+
+        if role == DISPLAY_ROLE:
+            return PASSWORD_MASK if column == self.password_col else self._columns[column][index.row()]
+        elif role == FONT_ROLE:
+            if self._cell_font is None:
+                self._cell_font = _font(11)
+            return self._cell_font
+        elif role == ALIGNMENT_ROLE:
+            return CELL_ALIGNMENT
+        elif role == EDIT_ROLE:
+            if column == self.password_col:
+                return self.password(index.row())  # Реальный пароль для редактирования
+            return self._columns[column][index.row()]
 
         # Показывать реальный пароль в подсказке
-        elif role == Qt.ItemDataRole.ToolTipRole and index.column() == self.password_col:
-            return f"Password: {self._rows[index.row()][index.column()]}"
-        elif role == Qt.ItemDataRole.FontRole:
-            font = QFont()
-            font.setPointSize(11)
-            font.setFamily("Bahnschrift Light")
-            return font
-        return QVariant()
+        elif role == TOOLTIP_ROLE and column == self.password_col:
+            password = self.password(index.row())
+            return f"Password: {password}" if password is not None else NO_DATA
+        return NO_DATA
 
     # Заголовки
-    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
-        if role == Qt.ItemDataRole.DisplayRole:
+    def headerData(self, section, orientation, role=DISPLAY_ROLE):
+        if role == DISPLAY_ROLE:
             if orientation == Qt.Orientation.Horizontal and 0 <= section < len(self._headers):
                 return self._headers[section]
             return section + 1
-        elif role == Qt.ItemDataRole.FontRole:
-            font = QFont()
-            font.setFamily("Bahnschrift Light")
-            font.setPointSize(10)
-            return font
-        return QVariant()
-
-    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
-        if role == Qt.ItemDataRole.EditRole and index.isValid():
-            self._rows[index.row()][index.column()] = str(value)
+        elif role == FONT_ROLE:
+            if self._header_font is None:
+                self._header_font = _font(10)
+            return self._header_font
+        return NO_DATA
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+        return super().flags(index) | Qt.ItemFlag.ItemIsEditable
+
+    def setData(self, index, value, role=EDIT_ROLE):
+        if role == EDIT_ROLE and index.isValid():
+            column, row = index.column(), index.row()
+            value = str(value)
+            if self._columns[column][row] == value:
+                return False
+            if column == self.password_col:
+                self._columns[column][row] = value
+            else:
+                self._columns[column][row] = sys.intern(value)
+                self._keys[column][row] = collation_key(value)
             self.dataChanged.emit(index, index, [role])
+            self.rowEdited.emit(self._ids[row], self.row_values(row))
             return True
-        return False
\ No newline at end of file
+        return False
+
+
+class TableProxyModel(QAbstractProxyModel):
+    """Прокси таблицы: фильтр по множеству id и сортировка без опроса data() для каждой строки
+
+    Порядок показа хранится массивом номеров строк модели. Фильтр - множество id показываемых записей
+    (результат поиска по search_index.TrigramIndex; None - все строки): строки найденных id берутся из словаря
+    id -> строка и упорядочиваются по месту в сортировке, без прохода по всем строкам.
+    Сортировку выполняет модель (TableModel.sort_rows) над тем же массивом по готовым ключам; она устойчивая
+    и сортирует текущий порядок, поэтому прежняя сортировка сохраняется внутри равных значений: щелчок
+    по Username, затем по Description - описания по алфавиту, одинаковые - по логину. Новые строки модели
+    (подгрузка страниц, добавление) сразу проходят фильтр и занимают место по текущей сортировке.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._ids = None  # id показываемых строк; None - без фильтра
+        self._order = array('q')  # все строки модели в порядке сортировки
+        self._rows = array('q')  # показываемые строки модели (фильтр поверх _order)
+        self._positions = None  # строка модели -> строка прокси (-1 - скрыта), строится по запросу
+        self._ranks = None  # строка модели -> место в _order, строится по запросу
+        self._rows_by_id = None  # id записи -> строка модели, строится по запросу
+        self._sort_column = -1
+        self._sort_order = Qt.SortOrder.AscendingOrder
+
+    def setSourceModel(self, model):
+        self.beginResetModel()
+        super().setSourceModel(model)
+        model.modelAboutToBeReset.connect(self.beginResetModel)
+        model.modelReset.connect(self._on_reset)
+        model.rowsInserted.connect(self._on_rows_inserted)
+        model.rowsAboutToBeRemoved.connect(self._on_rows_about_to_be_removed)
+        model.rowsRemoved.connect(self._on_rows_removed)
+        model.dataChanged.connect(self._on_data_changed)
+        self._set_order(self._sorted(range(model.rowCount())))
+        self._rows_by_id = None
+        self.endResetModel()
+
+    # Фильтр и сортировка
+    def set_ids(self, ids):  # показать только записи с id из ids (None - все)
+        if ids is None and self._ids is None:
+            return
+        self.beginResetModel()
+        self._ids = ids
+        self._rows = self._visible()
+        self._positions = None
+        self.endResetModel()
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        if (column, order) == (self._sort_column, self._sort_order):
+            return  # порядок уже такой: новые строки сортируются при вставке
+        self._sort_column, self._sort_order = column, order
+        self._relayout(self._sorted(self._order))
+
+    def _filtered(self, rows):  # строки rows, прошедшие фильтр (проход по rows - для немногих строк)
+        if self._ids is None:
+            return array('q', rows)
+        ids, row_ids = self._ids, self.sourceModel().row_ids()
+        return array('q', [row for row in rows if row_ids[row] in ids])
+
+    def _visible(self):  # показываемые строки в порядке _order
+        if self._ids is None:
+            return array('q', self._order)
+        if self._rows_by_id is None:
+            row_ids = self.sourceModel().row_ids()
+            self._rows_by_id = dict(zip(row_ids, range(len(row_ids))))
+        rows_by_id = self._rows_by_id
+        rows = [rows_by_id[row_id] for row_id in self._ids if row_id in rows_by_id]
+        if self._sort_column < 0:
+            rows.sort()  # _order - порядок модели
+        else:
+            if self._ranks is None:
+                ranks = array('q', [0]) * len(self._order)
+                for rank, row in enumerate(self._order):
+                    ranks[row] = rank
+                self._ranks = ranks
+            rows.sort(key=self._ranks.__getitem__)
+        return array('q', rows)
+
+    def _set_order(self, order):  # новый порядок всех строк и показываемые строки по нему
+        self._order = order
+        self._ranks = None
+        self._rows = self._visible()
+        self._positions = None
+
+    def _sorted(self, rows):  # строки rows в порядке текущей сортировки
+        if self._sort_column < 0:
+            return array('q', sorted(rows))  # порядок модели
+        return self.sourceModel().sort_rows(rows, self._sort_column, self._sort_order)
+
+    def _relayout(self, order):  # новый порядок строк: сохраненные индексы представления переносятся
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        sources = [self.mapToSource(index) for index in persistent]
+        self._set_order(order)
+        if len(persistent) <= RELAYOUT_SCAN_LIMIT:  # текущая ячейка и выделение: поиск в массиве без словаря
+            moved = [self.index(self._find(index.row()), index.column()) if index.isValid() else QModelIndex()
+                     for index in sources]
+        else:
+            moved = [self.mapFromSource(index) for index in sources]
+        self.changePersistentIndexList(persistent, moved)
+        self.layoutChanged.emit()
+
+    def _find(self, source_row):  # строка прокси для строки модели поиском в массиве (-1 - скрыта)
+        try:
+            return self._rows.index(source_row)
+        except ValueError:
+            return -1
+
+    def _position(self, source_row):  # строка прокси для строки модели (-1 - скрыта)
+        if self._positions is None:
+            positions = array('q', [-1]) * self.sourceModel().rowCount()
+            for position, row in enumerate(self._rows):
+                positions[row] = position
+            self._positions = positions
+        return self._positions[source_row] if source_row < len(self._positions) else -1
+
+    # Изменения модели
+    def _on_reset(self):
+        self._rows_by_id = None
+        self._set_order(self._sorted(range(self.sourceModel().rowCount())))
+        self.endResetModel()
+
+    def _on_rows_inserted(self, parent, first, last):
+        count = last - first + 1
+        if first < self.sourceModel().rowCount() - count:  # вставка не в конец - номера после first сдвигаются
+            self._order = array('q', [row + count if row >= first else row for row in self._order])
+            self._rows = array('q', [row + count if row >= first else row for row in self._rows])
+            self._rows_by_id = None
+        elif self._rows_by_id is not None:
+            row_ids = self.sourceModel().row_ids()
+            self._rows_by_id.update((row_ids[row], row) for row in range(first, last + 1))
+        self._order.extend(range(first, last + 1))
+        self._ranks = None
+        added = self._filtered(range(first, last + 1))
+        self._positions = None
+        if added:
+            start = len(self._rows)
+            self.beginInsertRows(QModelIndex(), start, start + len(added) - 1)
+            self._rows.extend(added)
+            self.endInsertRows()
+        if self._sort_column >= 0:  # новые строки - на места по сортировке
+            self._relayout(self._sorted(self._order))
+
+    def _on_rows_about_to_be_removed(self, parent, first, last):  # убрать строки прокси до удаления из модели
+        positions = sorted(position for position in map(self._position, range(first, last + 1)) if position >= 0)
+        ranges = []
+        for position in positions:
+            if ranges and ranges[-1][1] == position - 1:
+                ranges[-1][1] = position
+            else:
+                ranges.append([position, position])
+        for start, end in reversed(ranges):
+            self.beginRemoveRows(QModelIndex(), start, end)
+            del self._rows[start:end + 1]
+            self._positions = None
+            self.endRemoveRows()
+
+    def _on_rows_removed(self, parent, first, last):  # номера строк модели после удаленных сдвигаются
+        count = last - first + 1
+        self._order = array('q', [row - count if row > last else row
+                                  for row in self._order if row < first or row > last])
+        self._rows = array('q', [row - count if row > last else row for row in self._rows])
+        self._positions = None
+        self._ranks = None
+        self._rows_by_id = None
+
+    def _on_data_changed(self, top_left, bottom_right, roles):
+        for row in range(top_left.row(), bottom_right.row() + 1):
+            position = self._position(row)
+            if position >= 0:
+                self.dataChanged.emit(self.index(position, top_left.column()),
+                                      self.index(position, bottom_right.column()), roles)
+        if top_left.column() <= self._sort_column <= bottom_right.column():  # правка сдвигает строку по сортировке
+            self._relayout(self._sorted(self._order))
+
+    # Отображение индексов
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or not 0 <= row < len(self._rows) or not 0 <= column < self.columnCount():
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=QModelIndex()):
+        return QModelIndex()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.sourceModel().columnCount()
+
+    def mapToSource(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        return self.sourceModel().index(self._rows[index.row()], index.column())
+
+    def mapFromSource(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        position = self._position(index.row())
+        return self.index(position, index.column()) if position >= 0 else QModelIndex()
+
+    def data(self, index, role=DISPLAY_ROLE):  # сразу в модель, без обратного вызова mapToSource из Qt
+        if not index.isValid():
+            return NO_DATA
+        model = self.sourceModel()
+        return model.data(model.index(self._rows[index.row()], index.column()), role)
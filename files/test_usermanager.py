@@ -0,0 +1,36 @@
+"""Тесты UserManagementSystem (запуск из папки files: python -m unittest)"""
+import unittest
+
+from record_codec import FIELD_IDS, RECORD_VERSION, encode_record
+from storage.memory_backend import MemoryBackend
+from usermanager import UserManagementSystem
+
+
+class DecryptDataBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.um = UserManagementSystem(backend=MemoryBackend(), crypto_workers=0)
+        self.master_key = self.um.crypto.get_master_key()
+
+    def tearDown(self):
+        self.um.close()
+
+    def _rows(self, plaintexts):  # строки (encrypted_data, encrypted_meta, wrapped_key) записей одним блоком
+        return [(encr_datum, None, wrapped_key) for wrapped_key, (encr_datum,) in
+                self.um.crypto.seal_many([(plaintext,) for plaintext in plaintexts], self.master_key)]
+
+    def test_corrupt_record_does_not_fail_batch(self):
+        # битая запись разбирается из общего буфера расшифровки, следующие записи больше - буфер расширяется
+        bad_utf8 = bytes((RECORD_VERSION, 1, FIELD_IDS['name'], 0, 2)) + b'\xff\xfe'
+        truncated = encode_record({'name': 'site', 'username': 'user'})[:-3]
+        valid = [{'name': f'site{i}', 'username': 'user' * 50 * i, 'password': 'p' * 100 * i} for i in range(1, 4)]
+        plaintexts = [bad_utf8, encode_record(valid[0]), truncated] + [encode_record(datum) for datum in valid[1:]]
+        data = self.um.decrypt_data_batch(self._rows(plaintexts), self.master_key)
+        self.assertEqual(len(data), 5)
+        for error in (data[0], data[2]):
+            self.assertIsInstance(error, ValueError)
+            self.assertIsNone(error.__traceback__)  # ошибка не держит срезы буфера
+        self.assertEqual([data[1], *data[3:]], valid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,15 @@
-import json
-import sqlite3
+import hashlib
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from crypto import CryptographySystem
-from config import DATABASE_NAME
+from crypto import MASTER_KEY_SIZE, CryptographySystem
+from crypto_worker import CryptoWorkerPool
+from record_codec import decode_record, encode_record
+from config import DATABASE_NAME, DATA_PAGE_SIZE, DATA_STORAGE_MODE, DECRYPT_WORKERS, DECRYPT_CHUNK_SIZE
+from config import CRYPTO_WORKERS, ROTATION_CHUNK_SIZE, STORAGE_BACKEND
+from storage import UserExistsError, create_backend
+from writer import DatabaseWriter
 
 class UserManagementSystem:
     """Класс менеджера учетных данных
@@ -17,210 +24,655 @@ class UserManagementSystem:
         db_path: str
             Имя базы данных
 
+        storage_mode: str
+            Режим записи данных: 'split' - метаданные и пароль шифруются отдельно, 'blob' - одним блоком
+
         crypto: class
-            Экземпляр системы шифрования
+            Экземпляр системы шифрования (с пулом процессов шифрования при crypto_workers > 0)
+
+        backend: class
+            Хранилище зашифрованных данных (см. storage; по умолчанию SQLite)
+
+        writer: class
+            Фоновый поток записи в БД (см. submit)
+
+        decrypt_workers: int
+            Размер пула потоков для расшифровки (cryptography отпускает GIL на время работы OpenSSL)
 
         ---------------------------------------------------------------------------------------------------------------
         Методы:
 
         init_database()
-            Создает (если не существует) базу данных с данными пользователей
+            Создает хранилище с данными пользователей или обновляет его структуру (для SQLite - см. migrations)
 
         register_user(username, password, pin)
-            Создает учетную запись пользователя и записывает в БД
+            Создает учетную запись пользователя и записывает в БД. Ключи вырабатываются в вызывающем потоке
+            (не в потоке записи - см. run_task), в поток записи уходит только строка users
 
         get_master_key_with_pin(username, pin)
             Возвращает результат расшифровки мастер-ключа
 
         get_master_key_with_password(username, passw)
-            Возвращает результат расшифровки мастер-ключа
+            Возвращает результат расшифровки мастер-ключа. После успешного входа слот ключа со старым
+            набором шифрования или заметно отличающимися параметрами KDF перешифровывается в фоне
+
+        change_password(username, master_key, new_passw)
+            Меняет пароль: мастер-ключ (из сессии) шифруется ключом нового пароля, данные не перешифровываются.
+            Ключ вырабатывается в вызывающем потоке (не в потоке записи - см. run_task), в поток записи уходит
+            только сохранение слота. Во время смены мастер-ключа сразу возвращает ошибку, не дожидаясь ее конца
+
+        change_pin(username, master_key, new_pin)
+            Меняет PIN-код так же, как change_password
+
+        start_key_rotation(username, master_key, passw, pin)
+            Начинает смену мастер-ключа: проверяет пароль и PIN-код, сохраняет новый мастер-ключ (под старым)
+            и новые слоты ключа; записи и сами слоты пока не меняются
+
+        rotate_master_key(username, master_key, chunk_size)
+            Переводит все записи на новый мастер-ключ порциями по chunk_size строк (порция и контрольная
+            точка - одна транзакция): у конвертов перешифровываются только ключи данных, записи прежних версий
+            без ключа данных запечатываются заново. В конце одной транзакцией заменяет слоты ключа. После сбоя
+            или закрытия продолжает с контрольной точки. Возвращает (True, новый мастер-ключ); старый ключ
+            больше не принимается (в памяти остается только его SHA-256)
+
+        has_pending_rotation(username)
+            Проверяет, есть ли у пользователя незавершенная смена мастер-ключа
+
+        run_in_background(func, *args, **kwargs)
+            Выполняет долгое задание (смена мастер-ключа) в отдельном потоке и возвращает Future
+
+        run_task(func, *args, **kwargs)
+            Выполняет короткое задание (регистрация, смена пароля или PIN-кода) в фоновом пуле и возвращает
+            Future; в отличие от run_in_background не ждет завершения смены мастер-ключа
 
         get_users_list()
             Возвращает список пользователей
 
+        submit(func, *args, **kwargs)
+            Ставит метод записи func в очередь фонового писателя и возвращает Future с его результатом
+
+        transaction()
+            Контекстный менеджер единицы работы: все записи внутри одного блока with - одна транзакция
+
         write_user_data(username, master_key, data)
-            Записывает словарь data в БД под пользователем username
+            Записывает словари data в БД под пользователем username
 
-        read_user_data(username, master_key)
+        insert_many(username, master_key, data)
+            Как write_user_data, но возвращает (True, [id новых записей]) в порядке data
+
+        update_many(username, master_key, data)
+            Перезаписывает записи [(ud_id, datum), ...] пользователя username
+            (если datum['password'] is None, сохраняется прежний пароль)
+
+        upsert_many(username, master_key, data)
+            Обновляет записи с указанным id и добавляет записи с ud_id = None
+
+        delete_many(username, ud_ids)
+            Удаляет записи пользователя username с id из ud_ids
+
+        encrypt_datum(datum, master_key)
+            Шифрует запись datum для записи в БД согласно storage_mode
+
+        encrypt_data_batch(data, master_key)
+            Шифрует набор записей конвертами: у каждой записи свой ключ данных, мастер-ключом шифруются
+            только ключи данных (одним набором). Записи кодируются двоичным форматом record_codec
+
+        decrypt_datum(encrypted_data, encrypted_meta, master_key, wrapped_key)
+            Расшифровывает запись без пароля (для записей одним блоком - целиком)
+
+        decrypt_data_batch(rows, master_key)
+            Расшифровывает набор записей (ключи данных - одним набором, ошибка строки - на ее месте);
+            записи прежних версий в JSON читаются так же
+
+        read_user_data(username, master_key, errors)
             Возвращает данные пользователя username из БД
 
-        delete_user_data(u_id)
-            Удаляет данные пользователя с внутренним id = u_id
+        iter_user_data(username, master_key, page_size, after_id, errors)
+            Генератор страниц данных пользователя username (keyset-пагинация по data.id)
+
+        decrypt_rows(rows, master_key, errors)
+            Параллельно расшифровывает строки (id, encrypted_data, encrypted_meta) с сохранением порядка
+
+        read_user_password(ud_id, master_key, username)
+            Возвращает пароль записи пользователя username с внутренним id = ud_id (расшифровывается только он)
+
+        delete_user_data(username, ud_id)
+            Удаляет запись пользователя username с внутренним id = ud_id
 
         delete_user(username)
             Удаляет пользователя и все данные, связанные с ним
 
+        close()
+            Останавливает смену мастер-ключа после текущей порции, закрывает фоновый пул, дописывает очередь
+            фоновой записи, закрывает хранилище и пул шифрования
+
         """
 
-    def __init__(self, db_path=DATABASE_NAME):
+    def __init__(self, db_path=DATABASE_NAME, storage_mode=DATA_STORAGE_MODE, decrypt_workers=DECRYPT_WORKERS,
+                 backend=None, crypto_workers=CRYPTO_WORKERS):
         self.db_path = db_path
-        self.crypto = CryptographySystem()
+        self.storage_mode = storage_mode
+        # пул процессов шифрования запускается один раз, при создании менеджера (старте приложения)
+        self.crypto = CryptographySystem(worker=CryptoWorkerPool(crypto_workers) if crypto_workers else None)
+        self.backend = backend or create_backend(STORAGE_BACKEND, db_path)
+        self.decrypt_workers = decrypt_workers
+        self._executor = None  # фоновый пул (расшифровка, перешифровка слотов, регистрация), создается по требованию
+        self._jobs = None  # поток долгих заданий (смена мастер-ключа), создается по требованию
+        self._closing = threading.Event()  # сигнал долгим заданиям остановиться
+        self._retired_keys = set()  # SHA-256 мастер-ключей, замененных сменой (сами ключи не хранятся)
         self.init_database()
+        self.writer = DatabaseWriter(self.transaction, self.backend.release)
+        self.writer.start()
 
-    def init_database(self):
-        try:
-            con = sqlite3.connect(self.db_path)
-            cur = con.cursor()
-            command1 = '''CREATE TABLE IF NOT EXISTS users (
-        id                    INTEGER PRIMARY KEY ON CONFLICT ROLLBACK AUTOINCREMENT,
-        username              TEXT    UNIQUE
-                                      NOT NULL
-                                      ON CONFLICT ROLLBACK,
-        image                 BLOB            ,
-        master_key_passw      BLOB    NOT NULL,
-        master_key_passw_salt BLOB    NOT NULL,
-        master_key_pin        BLOB    NOT NULL,
-        master_key_pin_salt   BLOB    NOT NULL
-    );'''
-            cur.execute(command1)  # создаем бд пользователей
-            command2 = '''CREATE TABLE IF NOT EXISTS data (
-        id             INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id        INTEGER NOT NULL
-                               REFERENCES users (id),
-        encrypted_data BLOB    NOT NULL
-    );
-    '''
-            cur.execute(command2)  # создаем бд учетных данных
-            con.commit()
-            con.close()
-        except Exception:
-            pass
+    def init_database(self):  # создать/обновить хранилище, ошибки не скрываются
+        self.backend.init_storage()
 
     def register_user(self, username, password, pin, image=None):  # регистрируем пользователя
+        # обе выработки ключа - здесь, вне транзакции: поток записи занят только добавлением строки users
+        if self.backend.get_user_id(username) is not None:
+            return False, f'Username {username} is already registered'
         userdata = self.crypto.derive_userdata(password=password, pin=pin)
         # passw_key, passw_key_salt, pin_key, pin_key_salt = userdata
+        return self.submit(self._add_user, username, image, userdata, self.crypto.kdf).result()
+
+    def _add_user(self, username, image, userdata, kdf):  # в потоке записи
         try:
-            con = sqlite3.connect(self.db_path)
-            cur = con.cursor()
-            if image:
-                cur.execute(
-                    '''INSERT INTO users 
-                    (username, image, master_key_passw, master_key_passw_salt, master_key_pin, master_key_pin_salt) 
-                    VALUES (?,?,?,?,?,?)''',
-                    (username, image, *userdata))
-            else:
-                cur.execute(
-                    '''INSERT INTO users 
-                    (username, master_key_passw, master_key_passw_salt, master_key_pin, master_key_pin_salt) 
-                    VALUES (?,?,?,?,?)''',
-                    (username, *userdata))
-            con.commit()
-            con.close()
-        except sqlite3.IntegrityError as e:
-            if str(e) == 'UNIQUE constraint failed: users.username':
-                return False, f'Username {username} is already registered'
-            else:
-                return False, f'SQL Error: {str(e)}'
+            self.backend.add_user(username, image or None, *userdata, master_key_passw_kdf=kdf, master_key_pin_kdf=kdf)
+        except UserExistsError:
+            return False, f'Username {username} is already registered'
+        except Exception as e:
+            return False, f'Storage error: {str(e)}'
         else:
             return True, f'User {username} successfully registered'
 
     def get_master_key_with_pin(self, username, pin=None):  # расшифровать мастер-ключ
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
         if pin:
-            cur.execute('''SELECT master_key_pin, master_key_pin_salt FROM users WHERE username = ?''', (username,))
-            userdata = cur.fetchone()
-            key = self.crypto.derive_key(pin, userdata[1])
+            userdata = self.backend.get_key_slot(username, 'pin')
+            if not userdata:
+                return False, f'User {username} not found'
+            key = self.crypto.derive_key(pin, userdata[1], userdata[2])
         else:
             return False, 'Enter correct PIN'
         try:
-            master_key = self.crypto.decrypt_data(userdata[0], key)
-            return True, master_key
+            master_key = self.crypto.decrypt_master_key(userdata[0], key)
         except ValueError:
             return False, 'Incorrect PIN, try again'
+        self._upgrade_key_slot(username, 'pin', pin, userdata, key, master_key)
+        return True, master_key
 
     def get_master_key_with_password(self, username, passw=None):  # расшифровать мастер-ключ
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
         if passw:
-            cur.execute('''SELECT master_key_passw, master_key_passw_salt FROM users WHERE username = ?''', (username,))
-            userdata = cur.fetchone()
-            key = self.crypto.derive_key(passw, userdata[1])
+            userdata = self.backend.get_key_slot(username, 'passw')
+            if not userdata:
+                return False, f'User {username} not found'
+            key = self.crypto.derive_key(passw, userdata[1], userdata[2])
         else:
             return False, 'Enter correct password'
         try:
-            master_key = self.crypto.decrypt_data(userdata[0], key)
-            return True, master_key
+            master_key = self.crypto.decrypt_master_key(userdata[0], key)
+        except ValueError:
+            return False, 'Incorrect password, try again'
+        self._upgrade_key_slot(username, 'passw', passw, userdata, key, master_key)
+        return True, master_key
+
+    def _upgrade_key_slot(self, username, slot, secret, userdata, key, master_key):  # перешифровать старый слот
+        if len(master_key) != MASTER_KEY_SIZE:  # ключ не проверен - слот не трогаем, иначе секрет потерян
+            return
+        if self.crypto.kdf_needs_upgrade(userdata[2]):  # новые параметры KDF - новая соль и ключ, вход не ждет
+            self._get_executor().submit(self._rewrap_key_slot, username, slot, secret, master_key)
+        elif self.crypto.needs_upgrade(userdata[0]):  # запись в фоне, вход не ждет
+            self.submit(self.backend.update_key_slot, username, slot,
+                        self.crypto.encrypt_data(master_key, key), userdata[1], userdata[2])
+
+    def _rewrap_key_slot(self, username, slot, secret, master_key):  # выработать ключ с текущими параметрами KDF
+        # KDF вне потока записи - он не держит транзакцию
+        self.submit(self.backend.update_key_slot, username, slot, *self._wrap_master_key(secret, master_key))
+
+    def _wrap_master_key(self, secret, master_key):  # (мастер-ключ под ключом из secret, соль, параметры KDF)
+        if len(master_key) != MASTER_KEY_SIZE:
+            raise ValueError('Invalid master key')
+        kdf = self.crypto.kdf
+        salt = secrets.token_bytes(16)
+        return self.crypto.encrypt_data(master_key, self.crypto.derive_key(secret, salt, kdf)), salt, kdf
+
+    def change_password(self, username, master_key, new_passw):  # сменить пароль
+        if not new_passw:
+            return False, 'Enter correct password'
+        return self._change_key_slot(username, 'passw', master_key, new_passw, 'Password')
+
+    def change_pin(self, username, master_key, new_pin):  # сменить PIN-код
+        if not new_pin:
+            return False, 'Enter correct PIN'
+        return self._change_key_slot(username, 'pin', master_key, new_pin, 'PIN')
+
+    def _change_key_slot(self, username, slot, master_key, secret, name):  # перешифровать только слот ключа
+        # мастер-ключ не меняется, поэтому data не трогается: одна выработка ключа и одна строка users.
+        # KDF - здесь, вне транзакции: поток записи (и блокировка хранилища) занят только сохранением слота
+        user_id = self.backend.get_user_id(username)
+        if user_id is None:
+            return False, f'User {username} not found'
+        if self.backend.get_rotation(user_id) is not None:  # слоты будут заменены готовыми при завершении смены
+            return False, 'Wait until the master key rotation finishes'
+        try:
+            wrapped = self._wrap_master_key(secret, master_key)
+            return self.submit(self._store_key_slot, username, user_id, slot, master_key, wrapped, name).result()
+        except Exception as e:
+            return False, f'Storage error: {str(e)}'
+
+    def _store_key_slot(self, username, user_id, slot, master_key, wrapped, name):  # в потоке записи
+        # пока вырабатывался ключ, смена мастер-ключа могла начаться или завершиться (ключ сессии устарел)
+        if self.backend.get_rotation(user_id) is not None:
+            return False, 'Wait until the master key rotation finishes'
+        if self._is_retired(master_key):
+            return False, 'Master key has been rotated, try again'
+        self.backend.update_key_slot(username, slot, *wrapped)
+        return True, f'{name} successfully changed'
+
+    def has_pending_rotation(self, username):  # есть ли незавершенная смена мастер-ключа
+        user_id = self.backend.get_user_id(username)
+        return user_id is not None and self.backend.get_rotation(user_id) is not None
+
+    def _open_key_slot(self, username, slot, secret):  # мастер-ключ из слота или None
+        userdata = self.backend.get_key_slot(username, slot)
+        if not userdata or not secret:
+            return None
+        try:
+            return self.crypto.decrypt_master_key(userdata[0],
+                                                  self.crypto.derive_key(secret, userdata[1], userdata[2]))
         except ValueError:
+            return None
+
+    def start_key_rotation(self, username, master_key, passw, pin):  # начать смену мастер-ключа
+        # слоты нового ключа готовятся сразу: пароль и PIN-код нужны только здесь, а продолжению после сбоя
+        # достаточно мастер-ключа сессии (новый ключ хранится зашифрованным старым)
+        user_id = self.backend.get_user_id(username)
+        if user_id is None:
+            return False, f'User {username} not found'
+        if self.backend.get_rotation(user_id) is not None:
+            return False, 'Master key rotation is already in progress'
+        if self._open_key_slot(username, 'passw', passw) != master_key:
             return False, 'Incorrect password, try again'
+        if self._open_key_slot(username, 'pin', pin) != master_key:
+            return False, 'Incorrect PIN, try again'
+        new_key = self.crypto.get_master_key()
+        passw_wrapped, passw_salt, pin_wrapped, pin_salt = self.crypto.derive_userdata(passw, pin, new_key)
+        kdf = self.crypto.kdf
+        try:
+            self.submit(self.backend.begin_rotation, user_id, self.crypto.encrypt_data(new_key, master_key),
+                        passw_wrapped, passw_salt, kdf, pin_wrapped, pin_salt, kdf).result()
+        except Exception as e:
+            return False, f'Storage error: {str(e)}'
+        return True, 'Master key rotation started'
+
+    def rotate_master_key(self, username, master_key, chunk_size=ROTATION_CHUNK_SIZE):  # перешифровать записи
+        # порция строк читается по id, ключи данных перешифровываются новым ключом в фоновом пуле, а пишется
+        # вместе с контрольной точкой одной транзакцией потока записи. До замены слотов вход дает старый
+        # мастер-ключ, новый берется из key_rotation - поэтому прерванная смена просто продолжается
+        try:
+            user_id = self._get_user_id(username)
+            rotation = self.backend.get_rotation(user_id)
+            if rotation is None:
+                return False, 'No master key rotation in progress'
+            new_key = self.crypto.decrypt_data(rotation[0], master_key)
+            checkpoint = rotation[-1]
+            while not self._closing.is_set():
+                rows = self.backend.iter_raw_records(user_id, checkpoint, chunk_size)
+                if not rows:
+                    if self.submit(self._finish_rotation, user_id, master_key, new_key, checkpoint).result():
+                        return True, new_key
+                    continue  # после последней порции добавлены записи
+                records = self._reseal_rows(rows, master_key, new_key)
+                checkpoint = self.submit(self._commit_rotation_chunk, user_id, checkpoint, rows, records,
+                                         master_key, new_key).result()
+        except Exception as e:
+            return False, str(e)
+        return False, 'Master key rotation paused'
+
+    def _reseal_rows(self, rows, old_key, new_key):  # перешифровать строки порциями в фоновом пуле
+        chunks = [rows[i:i + DECRYPT_CHUNK_SIZE] for i in range(0, len(rows), DECRYPT_CHUNK_SIZE)]
+        if len(chunks) > 1 and self.decrypt_workers > 1:
+            results = self._get_executor().map(lambda chunk: self._reseal_chunk(chunk, old_key, new_key), chunks)
+        else:
+            results = (self._reseal_chunk(chunk, old_key, new_key) for chunk in chunks)
+        return [record for records in results for record in records]
+
+    def _reseal_chunk(self, rows, old_key, new_key):  # [(id, *record)] -> [(id, *record)] под новым ключом
+        # у конверта перешифровывается только ключ данных: блоки записи остаются прежними (правленая запись
+        # и так получает новый ключ данных при записи). Записи прежних версий без ключа данных запечатываются
+        # целиком. Строка, которая уже открывается новым ключом (перешифрована до сбоя), и строка, которую
+        # не открывает ни один ключ, остаются как есть
+        envelopes = [row for row in rows if row[4] is not None]
+        records = [(row[0], *row[1:4], wrapped_key) for row, wrapped_key in
+                   zip(envelopes, self.crypto.rewrap_keys([row[4] for row in envelopes], old_key, new_key,
+                                                          return_exceptions=True))
+                   if not isinstance(wrapped_key, Exception)]
+        kept, groups = [], []
+        for row in rows:
+            if row[4] is not None:
+                continue
+            try:
+                groups.append(self.crypto.decrypt_many([block for block in row[1:4] if block is not None], old_key))
+                kept.append(row)
+            except Exception:
+                continue
+        for row, (wrapped_key, blocks) in zip(kept, self.crypto.seal_many(groups, new_key)):
+            blocks = iter(blocks)
+            records.append((row[0], *(None if block is None else next(blocks) for block in row[1:4]), wrapped_key))
+        return records
+
+    def _commit_rotation_chunk(self, user_id, after_id, rows, records, old_key, new_key):  # в потоке записи
+        # строки, измененные или добавленные правками после чтения порции, перешифровываются заново здесь же
+        last_id = rows[-1][0]
+        read = {row[0]: tuple(row) for row in rows}
+        current = []
+        while True:
+            page = self.backend.iter_raw_records(user_id, current[-1][0] if current else after_id, len(rows))
+            current.extend(tuple(row) for row in page if row[0] <= last_id)
+            if len(page) < len(rows) or page[-1][0] >= last_id:
+                break
+        resealed = {record[0]: record for record in records}
+        resealed.update((record[0], record) for record in
+                        self._reseal_chunk([row for row in current if read.get(row[0]) != row], old_key, new_key))
+        self.backend.update_records(user_id, [resealed[row[0]] for row in current if row[0] in resealed])
+        self.backend.set_rotation_checkpoint(user_id, last_id)
+        return last_id
+
+    def _finish_rotation(self, user_id, old_key, new_key, checkpoint):  # в потоке записи: заменить слоты ключа
+        if self.backend.iter_raw_records(user_id, checkpoint, 1):
+            return False
+        self.backend.finish_rotation(user_id)
+        self._retired_keys.add(hashlib.sha256(old_key).digest())
+        return True
+
+    def _is_retired(self, master_key):  # ключ заменен сменой мастер-ключа - сессия с ним устарела
+        return hashlib.sha256(master_key).digest() in self._retired_keys
+
+    def _row_keys(self, user_id, master_key):  # (мастер-ключ, (новый мастер-ключ, checkpoint) или None)
+        # во время смены мастер-ключа записи с id <= checkpoint уже под новым ключом; после нее старый ключ
+        # не принимается: запись из очереди со старой сессией получает ошибку, а не переводится на новый ключ
+        if self._is_retired(master_key):
+            raise ValueError('Master key has been rotated, try again')
+        rotation = self.backend.get_rotation(user_id)
+        if rotation is None:
+            return master_key, None
+        return master_key, (self.crypto.decrypt_data(rotation[0], master_key), rotation[-1])
+
+    def run_in_background(self, func, *args, **kwargs):  # долгое задание в отдельном потоке, вернуть Future
+        if self._jobs is None:
+            self._jobs = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rotation')
+        return self._jobs.submit(func, *args, **kwargs)
+
+    def run_task(self, func, *args, **kwargs):  # короткое задание в фоновом пуле, вернуть Future
+        return self._get_executor().submit(func, *args, **kwargs)
 
     def get_users_list(self):  # вернуть список пользователей
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        cur.execute('''SELECT username, image FROM users''')
-        users = cur.fetchall()
-        return users
+        return self.backend.list_users()
+
+    def submit(self, func, *args, **kwargs):  # выполнить запись func в фоновом потоке, вернуть Future
+        return self.writer.submit(func, *args, **kwargs)
+
+    def transaction(self):  # with um.transaction(): - все записи внутри блока фиксируются одним commit
+        return self.backend.transaction()
 
     def write_user_data(self, username, master_key, data):  # запись пользовательских данных
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        encr_data = [(self.crypto.encrypt_data(json.dumps(datum).encode(), master_key),) for datum in data]
+        result = self.insert_many(username, master_key, data)
+        return (True, 'Data successfully added') if result[0] else result
+
+    def insert_many(self, username, master_key, data):  # добавить записи, вернуть их id
         try:
-            cur.executemany(
-                F'''INSERT INTO data (user_id, encrypted_data) VALUES((SELECT id FROM users WHERE username = '{username}'),?)''',
-                encr_data)
-            con.commit()
-            con.close()
+            user_id = self._get_user_id(username)
+            encr_data = [record[1:] for record in
+                         self._encrypt_rows(user_id, master_key, ((None, datum) for datum in data))]
+            with self.transaction():
+                ud_ids = self.backend.insert_records(user_id, encr_data)
+        except ValueError as e:  # ключ сессии заменен сменой мастер-ключа
+            return False, str(e)
         except Exception:
             return False, 'SQL error, try again'
         else:
-            return True, 'Data successfully added'
+            return True, ud_ids
 
-    def read_user_data(self, username, master_key):  # чтение пользовательских данных
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
+    def update_many(self, username, master_key, data):  # перезаписать записи [(ud_id, datum), ...]
         try:
-            cur.execute(
-                '''SELECT id, encrypted_data FROM data WHERE user_id = (SELECT id FROM users WHERE username = ?)''',
-                (username,))
-            encr_data = cur.fetchall()
+            user_id = self._get_user_id(username)
+            data = [(ud_id, self._with_password(username, ud_id, datum, master_key)) for ud_id, datum in data]
+            with self.transaction():
+                count = self.backend.update_records(user_id, self._encrypt_rows(user_id, master_key, data))
         except Exception as e:
             return False, str(e)
         else:
-            data = []
+            return True, f'{count} entries updated'
+
+    def _with_password(self, username, ud_id, datum, master_key):  # подставить сохраненный пароль
+        if datum.get('password') is not None:
+            return datum
+        result = self.read_user_password(ud_id, master_key, username)
+        if not result[0]:
+            raise ValueError(result[1])
+        return {**datum, 'password': result[1]}
+
+    def upsert_many(self, username, master_key, data):  # [(ud_id или None, datum), ...]: обновить или добавить
+        try:
+            user_id = self._get_user_id(username)
+            with self.transaction():
+                count = self.backend.upsert_records(user_id, self._encrypt_rows(user_id, master_key, data))
+        except Exception as e:
+            return False, str(e)
+        else:
+            return True, f'{count} entries saved'
+
+    def delete_many(self, username, ud_ids):  # удалить записи пользователя по списку id
+        try:
+            with self.transaction():
+                count = self.backend.delete_records(self._get_user_id(username), ud_ids)
+        except Exception as e:
+            return False, str(e)
+        else:
+            return True, f'{count} entries deleted'
+
+    def _get_user_id(self, username):  # id пользователя username
+        user_id = self.backend.get_user_id(username)
+        if user_id is None:
+            raise LookupError(f'User {username} not found')
+        return user_id
+
+    def _encrypt_rows(self, user_id, master_key, data):  # [(ud_id или None, datum)] -> [(ud_id, *record)]
+        # записи пишутся в потоке записи, где двигается и контрольная точка смены мастер-ключа, поэтому ключ
+        # строки согласован с ней; новые записи получают id больше checkpoint - им старый ключ
+        data = list(data)
+        master_key, rotation = self._row_keys(user_id, master_key)
+        moved = [rotation is not None and ud_id is not None and ud_id <= rotation[1] for ud_id, _ in data]
+        result = [None] * len(data)
+        for flag, key in ((False, master_key), (True, rotation and rotation[0])):
+            idx = [i for i in range(len(data)) if moved[i] is flag]
+            if idx:
+                for i, record in zip(idx, self.encrypt_data_batch([data[i][1] for i in idx], key)):
+                    result[i] = (data[i][0], *record)
+        return result
+
+    def encrypt_datum(self, datum, master_key):  # (encrypted_data, encrypted_meta, encrypted_password, wrapped_key)
+        return self.encrypt_data_batch([datum], master_key)[0]
+
+    def encrypt_data_batch(self, data, master_key):  # зашифровать набор записей (конверт: ключ данных на запись)
+        data = list(data)
+        if self.storage_mode == 'split':
+            groups = [(encode_record({'name': datum['name'], 'username': datum['username']}),
+                       datum['password'].encode()) for datum in data]
+            return [(None, meta, password, wrapped_key)
+                    for wrapped_key, (meta, password) in self.crypto.seal_many(groups, master_key)]
+        groups = [(encode_record(datum),) for datum in data]
+        return [(encr_datum, None, None, wrapped_key)
+                for wrapped_key, (encr_datum,) in self.crypto.seal_many(groups, master_key)]
+
+    def decrypt_datum(self, encrypted_data, encrypted_meta, master_key, wrapped_key=None):  # запись без пароля
+        datum = self.decrypt_data_batch([(encrypted_data, encrypted_meta, wrapped_key)], master_key)[0]
+        if isinstance(datum, Exception):
+            raise datum
+        return datum
+
+    def decrypt_data_batch(self, rows, master_key):  # [(encrypted_data, encrypted_meta, wrapped_key), ...]
+        # ключи данных расшифровываются одним набором, блоки - в один переиспользуемый буфер и разбираются
+        # прямо из него; ошибка строки возвращается на ее месте, остальные строки не страдают
+        decrypted = self.crypto.iter_open_into(
+            [(wrapped_key, encrypted_data if encrypted_meta is None else encrypted_meta)
+             for encrypted_data, encrypted_meta, wrapped_key in rows],
+            master_key, return_exceptions=True)
+        data = []
+        for (encrypted_data, encrypted_meta, _), plaintext in zip(rows, decrypted):
             try:
-                for encr_datum in encr_data:
-                    decrypted_datum = self.crypto.decrypt_data(encr_datum[1], master_key)
-                    data.append([encr_datum[0], json.loads(decrypted_datum.decode('utf8'))])
+                if isinstance(plaintext, Exception):
+                    raise plaintext
+                datum = decode_record(plaintext)  # двоичная запись или JSON прежних версий
+                if encrypted_meta is not None:
+                    datum['password'] = None  # расшифровывается по запросу (read_user_password)
+                data.append(datum)
             except Exception as e:
-                return False, str(e)
+                # traceback держит кадр decode_record со срезами общего буфера расшифровки: пока ошибка хранится
+                # с ним, буфер не расширить - остальные строки набора пошли бы в новые буферы
+                e.__context__ = e.__cause__ = None
+                data.append(e.with_traceback(None))
+        return data
+
+    def read_user_data(self, username, master_key, errors=None):  # чтение пользовательских данных
+        data = []
+        try:
+            for page in self.iter_user_data(username, master_key, errors=errors):
+                data.extend(page)
+        except Exception as e:
+            return False, str(e)
+        else:
+            return True, data
+
+    def iter_user_data(self, username, master_key, page_size=DATA_PAGE_SIZE, after_id=0, errors=None):
+        # постраничное чтение: каждая страница - отдельный запрос WHERE id > последнего id,
+        # поэтому курсор не держится между страницами
+        user_id = self.backend.get_user_id(username)
+        if user_id is None:
+            return
+        while True:
+            page_key, rotation = self._row_keys(user_id, master_key)  # контрольная точка - до чтения строк
+            encr_data = self.backend.iter_records(user_id, after_id, page_size)
+            if not encr_data:
+                return
+            yield self.decrypt_rows(encr_data, page_key, errors, rotation)
+            if len(encr_data) < page_size:
+                return
+            after_id = encr_data[-1][0]
+
+    def decrypt_rows(self, rows, master_key, errors=None, rotation=None):  # параллельная расшифровка строк
+        # строки делятся на порции по DECRYPT_CHUNK_SIZE, map сохраняет порядок порций;
+        # битая строка пропускается и попадает в errors как (id, сообщение), остальные не страдают
+        chunks = [rows[i:i + DECRYPT_CHUNK_SIZE] for i in range(0, len(rows), DECRYPT_CHUNK_SIZE)]
+        if len(chunks) > 1 and self.decrypt_workers > 1:
+            results = self._get_executor().map(lambda chunk: self._decrypt_chunk(chunk, master_key, rotation), chunks)
+        else:
+            results = (self._decrypt_chunk(chunk, master_key, rotation) for chunk in chunks)
+        data = []
+        for chunk_data, chunk_errors in results:
+            data.extend(chunk_data)
+            if errors is not None:
+                errors.extend(chunk_errors)
+        return data
+
+    def _get_executor(self):  # фоновый пул (расшифровка, перешифровка слотов ключа), создается по требованию
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.decrypt_workers, thread_name_prefix='decrypt')
+        return self._executor
+
+    def _decrypt_chunk(self, chunk, master_key, rotation=None):  # расшифровать порцию строк в рабочем потоке
+        data, errors = [], []
+        if rotation is None:
+            decrypted = self.decrypt_data_batch([encr_datum[1:] for encr_datum in chunk], master_key)
+        else:
+            decrypted = self._decrypt_rotating(chunk, master_key, *rotation)
+        for encr_datum, datum in zip(chunk, decrypted):
+            if isinstance(datum, Exception):
+                errors.append((encr_datum[0], str(datum) or type(datum).__name__))
             else:
-                return True, data
+                data.append([encr_datum[0], datum])
+        return data, errors
+
+    def _decrypt_rotating(self, chunk, master_key, new_key, checkpoint):  # расшифровка во время смены ключа
+        # строки с id <= checkpoint уже под новым ключом; строка, перешифрованная между чтением checkpoint
+        # и самих строк, не открывается ожидаемым ключом - она повторяется другим
+        decrypted = [None] * len(chunk)
+        for moved in (False, True):
+            idx = [i for i, encr_datum in enumerate(chunk) if (encr_datum[0] <= checkpoint) is moved]
+            for key in ((new_key, master_key) if moved else (master_key, new_key)):
+                if not idx:
+                    break
+                for i, datum in zip(idx, self.decrypt_data_batch([chunk[i][1:] for i in idx], key)):
+                    decrypted[i] = datum
+                idx = [i for i in idx if isinstance(decrypted[i], Exception)]
+        return decrypted
 
-    def delete_user_data(self, ud_id):  # удаление пользовательских данных
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
+    def read_user_password(self, ud_id, master_key, username):  # расшифровать пароль одной записи
+        # владелец обязателен: в хранилище с файлом на пользователя id записей уникальны только внутри файла
         try:
-            cur.execute('''DELETE from data where id = ?''', (ud_id,))
-            con.commit()
-            con.close()
+            user_id = self._get_user_id(username)
+            encr_datum = self.backend.get_record_secret(user_id, ud_id)
+            if not encr_datum:
+                return False, 'Data not found'
+            master_key, rotation = self._row_keys(user_id, master_key)
+            keys = [master_key]
+            if rotation is not None:  # сначала ключ по контрольной точке, затем другой
+                keys = [rotation[0], master_key] if ud_id <= rotation[1] else [master_key, rotation[0]]
+            for i, key in enumerate(keys):
+                try:
+                    return True, self._decrypt_password(encr_datum, key)
+                except ValueError:
+                    if i == len(keys) - 1:
+                        raise
+        except Exception as e:
+            return False, str(e)
+
+    def _decrypt_password(self, encr_datum, master_key):  # пароль из (encrypted_data, encrypted_password, wrapped_key)
+        key = self.crypto.unwrap_keys([encr_datum[2]], master_key)[0]  # ключ данных записи
+        if encr_datum[1] is None:  # запись одним блоком
+            decrypted_datum = self.crypto.decrypt_data(encr_datum[0], key)
+            return decode_record(decrypted_datum)['password']
+        return self.crypto.decrypt_data(encr_datum[1], key).decode('utf8')
+
+    def delete_user_data(self, username, ud_id):  # удаление записи пользователя
+        try:
+            self.backend.delete_records(self._get_user_id(username), [ud_id])
         except Exception as e:
             return False, str(e)
         else:
             return True, 'Data successfully deleted'
 
     def delete_user(self, username):  # удаление пользователя и его данных
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
         try:
-            cur.execute('''DELETE FROM data WHERE user_id = (SELECT id FROM users Where username = ?)''', (username,))
-            cur.execute('''DELETE FROM users where username = ?''', (username,))
-            con.commit()
-            con.close()
+            self.backend.delete_user(username)
         except Exception as e:
             return False, str(e)
         else:
             return True, f'User {username} successfully deleted'
 
-um = UserManagementSystem()
-# # # # print(um.register_user('kodex', 'c1ff2g3', '4108'))
-# # # print(um.register_user('user1', '88112233', '412143'))
-# # # print(*um.get_users_list())
-# userdata1 = {'descr':'yandex', 'login':'kdx', 'password':'aszaAAd!?'}
-# userdata2 = {'descr':'mail', 'login':'holy_cow@index.com', 'password':'Milk228#'}
-# #
-# mkey = um.get_master_key_with_pin('tu1', '111111')[1]
-# print(um.write_user_data('tu1', mkey, userdata1))
-# print(um.write_user_data('tu1', mkey, userdata2))
-# print(um.read_user_data('tu1', mkey))
-print(um.delete_user('tu1'))
\ No newline at end of file
+    def close(self):  # закрыть пул расшифровки, дописать очередь записи, закрыть хранилище
+        self._closing.set()  # смена мастер-ключа останавливается после текущей порции
+        if self._jobs is not None:  # задания пользуются и фоновым пулом, и потоком записи
+            self._jobs.shutdown(wait=True)
+            self._jobs = None
+        if self._executor is not None:  # задания пула еще могут ставить записи в очередь
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.writer.stop()
+        self.crypto.close()
+        self.backend.close()
+
+
+if __name__ == '__main__':
+    um = UserManagementSystem()
+    # # # # print(um.register_user('kodex', 'c1ff2g3', '4108'))
+    # # # print(um.register_user('user1', '88112233', '412143'))
+    # # # print(*um.get_users_list())
+    # userdata1 = {'descr':'yandex', 'login':'kdx', 'password':'aszaAAd!?'}
+    # userdata2 = {'descr':'mail', 'login':'holy_cow@index.com', 'password':'Milk228#'}
+    # #
+    # mkey = um.get_master_key_with_pin('tu1', '111111')[1]
+    # print(um.write_user_data('tu1', mkey, userdata1))
+    # print(um.write_user_data('tu1', mkey, userdata2))
+    # print(um.read_user_data('tu1', mkey))
+    print(um.delete_user('tu1'))
+    um.close()
@@ -2,18 +2,77 @@ import string
 from csv import DictReader
 
 from PIL import Image
-from PyQt6 import QtCore
+from PyQt6 import QtCore, QtWidgets
 from PyQt6.QtGui import QKeyEvent, QCursor, QPixmap
-from PyQt6.QtWidgets import QDialog, QLineEdit, QWidget, QApplication, QToolTip, QFileDialog
+from PyQt6.QtWidgets import QDialog, QLineEdit, QWidget, QApplication, QToolTip, QFileDialog, QMenu
 from PyQt6.QtCore import QBuffer, QByteArray
-from config import CSV_IMPORT_HEADER, TABLE_HEADERS
+from config import CSV_IMPORT_HEADER, TABLE_HEADERS, TABLE_ROW_HEIGHT, EDIT_COMMIT_DELAY_MS, SEARCH_DELAY_MS
 from crypto import generate_password
 from design_files.greet_widget_design import Ui_Form as GreetWidgetUi
 from design_files.main_widget_design import Ui_Form as MainWidgetUi
 from design_files.password_auth_design import Ui_Dialog as PasswordAuthUi
 from design_files.password_dialog_design import Ui_Dialog as PasswordCreationUi
 from design_files.user_creation_design import Ui_Dialog as UserCreationUi
-from table_model import TableModel
+from search_index import TrigramIndex
+from table_delegate import PasswordDelegate
+from table_model import TableModel, TableProxyModel
+
+
+class WriteWatcher(QtCore.QObject):
+    '''
+    Передает результат фоновой записи (Future из UserManagementSystem.submit) в поток GUI.
+
+    Сигнал done испускается из потока писателя и по очереди событий Qt доставляется в callback
+    в потоке GUI, поэтому интерфейс никогда не ждет commit(). Исключение превращается в (False, текст ошибки).
+    '''
+
+    done = QtCore.pyqtSignal(object)
+
+    def __init__(self, parent, future, callback):
+        super().__init__(parent)
+        self.done.connect(callback)
+        self.done.connect(self.deleteLater)
+        future.add_done_callback(self._emit_result)
+
+    def _emit_result(self, future):  # вызывается в потоке писателя
+        try:
+            result = future.result()
+        except Exception as e:
+            result = (False, str(e))
+        self.done.emit(result)
+
+
+def is_valid_password(passw):  # требования к паролю (регистрация и смена пароля)
+    passw = list(passw)
+    keys = []
+
+    is_passw_long_enough = len(passw) >= 8
+    passw_cont_numbers = any(k in passw for k in string.digits)
+    passw_cont_special_symbols = any(k in passw for k in '!#@$%_')
+    passw_cont_low_symbols = any(k in passw for k in string.ascii_lowercase)
+    passw_cont_up_symbols = any(k in passw for k in string.ascii_uppercase)
+    passw_cont_only_latin = all(k in string.ascii_letters or k in string.digits or k in '!#@$%_' for k in passw)
+
+    keys.append(is_passw_long_enough)
+    keys.append(passw_cont_numbers)
+    keys.append(passw_cont_special_symbols)
+    keys.append(passw_cont_low_symbols)
+    keys.append(passw_cont_up_symbols)
+    keys.append(passw_cont_only_latin)
+
+    return all(keys)  # возвращает выполнение всех ключей
+
+
+def is_valid_pin(pin):  # требования к PIN-коду (регистрация и смена PIN-кода)
+    keys = []
+
+    is_pin_long_enough = len(pin) >= 6
+    pin_cont_only_numbers = all(k.isdigit() for k in list(pin))
+
+    keys.append(is_pin_long_enough)
+    keys.append(pin_cont_only_numbers)
+
+    return all(keys)  # возвращает выполнение всех ключей
 
 
 class GreetWidget(QWidget, GreetWidgetUi):
@@ -159,7 +218,10 @@ class UserCreation(QDialog, UserCreationUi):
         Проверяет, что введен корректный PIN-код
 
     try_create_user()
-        Проверяет правильность введенных данных и создает пользователя
+        Проверяет правильность введенных данных и создает пользователя (в фоновом потоке записи)
+
+    on_user_created(result)
+        Показывает результат регистрации
 
     show_error_message(message)
         Выводит строку message в error_label
@@ -219,36 +281,10 @@ class UserCreation(QDialog, UserCreationUi):
         return all(keys)  # возвращает выполнение всех ключей
 
     def validate_password(self):  # валидация пароля
-        passw = list(self.password_lineEdit.text())
-        keys = []
-
-        is_passw_long_enough = len(passw) >= 8
-        passw_cont_numbers = any(k in passw for k in string.digits)
-        passw_cont_special_symbols = any(k in passw for k in '!#@$%_')
-        passw_cont_low_symbols = any(k in passw for k in string.ascii_lowercase)
-        passw_cont_up_symbols = any(k in passw for k in string.ascii_uppercase)
-        passw_cont_only_latin = all(k in string.ascii_letters or k in string.digits or k in '!#@$%_' for k in passw)
-
-        keys.append(is_passw_long_enough)
-        keys.append(passw_cont_numbers)
-        keys.append(passw_cont_special_symbols)
-        keys.append(passw_cont_low_symbols)
-        keys.append(passw_cont_up_symbols)
-        keys.append(passw_cont_only_latin)
-
-        return all(keys)  # возвращает выполнение всех ключей
+        return is_valid_password(self.password_lineEdit.text())
 
     def validate_pin(self):  # валидация pin
-        pin = self.pin_lineEdit.text()
-        keys = []
-
-        is_pin_long_enough = len(pin) >= 6
-        pin_cont_only_numbers = all(k.isdigit() for k in list(pin))
-
-        keys.append(is_pin_long_enough)
-        keys.append(pin_cont_only_numbers)
-
-        return all(keys)  # возвращает выполнение всех ключей
+        return is_valid_pin(self.pin_lineEdit.text())
 
     def try_create_user(self):  # проверка условий
         if not self.validate_login():
@@ -263,8 +299,17 @@ class UserCreation(QDialog, UserCreationUi):
                 password = self.password_lineEdit.text()
                 pin = self.pin_lineEdit.text()
                 image = self.blob_image if self.blob_image else None
-                result = self.um.register_user(username, password, pin, image)
-                self.show_error_message(result[1])
+                self.create_button.setEnabled(False)
+                self.show_error_message('Creating user...')
+                # выработка ключей - в фоновом пуле, поток записи только добавляет пользователя
+                future = self.um.run_task(self.um.register_user, username, password, pin, image)
+                # список пользователей обновляет окно: результат не теряется, если диалог уже закрыт
+                WriteWatcher(self.window, future, self.window.on_user_registered)
+                WriteWatcher(self, future, self.on_user_created)
+
+    def on_user_created(self, result):  # результат фоновой регистрации (пока диалог открыт)
+        self.create_button.setEnabled(True)
+        self.show_error_message(result[1])
 
     def show_error_message(self, message: str):  # вывести сообщение
         self.error_label.setText(message)
@@ -372,6 +417,235 @@ class PasswordAuth(QDialog, PasswordAuthUi):
                 self.show_error_message(result[1])
 
 
+class SecretChange(QDialog, PasswordAuthUi):
+    '''
+        Класс логики диалогового окна смены пароля или PIN-кода вошедшего пользователя
+
+        ------------------------------------------------------------------------------------------------------------------
+
+        Дизайн - PasswordAuthUi
+
+        ------------------------------------------------------------------------------------------------------------------
+
+        Атрибуты:
+
+        window: class
+            Родительское окно
+
+        um: class
+            Экземпляр менеджера учетных данных
+
+        slot: str
+            'passw' - смена пароля, 'pin' - смена PIN-кода
+
+        new_secret: str
+            Новое значение после первого ввода (None - ждем первый ввод)
+
+        ------------------------------------------------------------------------------------------------------------------
+
+        Методы:
+
+        show_chars()
+            Переключает режим показа на видимый
+
+        hide_chars()
+            Переключает режим показа на скрытый
+
+        accept_secret()
+            Проверяет новое значение, после повторного ввода меняет его (ключ вырабатывается в фоне)
+
+        on_secret_changed(result)
+            Закрывает окно после смены или показывает ошибку (итог смены сообщает главный виджет)
+
+        '''
+
+    def __init__(self, window, slot):
+        super().__init__()
+        self.window = window
+        self.setupUi(self)
+        self.setWindowFlags(QtCore.Qt.WindowType.FramelessWindowHint)
+        self.setAttribute(QtCore.Qt.WidgetAttribute.WA_TranslucentBackground)
+        self.setModal(True)
+        self.cancel_button.clicked.connect(self.reject)
+        self.accept_button.clicked.connect(self.accept_secret)
+        self.password_lineEdit.setEchoMode(QLineEdit.EchoMode.Password)
+        self.show_char_button.pressed.connect(self.show_chars)
+        self.show_char_button.released.connect(self.hide_chars)
+        self.um = window.usermanager
+        self.slot = slot
+        self.new_secret = None
+        self.name = 'password' if slot == 'passw' else 'PIN'
+        if slot == 'passw':
+            self.password_lineEdit.setPlaceholderText('len>7, upper, lower, numbers, !#@$%_')
+        else:
+            self.label_2.setText('PIN')
+            self.password_lineEdit.setPlaceholderText('len>5, only numbers')
+        self.info_label.setText(f'Enter new {self.name}')
+
+    def mousePressEvent(self, ev):
+        self.dragPos = ev.globalPosition().toPoint()
+
+    def mouseMoveEvent(self, ev):
+        try:
+            self.move(self.pos() + ev.globalPosition().toPoint() - self.dragPos)
+            self.dragPos = ev.globalPosition().toPoint()
+        except AttributeError:
+            pass
+        finally:
+            ev.accept()
+
+    def show_chars(self):  # показать ввод
+        self.password_lineEdit.setEchoMode(QLineEdit.EchoMode.Normal)
+
+    def hide_chars(self):  # скрыть ввод
+        self.password_lineEdit.setEchoMode(QLineEdit.EchoMode.Password)
+
+    def show_error_message(self, message: str):  # вывести сообщение
+        self.error_label.setText(message)
+
+    def accept_secret(self):  # первый ввод - проверка требований, второй - подтверждение и смена
+        secret = self.password_lineEdit.text()
+        self.password_lineEdit.clear()
+        if self.new_secret is None:
+            if not (is_valid_password(secret) if self.slot == 'passw' else is_valid_pin(secret)):
+                self.show_error_message(f'Incorrect {self.name}')
+                return
+            self.new_secret = secret
+            self.info_label.setText(f'Repeat new {self.name}')
+            self.show_error_message('')
+        elif secret != self.new_secret:
+            self.new_secret = None
+            self.info_label.setText(f'Enter new {self.name}')
+            self.show_error_message('Entries do not match')
+        else:
+            username, master_key = self.window.get_user_session()
+            change = self.um.change_password if self.slot == 'passw' else self.um.change_pin
+            self.accept_button.setEnabled(False)
+            self.show_error_message(f'Changing {self.name}...')
+            # выработка ключа - в фоновом пуле (не в очереди смены мастер-ключа), поток записи только сохраняет слот
+            future = self.um.run_task(change, username, master_key, secret)
+            main_widget = self.window.main_widget  # итог сообщается и после закрытия диалога
+            WriteWatcher(main_widget, future, main_widget.on_secret_changed)
+            WriteWatcher(self, future, self.on_secret_changed)
+
+    def on_secret_changed(self, result):  # результат фоновой смены (пока диалог открыт)
+        if result[0]:
+            self.accept()
+        else:
+            self.new_secret = None
+            self.accept_button.setEnabled(True)
+            self.info_label.setText(f'Enter new {self.name}')
+            self.show_error_message(result[1])
+
+
+class KeyRotation(QDialog, PasswordAuthUi):
+    '''
+        Класс логики диалогового окна смены мастер-ключа (после возможной утечки ключа)
+
+        ------------------------------------------------------------------------------------------------------------------
+
+        Дизайн - PasswordAuthUi
+
+        ------------------------------------------------------------------------------------------------------------------
+
+        Атрибуты:
+
+        window: class
+            Родительское окно
+
+        um: class
+            Экземпляр менеджера учетных данных
+
+        passw: str
+            Текущий пароль после первого ввода (None - ждем пароль)
+
+        ------------------------------------------------------------------------------------------------------------------
+
+        Методы:
+
+        show_chars()
+            Переключает режим показа на видимый
+
+        hide_chars()
+            Переключает режим показа на скрытый
+
+        accept_secret()
+            Принимает текущий пароль, затем PIN-код и начинает смену (в фоновом потоке)
+
+        on_rotation_started(result)
+            Закрывает окно или показывает ошибку (перешифровку записей запускает главный виджет)
+
+        '''
+
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self.setupUi(self)
+        self.setWindowFlags(QtCore.Qt.WindowType.FramelessWindowHint)
+        self.setAttribute(QtCore.Qt.WidgetAttribute.WA_TranslucentBackground)
+        self.setModal(True)
+        self.cancel_button.clicked.connect(self.reject)
+        self.accept_button.clicked.connect(self.accept_secret)
+        self.password_lineEdit.setEchoMode(QLineEdit.EchoMode.Password)
+        self.show_char_button.pressed.connect(self.show_chars)
+        self.show_char_button.released.connect(self.hide_chars)
+        self.um = window.usermanager
+        self.passw = None
+        self.info_label.setText('Enter current password')
+
+    def mousePressEvent(self, ev):
+        self.dragPos = ev.globalPosition().toPoint()
+
+    def mouseMoveEvent(self, ev):
+        try:
+            self.move(self.pos() + ev.globalPosition().toPoint() - self.dragPos)
+            self.dragPos = ev.globalPosition().toPoint()
+        except AttributeError:
+            pass
+        finally:
+            ev.accept()
+
+    def show_chars(self):  # показать ввод
+        self.password_lineEdit.setEchoMode(QLineEdit.EchoMode.Normal)
+
+    def hide_chars(self):  # скрыть ввод
+        self.password_lineEdit.setEchoMode(QLineEdit.EchoMode.Password)
+
+    def show_error_message(self, message: str):  # вывести сообщение
+        self.error_label.setText(message)
+
+    def accept_secret(self):  # первый ввод - пароль, второй - PIN-код (новые слоты ключа нужны для обоих)
+        secret = self.password_lineEdit.text()
+        self.password_lineEdit.clear()
+        if not secret:
+            return
+        if self.passw is None:
+            self.passw = secret
+            self.label_2.setText('PIN')
+            self.info_label.setText('Enter current PIN')
+            self.show_error_message('')
+            return
+        username, master_key = self.window.get_user_session()
+        self.accept_button.setEnabled(False)
+        self.show_error_message('Checking...')
+        # выработка ключей не должна занимать ни поток GUI, ни поток записи
+        future = self.um.run_in_background(self.um.start_key_rotation, username, master_key, self.passw, secret)
+        main_widget = self.window.main_widget  # перешифровка запускается и после закрытия диалога
+        user_session = (username, master_key)
+        WriteWatcher(main_widget, future, lambda result: main_widget.on_rotation_started(user_session, result))
+        WriteWatcher(self, future, self.on_rotation_started)
+
+    def on_rotation_started(self, result):  # результат начала смены (пока диалог открыт)
+        if result[0]:
+            self.accept()
+        else:
+            self.passw = None
+            self.accept_button.setEnabled(True)
+            self.label_2.setText('Password')
+            self.info_label.setText('Enter current password')
+            self.show_error_message(result[1])
+
+
 class MainWidget(QWidget, MainWidgetUi):
     '''
             Класс логики основного окна входа.
@@ -392,12 +666,24 @@ class MainWidget(QWidget, MainWidgetUi):
             user_session: tuple
                 Пользовательская сессия с учетными данными
 
+            search_index: TrigramIndex
+                Индекс поиска по описаниям и логинам загруженных записей
+
             ------------------------------------------------------------------------------------------------------------------
 
             Методы:
 
             create_table_model()
-                Создает модель таблицы
+                Создает модель таблицы и прокси поиска (один раз, при создании виджета)
+
+            queue_search()
+                Откладывает поиск до паузы во вводе (SEARCH_DELAY_MS) и отменяет прежний
+
+            run_search()
+                Показывает записи, найденные по строке поиска, и делает текущей лучшую из них
+
+            fetch_for_search(generation)
+                Догружает страницы для поиска по одной, пока запрос generation не устарел
 
             create_user_session(user_session)
                 Создает пользовательскую сессию и инициализирует таблицу
@@ -409,59 +695,165 @@ class MainWidget(QWidget, MainWidgetUi):
                 Выводит tooltip с сообщением msg
 
             load_data()
-                Возвращает данные из таблицы
+                Возвращает итератор страниц данных из БД
 
             show_data()
-                Отображает данные в таблице
+                Загружает данные пользователя в таблицу (страницы подгружаются по мере прокрутки)
+
+            transform_page(page)
+                Переводит страницу данных из БД в строки таблицы
+
+            load_password(ud_id)
+                Расшифровывает пароль записи ud_id при копировании, подсказке или редактировании
 
             show_info_message()
                 Показывает сообщение пользователю
 
+            queue_edit(ud_id, row)
+                Ставит правку строки в очередь записи (с задержкой EDIT_COMMIT_DELAY_MS)
+
+            flush_edits()
+                Записывает накопленные правки таблицы одной транзакцией
+
+            on_edits_saved(result)
+                Показывает результат записи правок
+
             del_data()
-                Удаляет выбранные данные из БД
+                Удаляет все выбранные строки из БД одной транзакцией
 
             import_csv_data()
                 Импортирует данные из CSV-файла
 
+            add_rows(ud_ids, data)
+                Добавляет в таблицу только что записанные записи (без перечитывания и расшифровки)
+
+            on_rows_deleted(ud_ids, result)
+                Убирает из таблицы удаленные строки
+
+            on_rows_added(data, message, result)
+                Добавляет в таблицу записанные записи (добавление и импорт) или показывает ошибку
+
+            on_secret_changed(result)
+                Показывает итог смены пароля или PIN-кода
+
+            on_rotation_started(user_session, result)
+                Запускает перешифровку записей после начала смены мастер-ключа
+
+            change_secret(slot)
+                Открывает диалог смены пароля (slot = 'passw') или PIN-кода (slot = 'pin')
+
+            rotate_master_key()
+                Открывает диалог смены мастер-ключа (или продолжает незавершенную смену)
+
+            resume_rotation()
+                Перешифровывает записи новым мастер-ключом в фоне (при входе - продолжает прерванную смену)
+
+            on_key_rotated(user_session, result)
+                Заменяет мастер-ключ сессии новым после завершения смены
+
             '''
 
     def __init__(self, window):
         super().__init__()
         self.setupUi(self)
-        self.search_edit.setPlaceholderText('Search by name')
+        self.search_edit.setPlaceholderText('Search by name or username')
 
         self.window = window
         self.um = window.usermanager
+        self.user_session = None
+        self.rotation = None  # Future фоновой смены мастер-ключа
         self.log_out_button.clicked.connect(self.window.log_out)
         self.quitButton.clicked.connect(self.window.close)
         self.add_data_button.clicked.connect(self.window.open_password_creation_window)
         self.delete_data_button.clicked.connect(self.del_data)
         self.import_data_button.clicked.connect(self.import_csv_data)
+        key_menu = QMenu(self.key_button)
+        key_menu.addAction('Change password', lambda: self.change_secret('passw'))
+        key_menu.addAction('Change PIN', lambda: self.change_secret('pin'))
+        key_menu.addAction('Rotate master key', self.rotate_master_key)
+        self.key_button.setMenu(key_menu)
         self.tableView.doubleClicked.connect(self.copy_to_clipboard)
+        # двойной клик занят копированием, редактирование - по F2
+        self.tableView.setEditTriggers(QtWidgets.QAbstractItemView.EditTrigger.EditKeyPressed)
+
+        self.pending_edits = dict()  # id записи -> значения строки, ожидающие записи в БД
+        self.edit_timer = QtCore.QTimer(self)
+        self.edit_timer.setSingleShot(True)
+        self.edit_timer.setInterval(EDIT_COMMIT_DELAY_MS)
+        self.edit_timer.timeout.connect(self.flush_edits)
+        self.search_index = TrigramIndex()
+        self.search_generation = 0  # номер последнего запроса: догрузка для прежних запросов прекращается
+        self.search_timer = QtCore.QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.run_search)
+        self.create_table_model()
 
-    def create_table_model(self):  # создать модель таблицы
+    def create_table_model(self):  # создать модель таблицы (одна на виджет, данные меняются в ней)
 
-        self.table_model = TableModel()
-        self.proxy = QtCore.QSortFilterProxyModel(self)
+        self.table_model = TableModel(TABLE_HEADERS, parent=self)
+        self.proxy = TableProxyModel(self)  # фильтр по результату поиска в индексе
         self.proxy.setSourceModel(self.table_model)
-        self.proxy.setFilterCaseSensitivity(QtCore.Qt.CaseSensitivity.CaseInsensitive)
-        self.proxy.setFilterKeyColumn(0)
         self.tableView.setModel(self.proxy)
         self.tableView.setSortingEnabled(True)
-        self.search_edit.textChanged.connect(self.proxy.setFilterFixedString)
+        self.search_edit.textChanged.connect(self.queue_search)
+        self.table_model.fetchFailed.connect(self.show_info_message)
+        self.table_model.password_loader = self.load_password
+        self.table_model.rowEdited.connect(self.queue_edit)
         header = self.tableView.horizontalHeader()
         # header.setSectionResizeMode(QHeaderView.ResizeMode.Interactive)
         header.setDefaultSectionSize(135)
+        # маска пароля - готовой картинкой; строки одной высоты, без sizeHint для каждой строки
+        self.password_delegate = PasswordDelegate(self.tableView)
+        self.tableView.setItemDelegateForColumn(self.table_model.password_col, self.password_delegate)
+        rows_header = self.tableView.verticalHeader()
+        rows_header.setSectionResizeMode(QtWidgets.QHeaderView.ResizeMode.Fixed)
+        rows_header.setDefaultSectionSize(TABLE_ROW_HEIGHT)
+
+    def queue_search(self):  # ввод в строке поиска: поиск - после паузы во вводе
+        self.search_generation += 1
+        self.search_timer.start()
+
+    def run_search(self):  # применить строку поиска к таблице
+        self.search_timer.stop()
+        query = self.search_edit.text().strip()
+        if not query:
+            self.proxy.set_ids(None)
+            return
+        ids, ranked = self.search_index.search(query)
+        self.proxy.set_ids(ids)
+        if ranked:
+            best = self.proxy.mapFromSource(self.table_model.index(self.table_model.row_of(ranked[0]), 0))
+            if best.isValid():
+                self.tableView.setCurrentIndex(best)
+                self.tableView.scrollTo(best)
+        if self.table_model.canFetchMore():  # в индексе только загруженные страницы - догрузить остальные
+            generation = self.search_generation
+            QtCore.QTimer.singleShot(0, lambda: self.fetch_for_search(generation))
+
+    def fetch_for_search(self, generation):  # страница за проход цикла событий - интерфейс не замирает
+        if generation != self.search_generation:  # запрос изменен - поиск перезапустится сам
+            return
+        self.table_model.fetchMore()
+        if self.table_model.canFetchMore():
+            QtCore.QTimer.singleShot(0, lambda: self.fetch_for_search(generation))
+        else:
+            self.run_search()  # все записи в индексе - окончательный результат
 
     def create_user_session(self, user_session):  # создать пользовательскую сессию
         self.info_label.clear()
         self.user_session = user_session
         self.show_data()
+        if self.um.has_pending_rotation(user_session[0]):  # смена прервана закрытием или сбоем
+            self.resume_rotation()
 
     def copy_to_clipboard(self, index):  # скопировать в буфер обмена по двойному клику по ячейке
         source_index = self.proxy.mapToSource(index)
 
-        real_password = self.table_model._rows[source_index.row()][source_index.column()]
+        real_password = self.table_model.data(source_index, QtCore.Qt.ItemDataRole.EditRole)
+        if real_password is None:
+            self.show_info_message('Failed to decrypt password')
+            return
 
         clipboard = QApplication.clipboard()
         clipboard.setText(real_password)
@@ -478,44 +870,115 @@ class MainWidget(QWidget, MainWidgetUi):
             msecShowTime=100000
         )
 
-    def load_data(self):  # загрузить данные из бд
+    def load_data(self):  # итератор страниц данных из бд
         if not self.user_session:
             return None
-        result = self.um.read_user_data(self.user_session[0], self.user_session[1])
-        if result[0]:
-            data = result[1]
-            return data
+        self.read_errors = []  # (id, сообщение) записей, которые не удалось расшифровать
+        return self.um.iter_user_data(self.user_session[0], self.user_session[1], errors=self.read_errors)
 
     def show_data(self):  # показать данные
-        self.create_table_model()
-        data = self.load_data()
-        if not data:
+        self.flush_edits()
+        pages = self.load_data()
+        if pages is None:
             return
 
-        trans_data = [list(d[1].values()) for d in data] if data else []
+        self.search_index.clear()
+        self.table_model.set_pages(self.transform_page(page) for page in pages)
+        self.table_model.fetchMore()  # первая страница сразу, остальные - при прокрутке
+        self.search_generation += 1
+        self.run_search()
+
+    def transform_page(self, page):  # страница из бд -> строки таблицы
+        if self.read_errors:
+            self.show_info_message(f'{len(self.read_errors)} entries could not be decrypted')
+        rows = [(d[0], [d[1]['name'], d[1]['username'], d[1]['password']]) for d in page]
+        self.search_index.add_many((ud_id, row[0], row[1]) for ud_id, row in rows)
+        return rows
+
+    def load_password(self, ud_id):  # расшифровать пароль записи по запросу
+        result = self.um.read_user_password(ud_id, self.user_session[1], self.user_session[0])
+        if result[0]:
+            return result[1]
+
+    def queue_edit(self, ud_id, row):  # правка в таблице: записать вместе с соседними правками
+        self.pending_edits[ud_id] = row
+        self.edit_timer.start()  # перезапуск таймера - быстрые правки попадут в одну транзакцию
+        self.search_index.add(ud_id, row[0], row[1])
+        if self.search_edit.text().strip():
+            self.queue_search()
+
+    def flush_edits(self):  # записать накопленные правки одной транзакцией
+        self.edit_timer.stop()
+        if not self.pending_edits or not self.user_session:
+            self.pending_edits.clear()
+            return
+        data = [(ud_id, {'name': row[0], 'username': row[1], 'password': row[2]})
+                for ud_id, row in self.pending_edits.items()]
+        self.pending_edits = dict()
+        future = self.um.submit(self.um.update_many, self.user_session[0], self.user_session[1], data)
+        WriteWatcher(self, future, self.on_edits_saved)
 
-        self.internal_id = {j[1]['name'] + '~' + j[1]['username']: j[0] for j in data}  # внутренний id
-        self.table_model._headers = TABLE_HEADERS
-        self.table_model._rows = trans_data
-        self.table_model.endResetModel()
+    def on_edits_saved(self, result):  # результат записи правок
+        self.show_info_message(result[1] if result[0] else f'Edit not saved: {result[1]}')
 
     def show_info_message(self, msg):  # вывести сообщение
         self.info_label.setText(msg)
 
-    def del_data(self):  # удалить один пароль
-        ind = self.tableView.selectionModel().selectedIndexes()
-        if len(ind) != 3:
-            self.show_info_message('Select whole row to Delete')
-            return
-        key = '~'.join([self.proxy.data(i, 0) for i in ind[:-1]])  # выбранные данные
-        if key not in self.internal_id.keys():
-            self.show_info_message('Select whole row to Delete')
+    def del_data(self):  # удалить выбранные строки одной транзакцией
+        rows = self.tableView.selectionModel().selectedRows()  # только полностью выделенные строки
+        if not rows:
+            self.show_info_message('Select whole rows to Delete')
             return
-        result = self.um.delete_user_data(self.internal_id[key])
+        ud_ids = [self.table_model.row_id(self.proxy.mapToSource(i).row()) for i in rows]
+        WriteWatcher(self, self.um.submit(self.um.delete_many, self.user_session[0], ud_ids),
+                     lambda result: self.on_rows_deleted(ud_ids, result))
+
+    def on_rows_deleted(self, ud_ids, result):  # результат фонового удаления: убрать только эти строки
         if result[0]:
-            self.show_data()
+            for ud_id in ud_ids:
+                self.pending_edits.pop(ud_id, None)
+                self.search_index.remove(ud_id)
+            self.table_model.remove_ids(ud_ids)
         self.show_info_message(result[1])
 
+    def add_rows(self, ud_ids, data):  # добавить записанные записи в конец таблицы
+        # пароль в модели не хранится - как и у загруженных строк, он расшифровывается по запросу
+        self.table_model.insert_rows((ud_id, [datum['name'], datum['username'], None])
+                                     for ud_id, datum in zip(ud_ids, data))
+        self.search_index.add_many((ud_id, datum['name'], datum['username']) for ud_id, datum in zip(ud_ids, data))
+        if self.search_edit.text().strip():  # новые записи тоже проходят через поиск
+            self.queue_search()
+
+    def change_secret(self, slot):  # сменить пароль или PIN-код (данные не перешифровываются)
+        if self.user_session:
+            SecretChange(self.window, slot).exec()
+
+    def rotate_master_key(self):  # сменить мастер-ключ (все записи перешифровываются в фоне)
+        if not self.user_session:
+            return
+        if self.um.has_pending_rotation(self.user_session[0]):
+            self.resume_rotation()
+        else:
+            KeyRotation(self.window).exec()
+
+    def resume_rotation(self):  # перешифровать записи в фоне, интерфейс не ждет
+        if self.rotation is not None and not self.rotation.done():
+            self.show_info_message('Master key rotation is in progress')
+            return
+        self.show_info_message('Rotating master key...')
+        user_session = self.user_session
+        self.rotation = self.um.run_in_background(self.um.rotate_master_key, *user_session)
+        WriteWatcher(self, self.rotation, lambda result: self.on_key_rotated(user_session, result))
+
+    def on_key_rotated(self, user_session, result):  # смена завершена - дальше сессия работает с новым ключом
+        if not result[0]:
+            self.show_info_message(f'Master key rotation stopped: {result[1]}')
+            return
+        if self.window.get_user_session() == user_session:  # пользователь не вышел за время смены
+            self.window.set_current_session(user_session[0], result[1])
+            self.user_session = self.window.get_user_session()
+            self.show_info_message('Master key rotated')
+
     def import_csv_data(self):  # импорт данных из csv-таблицы
         filename = QFileDialog.getOpenFileName(self, 'Open CSV file', '', 'CSV files (*.csv)')[0]
         overall, added = 0, 0
@@ -537,12 +1000,24 @@ class MainWidget(QWidget, MainWidgetUi):
                     added += 1
                 except KeyError:
                     continue
-        result = self.um.write_user_data(self.user_session[0], self.user_session[1], reversed(udata))
+        self.show_info_message('Importing...')
+        udata = udata[::-1]
+        future = self.um.submit(self.um.insert_many, self.user_session[0], self.user_session[1], udata)
+        WriteWatcher(self, future,
+                     lambda result: self.on_rows_added(udata, f'{added}/{overall} imported', result))
+
+    def on_rows_added(self, data, message, result):  # результат фоновой записи новых записей
         if result[0]:
-            self.show_info_message(f'{added}/{overall} imported')
-            self.show_data()
-        else:
-            self.show_info_message(result[1])
+            self.add_rows(result[1], data)
+        self.show_info_message(message if result[0] else result[1])
+
+    def on_secret_changed(self, result):  # итог смены пароля или PIN-кода (диалог мог быть уже закрыт)
+        self.show_info_message(result[1] if result[0] else f'Not changed: {result[1]}')
+
+    def on_rotation_started(self, user_session, result):  # новый ключ сохранен - перешифровка записей в фоне
+        # после выхода смена продолжится при следующем входе (create_user_session)
+        if result[0] and self.window.get_user_session() == user_session:
+            self.resume_rotation()
 
 
 class PasswordCreation(QDialog, PasswordCreationUi):
@@ -580,7 +1055,10 @@ class PasswordCreation(QDialog, PasswordCreationUi):
             Выводит строку message в error_label
 
         add_password()
-            Добавляет пользовательские данные
+            Добавляет пользовательские данные (в фоновом потоке записи)
+
+        on_password_added(result)
+            Закрывает окно после успешной записи или показывает ошибку (строку в таблицу добавляет главный виджет)
 
         generate_password()
             Генерирует пароль
@@ -649,9 +1127,15 @@ class PasswordCreation(QDialog, PasswordCreationUi):
             'password': self.password_lineEdit.text()
         }
 
-        result = self.um.write_user_data(self.user_session[0], self.user_session[1], [data])
+        self.create_button.setEnabled(False)
+        future = self.um.submit(self.um.insert_many, self.user_session[0], self.user_session[1], [data])
+        mw = self.mw  # строка попадает в таблицу и после закрытия диалога (например, отменой)
+        WriteWatcher(mw, future, lambda result: mw.on_rows_added([data], 'Data successfully added', result))
+        WriteWatcher(self, future, self.on_password_added)
+
+    def on_password_added(self, result):  # результат фоновой записи (пока диалог открыт)
+        self.create_button.setEnabled(True)
         if result[0]:
             self.accept()
-            self.mw.show_info_message(result[1])
         else:
             self.show_error_message(result[1])
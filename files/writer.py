@@ -0,0 +1,104 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+from config import WRITER_BATCH_SIZE
+
+
+class DatabaseWriter(threading.Thread):
+    """Класс фонового писателя БД
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Единственный поток, выполняющий запись в БД. Задания берутся из очереди; подряд идущие задания (до batch_size)
+    выполняются в одной транзакции, поэтому серия записей стоит один commit. Каждое задание внутри работает
+    в своем SAVEPOINT (вложенная transaction()), так что ошибка одного не откатывает остальные.
+    Результат возвращается через concurrent.futures.Future только после успешного commit.
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Атрибуты:
+
+    transaction: callable
+        Фабрика контекстного менеджера транзакции
+
+    release: callable
+        Закрывает соединение потока писателя при остановке
+
+    batch_size: int
+        Максимум заданий в одной транзакции
+
+    ------------------------------------------------------------------------------------------------------------------
+
+    Методы:
+
+    submit(func, *args, **kwargs)
+        Ставит вызов func(*args, **kwargs) в очередь и возвращает Future с его результатом
+
+    stop()
+        Дописывает очередь и останавливает поток
+
+    """
+
+    def __init__(self, transaction, release=None, batch_size=WRITER_BATCH_SIZE):
+        super().__init__(name='db-writer', daemon=True)
+        self.transaction = transaction
+        self.release = release
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._stopped = False
+
+    def submit(self, func, *args, **kwargs):  # поставить запись в очередь
+        if self._stopped:
+            raise RuntimeError('Database writer is stopped')
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def stop(self):  # дописать очередь и остановить поток
+        if not self._stopped:
+            self._stopped = True
+            self._queue.put(None)
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        try:
+            running = True
+            while running:
+                job = self._queue.get()
+                if job is None:
+                    break
+                jobs = [job]
+                while len(jobs) < self.batch_size:  # забрать все, что уже накопилось
+                    try:
+                        job = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        running = False
+                        break
+                    jobs.append(job)
+                self._run_batch(jobs)
+        finally:
+            if self.release:
+                self.release()
+
+    def _run_batch(self, jobs):  # выполнить задания в одной транзакции
+        done = []
+        try:
+            with self.transaction():
+                for future, func, args, kwargs in jobs:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with self.transaction():
+                            done.append((future, func(*args, **kwargs)))
+                    except Exception as e:
+                        future.set_exception(e)
+        except Exception as e:  # commit не удался - не записано ни одно задание пакета
+            for future, _ in done:
+                future.set_exception(e)
+        else:
+            for future, result in done:
+                future.set_result(result)